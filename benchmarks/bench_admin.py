@@ -0,0 +1,111 @@
+"""Страницы админки на большой БД: ModelAdmin по умолчанию и настроенные storage/admin.py.
+
+Для сравнения те же модели регистрируются на отдельном AdminSite без
+настроек. Для каждой страницы печатаются время, число запросов и размер HTML.
+Запуск: python benchmarks/bench_admin.py --users 20000 --boxes 100000
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+from datetime import timedelta
+
+from common import create_test_database, destroy_test_database, setup_django
+
+setup_django()
+
+from django.contrib import admin
+from django.contrib.auth.models import User as AdminUser
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import path
+from django.utils import timezone
+
+from storage.models import Box, Promocodes, TransferRequest, User
+
+BATCH_SIZE = 5000
+
+default_site = admin.AdminSite(name='default_admin')
+for model in (User, Box, TransferRequest, Promocodes):
+    default_site.register(model)
+
+urlpatterns = [
+    path('default-admin/', default_site.urls),
+    path('admin/', admin.site.urls),
+]
+
+
+def seed(users_count, boxes_count):
+    now = timezone.now()
+    User.objects.bulk_create(
+        (User(tg_username=f'user{number}', chat_id=10 ** 9 + number) for number in range(users_count)),
+        batch_size=BATCH_SIZE,
+    )
+    user_ids = list(User.objects.values_list('id', flat=True))
+    Box.objects.bulk_create(
+        (Box(user_id=random.choice(user_ids), weight=10, volume=1, paid_from=now,
+             paid_till=now + timedelta(days=random.randint(-60, 365)), description='')
+         for _ in range(boxes_count)),
+        batch_size=BATCH_SIZE,
+    )
+    box_ids = list(Box.objects.values_list('id', flat=True))
+    TransferRequest.objects.bulk_create(
+        (TransferRequest(box_id=box_id, transfer_type=0, address='', is_complete=random.random() > 0.1)
+         for box_id in box_ids),
+        batch_size=BATCH_SIZE,
+    )
+    return box_ids[len(box_ids) // 2], User.objects.get(pk=user_ids[len(user_ids) // 2])
+
+
+def pages(prefix, box_id, user):
+    return {
+        'box_changelist': f'/{prefix}/storage/box/',
+        'box_change': f'/{prefix}/storage/box/{box_id}/change/',
+        'box_search': f'/{prefix}/storage/box/?q={user.chat_id}',
+        'transfer_changelist': f'/{prefix}/storage/transferrequest/',
+        'transfer_change': f'/{prefix}/storage/transferrequest/{box_id}/change/',
+        'user_changelist': f'/{prefix}/storage/user/',
+        'user_search': f'/{prefix}/storage/user/?q={user.tg_username}',
+    }
+
+
+def measure(client, url):
+    client.get(url)
+    with CaptureQueriesContext(connection) as queries:
+        started = time.perf_counter()
+        response = client.get(url)
+        elapsed = time.perf_counter() - started
+    assert response.status_code == 200, (url, response.status_code)
+    return {
+        'ms': round(elapsed * 1000, 1),
+        'queries': len(queries),
+        'html_kb': round(len(response.content) / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--boxes', type=int, default=100000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir, override_settings(ROOT_URLCONF=__name__, DEBUG=True):
+        old_name = create_test_database(os.path.join(workdir, 'bench.sqlite3'))
+        box_id, user = seed(args.users, args.boxes)
+        client = Client()
+        client.force_login(AdminUser.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+
+        results = {}
+        for site, prefix in (('default', 'default-admin'), ('tuned', 'admin')):
+            for page, url in pages(prefix, box_id, user).items():
+                results.setdefault(page, {})[site] = measure(client, url)
+        destroy_test_database(old_name)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""Дневные ряды загрузки склада и выручки: цикл по боксам в Python и storage.analytics на numpy.
+
+Также замеряется то, что делает бот на каждое нажатие "Загрузка склада и
+выручка": чтение готовой сводки из StorageDailyStats.
+Запуск: python benchmarks/bench_analytics.py --users 20000 --boxes 200000
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+from collections import defaultdict
+from datetime import timedelta
+
+from common import create_test_database, destroy_test_database, setup_django
+
+setup_django()
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from storage import analytics
+from storage.models import Box, User
+
+BATCH_SIZE = 5000
+
+
+def seed(users_count, boxes_count, history_days):
+    now = timezone.now()
+    User.objects.bulk_create(
+        (User(tg_username=f'user{number}', chat_id=10 ** 9 + number) for number in range(users_count)),
+        batch_size=BATCH_SIZE,
+    )
+    user_ids = list(User.objects.values_list('id', flat=True))
+    Box.objects.bulk_create(
+        (
+            Box(
+                user_id=random.choice(user_ids),
+                weight=random.choice((10, 25, 40, 70)),
+                volume=random.choice((1, 2, 4)),
+                paid_from=paid_from,
+                paid_till=paid_from + timedelta(days=30 * random.choice((1, 3, 6, 12))),
+                price=random.choice((None, 1000, 2500, 7000)),
+                discount=random.choice((0, 0, 10)),
+                description='',
+            )
+            for paid_from in (now - timedelta(days=random.uniform(0, history_days)) for _ in range(boxes_count))
+        ),
+        batch_size=BATCH_SIZE,
+    )
+
+
+def python_daily_series(today):
+    """То же без numpy: все боксы в память и цикл по дням аренды каждого."""
+    boxes = defaultdict(int)
+    volume = defaultdict(float)
+    revenue = defaultdict(float)
+    rows = Box.objects.filter(paid_from__isnull=False, paid_till__isnull=False) \
+        .values_list('volume', 'paid_from', 'paid_till', 'price')
+    for box_volume, paid_from, paid_till, price in rows.iterator(chunk_size=10000):
+        daily_revenue = (price or 0) / analytics.DAYS_PER_MONTH
+        day = timezone.localtime(paid_from).date()
+        end = min(timezone.localtime(paid_till).date(), today + timedelta(days=1))
+        while day < end:
+            boxes[day] += 1
+            volume[day] += box_volume or 0
+            revenue[day] += daily_revenue
+            day += timedelta(days=1)
+    return boxes, volume, revenue
+
+
+def owner_click():
+    stats = analytics.get_latest_stats()
+    analytics.get_churn(stats)
+    analytics.get_monthly_revenue()
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return round((time.perf_counter() - started) * 1000, 1), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--boxes', type=int, default=200000)
+    parser.add_argument('--history-days', type=int, default=730)
+    parser.add_argument('--clicks', type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        old_name = create_test_database(os.path.join(workdir, 'bench.sqlite3'))
+        seed(args.users, args.boxes, args.history_days)
+        today = timezone.localdate()
+
+        results = {}
+        results['python_loop_ms'], _ = timed(python_daily_series, today)
+        results['numpy_load_ms'], arrays = timed(analytics.load_box_arrays)
+        first_day = int(arrays.start_day.min())
+        results['numpy_compute_ms'], _ = timed(analytics.compute_daily_stats, arrays, first_day, today.toordinal())
+        results['refresh_table_ms'], results['days'] = timed(analytics.refresh_daily_stats)
+
+        latencies = []
+        with CaptureQueriesContext(connection) as queries:
+            for _ in range(args.clicks):
+                started = time.perf_counter()
+                owner_click()
+                latencies.append((time.perf_counter() - started) * 1000)
+        results['owner_click_ms'] = round(sum(latencies) / len(latencies), 2)
+        results['owner_click_queries'] = len(queries) // args.clicks
+        destroy_test_database(old_name)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
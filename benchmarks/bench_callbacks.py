@@ -0,0 +1,133 @@
+"""Поиск обработчика нажатой кнопки: цепочка CallbackQueryHandler с регулярками и CallbackRouter.
+
+Цепочка повторяет прежний register_handlers, аргументы после нее разбираются
+через split('_'), как это делали обработчики. Роутер получает новые
+компактные callback_data и, отдельно, старые - из уже отправленных сообщений.
+Запуск: python benchmarks/bench_callbacks.py --iterations 20000
+"""
+import argparse
+import json
+import timeit
+
+from telegram import CallbackQuery, Update, User
+from telegram.ext import CallbackQueryHandler
+
+import common  # noqa: F401 - добавляет проект в sys.path
+from bot import callbacks
+from bot.callbacks import CallbackRouter
+
+# (pattern, action) в порядке прежней регистрации
+REGEX_CHAIN = (
+    ('^start$', callbacks.START),
+    ('^owner_promos$', callbacks.OWNER_PROMOS),
+    ('^unpaid_boxes', callbacks.UNPAID_BOXES),
+    (r'^transfers(_(after|before)_\d+)?$', callbacks.TRANSFERS_PAGE),
+    ('^transfer_box_', callbacks.TRANSFER_BOX),
+    ('^transfer_complete_', callbacks.TRANSFER_COMPLETE),
+    ('^utm_sources$', callbacks.UTM_SOURCES),
+    ('^client_listboxes$', callbacks.CLIENT_LISTBOXES),
+    ('^client_show_box_', callbacks.CLIENT_SHOW_BOX),
+    ('^client_buy_box$', callbacks.CLIENT_BUY_BOX),
+    ('^client_set_weight_', callbacks.CLIENT_SET_WEIGHT),
+    ('^client_set_volume_', callbacks.CLIENT_SET_VOLUME),
+    ('^client_ask_promo$', callbacks.CLIENT_ASK_PROMO),
+    ('^client_rent_period_', callbacks.CLIENT_RENT_PERIOD),
+    ('^client_ask_phone$', callbacks.CLIENT_ASK_PHONE),
+    ('^client_ask_address$', callbacks.CLIENT_ASK_ADDRESS),
+    ('^client_time_arrive_', callbacks.CLIENT_TIME_ARRIVE),
+    ('^client_save_delivery_transfer$', callbacks.CLIENT_SAVE_DELIVERY_TRANSFER),
+    ('^client_save_transfer$', callbacks.CLIENT_SAVE_TRANSFER),
+    ('^client_self_transfer$', callbacks.CLIENT_SELF_TRANSFER),
+    ('^change_description', callbacks.CHANGE_DESCRIPTION),
+    ('^there is already a boxing$', callbacks.THERE_IS_BOXING),
+    ('^pick up all the things$', callbacks.PICK_UP_ALL),
+    ('^pick up some things$', callbacks.PICK_UP_SOME),
+    ('^pick it up myself$', callbacks.PICK_UP_MYSELF),
+    ('^need a courier for delivery$', callbacks.NEED_COURIER),
+)
+
+# нажатия воронки покупки и меню владельца: (action, args)
+CLICKS = (
+    (callbacks.START, ()),
+    (callbacks.CLIENT_BUY_BOX, ()),
+    (callbacks.CLIENT_SET_WEIGHT, (25,)),
+    (callbacks.CLIENT_SET_VOLUME, (0.5,)),
+    (callbacks.CLIENT_RENT_PERIOD, (6,)),
+    (callbacks.CLIENT_ASK_ADDRESS, ()),
+    (callbacks.CLIENT_TIME_ARRIVE, ('13-18',)),
+    (callbacks.CLIENT_SAVE_TRANSFER, ()),
+    (callbacks.CLIENT_SELF_TRANSFER, ()),
+    (callbacks.CLIENT_SHOW_BOX, (123456,)),
+    (callbacks.TRANSFERS_PAGE, ('after', 98765)),
+    (callbacks.TRANSFER_COMPLETE, (98765,)),
+    (callbacks.PICK_UP_MYSELF, ()),
+)
+
+
+def legacy_data(action, args):
+    return '_'.join([action.legacy, *map(str, args)])
+
+
+def make_update(data):
+    user = User(1, 'client', False)
+    return Update(1, callback_query=CallbackQuery('1', user, 'instance', data=data))
+
+
+def regex_dispatch(handlers, update):
+    for handler, action in handlers:
+        if handler.check_update(update):
+            # так аргументы доставали обработчики
+            if action.arg_types:
+                data = update.callback_query.data
+                if action is callbacks.TRANSFERS_PAGE:
+                    return action, data.split('_')[1:]
+                return action, action.arg_types[0](data.split('_')[-1])
+            return action, ()
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--iterations', type=int, default=20000)
+    args = parser.parse_args()
+
+    handlers = [(CallbackQueryHandler(lambda *_: None, pattern=pattern), action)
+                for pattern, action in REGEX_CHAIN]
+    router = CallbackRouter()
+    for _, action in REGEX_CHAIN:
+        router.add(action, lambda *_: None)
+    router.add(callbacks.TRANSFERS, lambda *_: None)
+
+    legacy_updates = [make_update(legacy_data(action, values)) for action, values in CLICKS]
+    packed_updates = [make_update(action.pack(*values)) for action, values in CLICKS]
+    for update in legacy_updates + packed_updates:
+        assert router.check_update(update)
+
+    def run_regex():
+        for update in legacy_updates:
+            regex_dispatch(handlers, update)
+
+    def run_router(updates):
+        def run():
+            for update in updates:
+                router.check_update(update)
+        return run
+
+    results = {}
+    for name, func in (
+        ('regex_chain', run_regex),
+        ('router_packed', run_router(packed_updates)),
+        ('router_legacy', run_router(legacy_updates)),
+    ):
+        elapsed = timeit.timeit(func, number=args.iterations)
+        results[name] = {'us_per_click': round(elapsed / args.iterations / len(CLICKS) * 1e6, 3)}
+
+    results['callback_data_bytes'] = {
+        'legacy_max': max(len(legacy_data(action, values).encode()) for action, values in CLICKS),
+        'packed_max': max(len(action.pack(*values).encode()) for action, values in CLICKS),
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""Выгрузка /export/boxes.csv: поток порциями по id и сборка всего файла в памяти.
+
+Для каждого варианта печатаются время до первого байта, полное время,
+строк в секунду и пик памяти Python (tracemalloc, отдельным проходом).
+Запуск: python benchmarks/bench_exports.py --users 20000 --boxes 500000
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from datetime import timedelta
+
+from common import create_test_database, destroy_test_database, setup_django
+
+setup_django()
+
+from django.contrib.auth.models import User as AdminUser
+from django.http import HttpResponse
+from django.test import Client, override_settings
+from django.urls import path
+from django.utils import timezone
+
+from storage.exports import EXPORTS, filter_rows
+from storage.models import Box, User
+from storage.views import export_rows
+
+BATCH_SIZE = 5000
+
+
+def export_in_memory(request, name):
+    """Как выгрузка без потока: все строки в список, файл целиком в ответ."""
+    export = EXPORTS[name]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(export.fields)
+    writer.writerows(list(filter_rows(export, request.GET).order_by('pk').values_list(*export.fields)))
+    return HttpResponse(buffer.getvalue(), content_type='text/csv; charset=utf-8')
+
+
+urlpatterns = [
+    path('export/<str:name>.<str:export_format>', export_rows),
+    path('export-in-memory/<str:name>.csv', export_in_memory),
+]
+
+
+def seed(users_count, boxes_count):
+    now = timezone.now()
+    User.objects.bulk_create(
+        (User(tg_username=f'user{number}', chat_id=10 ** 9 + number, phone='9990000000')
+         for number in range(users_count)),
+        batch_size=BATCH_SIZE,
+    )
+    user_ids = list(User.objects.values_list('id', flat=True))
+    Box.objects.bulk_create(
+        (Box(user_id=random.choice(user_ids), weight=25, volume=1, paid_from=now, price=2500,
+             paid_till=now + timedelta(days=random.randint(-60, 365)), description='велосипед')
+         for _ in range(boxes_count)),
+        batch_size=BATCH_SIZE,
+    )
+
+
+def read_response(client, url):
+    started = time.perf_counter()
+    response = client.get(url)
+    assert response.status_code == 200, (url, response.status_code)
+    chunks = response.streaming_content if response.streaming else [response.content]
+    first_byte = None
+    size = 0
+    for chunk in chunks:
+        if first_byte is None:
+            first_byte = time.perf_counter() - started
+        size += len(chunk)
+    return first_byte, time.perf_counter() - started, size
+
+
+def measure(client, url):
+    first_byte, elapsed, size = read_response(client, url)
+    # память отдельным проходом: под tracemalloc все заметно медленнее
+    tracemalloc.start()
+    read_response(client, url)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rows = Box.objects.count()
+    return {
+        'first_byte_ms': round(first_byte * 1000, 1),
+        'total_ms': round(elapsed * 1000, 1),
+        'rows_per_sec': round(rows / elapsed),
+        'peak_mb': round(peak / 2 ** 20, 1),
+        'size_mb': round(size / 2 ** 20, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--boxes', type=int, default=500000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir, override_settings(ROOT_URLCONF=__name__):
+        old_name = create_test_database(os.path.join(workdir, 'bench.sqlite3'))
+        seed(args.users, args.boxes)
+        client = Client()
+        client.force_login(AdminUser.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+
+        results = {
+            'in_memory': measure(client, '/export-in-memory/boxes.csv'),
+            'streaming_csv': measure(client, '/export/boxes.csv'),
+            'streaming_jsonl': measure(client, '/export/boxes.jsonl'),
+        }
+        destroy_test_database(old_name)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
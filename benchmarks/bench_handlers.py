@@ -0,0 +1,205 @@
+"""Обработчики bot/bot.py целиком: Dispatcher с записывающим Bot и засеянная БД.
+
+Сценарии из telegram_updates.py (новый клиент /start, покупка бокса до
+client_save_transfer, список из 200 боксов клиента, все отчеты владельца)
+прогоняются на БД нескольких размеров. Для каждого обработчика печатаются
+перцентили времени, число запросов к БД, вызовов Bot API и выделенная
+память (tracemalloc, отдельным проходом). Вывод - JSON с постоянным
+порядком ключей, удобно сравнивать между коммитами.
+Запуск: python benchmarks/bench_handlers.py --sizes 1000 10000 100000 --iterations 30
+"""
+import argparse
+import contextlib
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from datetime import timedelta
+from queue import Queue
+
+from common import create_test_database, destroy_test_database, percentile, setup_django
+
+setup_django()
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from telegram import Bot, Update
+from telegram.ext import Dispatcher
+
+from bot.bot import register_handlers
+from bot.rendering import load_templates
+from storage.models import Box, Promocodes, TransferRequest, User
+from telegram_updates import buy_box_funnel, client_boxes, new_client_start, owner_reports
+
+BATCH_SIZE = 5000
+OWNER_CHAT_ID = 1
+CLIENT_CHAT_ID = 2
+CLIENT_BOXES = 200
+# chat_id новых клиентов, у засеянных - от 10 ** 9
+NEW_CHAT_IDS = iter(range(10 ** 6, 10 ** 9))
+
+
+class RecordingRequest:
+    """Вместо HTTP запросов к Bot API: запоминает вызовы и отвечает как Telegram."""
+
+    def __init__(self):
+        self.calls = []
+        self._message_ids = iter(range(1, 10 ** 12))
+
+    def post(self, url, data, timeout=None):
+        method = url.rsplit('/', 1)[-1]
+        self.calls.append((method, data))
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_storage_bot'}
+        if method == 'getMyCommands':
+            return []
+        if method.startswith(('send', 'edit')):
+            return {
+                'message_id': next(self._message_ids),
+                'date': int(time.time()),
+                'chat': {'id': int(data['chat_id']), 'type': 'private'},
+            }
+        return True
+
+    def stop(self):
+        pass
+
+
+def seed(boxes_count):
+    """Клиенты с боксами и заявками, владелец и клиент с CLIENT_BOXES боксами."""
+    random.seed(boxes_count)
+    now = timezone.now()
+    users_count = max(1, boxes_count // 5)
+    User.objects.bulk_create(
+        (User(tg_username=f'user{number}', chat_id=10 ** 9 + number,
+              utm_source=random.choice((None, 'vk', 'avito', 'yandex')))
+         for number in range(users_count)),
+        batch_size=BATCH_SIZE,
+    )
+    User.objects.create(tg_username='owner', chat_id=OWNER_CHAT_ID, from_owner=True)
+    client = User.objects.create(tg_username=f'user{CLIENT_CHAT_ID}', chat_id=CLIENT_CHAT_ID, phone='9990000000')
+    user_ids = list(User.objects.filter(chat_id__gte=10 ** 9).values_list('id', flat=True))
+
+    def make_box(user_id):
+        paid_from = now - timedelta(days=random.randint(0, 365))
+        return Box(user_id=user_id, weight=25, volume=1, price=2500, discount=0, description='велосипед',
+                   paid_from=paid_from, paid_till=paid_from + timedelta(days=30 * random.choice((1, 3, 6, 12))))
+
+    Box.objects.bulk_create((make_box(random.choice(user_ids)) for _ in range(boxes_count)), batch_size=BATCH_SIZE)
+    Box.objects.bulk_create(make_box(client.id) for _ in range(CLIENT_BOXES))
+    TransferRequest.objects.bulk_create(
+        (TransferRequest(box_id=box_id, transfer_type=0, address='г. Москва', time_arrive='9-13',
+                         is_complete=random.random() > 0.1)
+         for box_id in Box.objects.values_list('id', flat=True).iterator(chunk_size=BATCH_SIZE)),
+        batch_size=BATCH_SIZE,
+    )
+    Promocodes.objects.bulk_create(
+        Promocodes(name=f'PROMO{number}', discount=5 * number, valid_from=now - timedelta(days=1),
+                   valid_till=now + timedelta(days=30))
+        for number in range(1, 6)
+    )
+    return {
+        'client_box_id': client.boxes.values_list('id', flat=True).first(),
+        'transfer_id': TransferRequest.objects.filter(is_complete=False).values_list('id', flat=True).first(),
+    }
+
+
+def make_dispatcher():
+    request = RecordingRequest()
+    bot = Bot('123456:BENCHMARK', request=request)
+    dispatcher = Dispatcher(bot, Queue(), workers=0)
+    register_handlers(dispatcher)
+    errors = []
+    dispatcher.add_error_handler(lambda update, context: errors.append(repr(context.error)))
+    return dispatcher, request, errors
+
+
+def make_flows(seeded):
+    """Сценарии одного прохода, новым клиентам - новые chat_id."""
+    return {
+        'new_client_start': new_client_start(next(NEW_CHAT_IDS)),
+        'buy_box_funnel': buy_box_funnel(next(NEW_CHAT_IDS), 'PROMO2'),
+        'client_listboxes_200': client_boxes(CLIENT_CHAT_ID, seeded['client_box_id']),
+        'owner_reports': owner_reports(OWNER_CHAT_ID, seeded['transfer_id']),
+    }
+
+
+def run_flows(dispatcher, seeded, on_step):
+    for flow, steps in make_flows(seeded).items():
+        for step in steps:
+            update = Update.de_json(step.update, dispatcher.bot)
+            on_step(f'{flow}.{step.name}', lambda: dispatcher.process_update(update))
+
+
+def measure_size(boxes_count, iterations):
+    seeded = seed(boxes_count)
+    dispatcher, request, errors = make_dispatcher()
+    samples = defaultdict(lambda: {'ms': [], 'queries': [], 'api_calls': []})
+
+    def timed_step(name, process):
+        request.calls.clear()
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            process()
+            elapsed = time.perf_counter() - started
+        samples[name]['ms'].append(elapsed * 1000)
+        samples[name]['queries'].append(len(queries))
+        samples[name]['api_calls'].append(len(request.calls))
+
+    memory = {}
+
+    def traced_step(name, process):
+        request.calls.clear()
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        process()
+        current, peak = tracemalloc.get_traced_memory()
+        memory[name] = {'peak_kb': round((peak - before) / 1024, 1), 'retained_kb': round((current - before) / 1024, 1)}
+
+    # прогрев: кэши шаблонов, промокодов и сводка StorageDailyStats
+    run_flows(dispatcher, seeded, lambda name, process: process())
+    for _ in range(iterations):
+        run_flows(dispatcher, seeded, timed_step)
+    tracemalloc.start()
+    run_flows(dispatcher, seeded, traced_step)
+    tracemalloc.stop()
+
+    handlers = {}
+    for name, sample in sorted(samples.items()):
+        handlers[name] = {
+            'p50_ms': round(percentile(sample['ms'], 50), 2),
+            'p95_ms': round(percentile(sample['ms'], 95), 2),
+            'p99_ms': round(percentile(sample['ms'], 99), 2),
+            'queries': max(sample['queries']),
+            'api_calls': max(sample['api_calls']),
+            **memory[name],
+        }
+    return {'boxes': Box.objects.count(), 'errors': errors, 'handlers': handlers}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='Число засеянных боксов')
+    parser.add_argument('--iterations', type=int, default=30)
+    args = parser.parse_args()
+
+    load_templates()
+    results = {}
+    for boxes_count in args.sizes:
+        # error_handler_function бота печатает ошибки в stdout, там только JSON
+        with tempfile.TemporaryDirectory() as workdir, contextlib.redirect_stdout(sys.stderr):
+            old_name = create_test_database(os.path.join(workdir, 'bench.sqlite3'))
+            results[str(boxes_count)] = measure_size(boxes_count, args.iterations)
+            destroy_test_database(old_name)
+
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
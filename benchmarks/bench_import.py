@@ -0,0 +1,104 @@
+"""Загрузка клиентов и боксов: по одному через ORM и командой import_storage_data.
+
+По одному загружается только --sample строк, скорость считается в строках
+в секунду для обоих вариантов.
+Запуск: python benchmarks/bench_import.py --users 20000 --boxes 200000
+"""
+import argparse
+import io
+import json
+import os
+import random
+import tempfile
+import time
+from datetime import timedelta
+
+from common import create_test_database, destroy_test_database, setup_django
+
+setup_django()
+
+from django.core.management import call_command
+from django.utils import timezone
+
+from storage.importer import read_rows
+from storage.models import Box, User
+
+
+def write_files(workdir, users_count, boxes_count):
+    now = timezone.now()
+    users_path = os.path.join(workdir, 'users.jsonl')
+    boxes_path = os.path.join(workdir, 'boxes.jsonl')
+    with open(users_path, 'w') as file:
+        for number in range(users_count):
+            file.write(json.dumps({'tg_username': f'user{number}', 'chat_id': 10 ** 9 + number,
+                                   'utm_source': random.choice((None, 'vk', 'avito'))}) + '\n')
+    with open(boxes_path, 'w') as file:
+        for number in range(boxes_count):
+            file.write(json.dumps({
+                'id': f'old-{number}',
+                'user__chat_id': 10 ** 9 + random.randrange(users_count),
+                'weight': 25, 'volume': 1, 'price': 2500, 'discount': 0, 'description': '',
+                'paid_from': now.isoformat(),
+                'paid_till': (now + timedelta(days=random.randint(-60, 365))).isoformat(),
+            }) + '\n')
+    return users_path, boxes_path
+
+
+def one_by_one(users_path, boxes_path, sample):
+    """Как при переносе через ORM по одной строке: create и запрос клиента на каждый бокс."""
+    started = time.perf_counter()
+    rows = 0
+    for row in read_rows(users_path):
+        User.objects.create(tg_username=row['tg_username'], chat_id=row['chat_id'], utm_source=row['utm_source'])
+        rows += 1
+        if rows == sample:
+            break
+    created_chat_ids = set(User.objects.values_list('chat_id', flat=True))
+    for row in read_rows(boxes_path):
+        if row['user__chat_id'] not in created_chat_ids:
+            continue
+        Box.objects.create(
+            user=User.objects.get(chat_id=row['user__chat_id']),
+            weight=row['weight'], volume=row['volume'], price=row['price'], discount=row['discount'],
+            description=row['description'], paid_from=row['paid_from'], paid_till=row['paid_till'],
+        )
+        rows += 1
+        if rows == 2 * sample:
+            break
+    elapsed = time.perf_counter() - started
+    Box.objects.all().delete()
+    User.objects.all().delete()
+    return {'rows': rows, 'rows_per_sec': round(rows / elapsed)}
+
+
+def import_command(users_path, boxes_path, rows, **options):
+    started = time.perf_counter()
+    call_command('import_storage_data', users=users_path, boxes=boxes_path, stdout=io.StringIO(), **options)
+    elapsed = time.perf_counter() - started
+    return {'rows': rows, 'seconds': round(elapsed, 1), 'rows_per_sec': round(rows / elapsed)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--boxes', type=int, default=200000)
+    parser.add_argument('--sample', type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        old_name = create_test_database(os.path.join(workdir, 'bench.sqlite3'))
+        users_path, boxes_path = write_files(workdir, args.users, args.boxes)
+
+        rows = args.users + args.boxes
+        results = {
+            'one_by_one': one_by_one(users_path, boxes_path, args.sample),
+            'dry_run': import_command(users_path, boxes_path, rows, dry_run=True),
+            'import_command': import_command(users_path, boxes_path, rows),
+        }
+        destroy_test_database(old_name)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""Планы и время горячих запросов бота до и после миграции 0007 с индексами.
+
+Засевает отдельную БД на схеме 0006, снимает EXPLAIN QUERY PLAN и время,
+затем накатывает 0007 и повторяет замеры.
+Запуск: python benchmarks/bench_indexes.py --users 100000 --boxes 300000
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+from datetime import timedelta
+
+from common import create_test_database, destroy_test_database, percentile, setup_django
+
+setup_django()
+
+from django.core.management import call_command
+from django.db import connection
+from django.utils import timezone
+
+from storage.models import Box, TransferRequest, User
+
+BEFORE_MIGRATION = '0006_remove_transferrequest_is_call_needed_and_more'
+AFTER_MIGRATION = '0007_hot_lookup_indexes'
+BATCH_SIZE = 5000
+
+
+def seed(users_count, boxes_count, overdue_share, open_share):
+    now = timezone.now()
+    User.objects.bulk_create(
+        (User(tg_username=f'user{number}', chat_id=10 ** 9 + number, utm_source=f'source{number % 20}')
+         for number in range(users_count)),
+        batch_size=BATCH_SIZE,
+    )
+    user_ids = list(User.objects.values_list('id', flat=True))
+
+    boxes = []
+    for number in range(boxes_count):
+        if random.random() < overdue_share:
+            paid_till = now - timedelta(days=random.randint(1, 60))
+        else:
+            paid_till = now + timedelta(days=random.randint(1, 365))
+        boxes.append(Box(
+            user_id=random.choice(user_ids),
+            weight=10,
+            volume=1,
+            paid_from=paid_till - timedelta(days=30),
+            paid_till=paid_till,
+            description='',
+        ))
+    Box.objects.bulk_create(boxes, batch_size=BATCH_SIZE)
+
+    box_ids = list(Box.objects.values_list('id', flat=True))
+    TransferRequest.objects.bulk_create(
+        (TransferRequest(
+            box_id=box_id,
+            transfer_type=0,
+            address='',
+            time_arrive='9-13',
+            is_complete=random.random() >= open_share,
+        ) for box_id in box_ids),
+        batch_size=BATCH_SIZE,
+    )
+    cursor = connection.cursor()
+    cursor.execute('ANALYZE')
+
+
+def hot_queries(chat_id):
+    now = timezone.now()
+    return {
+        'start_get_user': User.objects.filter(chat_id=chat_id),
+        'unpaid_boxes': Box.objects.filter(paid_till__lte=now).select_related('user'),
+        'transfers_queue': TransferRequest.objects.filter(is_complete=False)[:8],
+        'utm_sources': User.objects.values('utm_source').order_by('utm_source').distinct(),
+    }
+
+
+def measure(repeats, chat_ids):
+    results = {}
+    for name in hot_queries(chat_ids[0]):
+        timings = []
+        for repeat in range(repeats):
+            queryset = hot_queries(chat_ids[repeat % len(chat_ids)])[name]
+            started = time.perf_counter()
+            list(queryset)
+            timings.append((time.perf_counter() - started) * 1000)
+        sql, params = hot_queries(chat_ids[0])[name].query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            plan = [row[-1] for row in cursor.fetchall()]
+        results[name] = {
+            'p50_ms': round(percentile(timings, 50), 3),
+            'p99_ms': round(percentile(timings, 99), 3),
+            'plan': plan,
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--boxes', type=int, default=60000)
+    parser.add_argument('--overdue-share', type=float, default=0.01)
+    parser.add_argument('--open-share', type=float, default=0.01)
+    parser.add_argument('--repeats', type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        old_name = create_test_database(os.path.join(workdir, 'bench.sqlite3'))
+        call_command('migrate', 'storage', BEFORE_MIGRATION, verbosity=0)
+        seed(args.users, args.boxes, args.overdue_share, args.open_share)
+        chat_ids = random.sample(list(User.objects.values_list('chat_id', flat=True)), 20)
+
+        before = measure(args.repeats, chat_ids)
+        call_command('migrate', 'storage', AFTER_MIGRATION, verbosity=0)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        after = measure(args.repeats, chat_ids)
+        destroy_test_database(old_name)
+
+    print(json.dumps({'before': before, 'after': after}, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
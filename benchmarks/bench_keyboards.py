@@ -0,0 +1,96 @@
+"""Сборка и сериализация клавиатур: как раньше в каждом обработчике и из реестра bot/keyboards.py.
+
+Считается то, что делает обработчик до отправки: собрать InlineKeyboardMarkup
+и превратить его в JSON для Bot API.
+Запуск: python benchmarks/bench_keyboards.py --iterations 20000
+"""
+import argparse
+import json
+import timeit
+import tracemalloc
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from common import setup_django
+
+setup_django()
+
+from bot import keyboards
+from bot.tariffs import RENT_PERIODS, WEIGHT_RANGE
+
+
+def owner_menu_inline():
+    buttons = [
+        [InlineKeyboardButton("Промокоды", callback_data='owner_promos')],
+        [InlineKeyboardButton("Просроченные боксы", callback_data='unpaid_boxes')],
+        [InlineKeyboardButton("Заявки на трансфер", callback_data='transfers')],
+        [InlineKeyboardButton("Источники клиентов", callback_data='utm_sources')],
+    ]
+    return InlineKeyboardMarkup(buttons).to_json()
+
+
+def weights_inline():
+    buttons = []
+    for weight_k, weight_v in WEIGHT_RANGE.items():
+        buttons.append(
+            [InlineKeyboardButton(weight_k, callback_data=f'client_set_weight_{weight_v}')]
+        )
+    return InlineKeyboardMarkup(buttons).to_json()
+
+
+def rent_periods_with_promo_inline():
+    buttons = [
+        [InlineKeyboardButton(period_k, callback_data=f'client_rent_period_{period_v}')]
+        for period_k, period_v in RENT_PERIODS.items()
+    ]
+    buttons.append([InlineKeyboardButton('У меня есть промокод', callback_data='client_ask_promo')])
+    return InlineKeyboardMarkup(buttons).to_json()
+
+
+CASES = {
+    'owner_menu': (owner_menu_inline, lambda: keyboards.OWNER_MENU.to_json()),
+    'weights': (weights_inline, lambda: keyboards.WEIGHTS.to_json()),
+    'rent_periods_with_promo': (rent_periods_with_promo_inline,
+                                lambda: keyboards.RENT_PERIODS_WITH_PROMO.to_json()),
+}
+
+
+def button_texts(markup_json):
+    # callback_data в реестре уже компактные, сравниваем только надписи
+    return [[button['text'] for button in row] for row in json.loads(markup_json)['inline_keyboard']]
+
+
+def peak_bytes(func, iterations):
+    tracemalloc.start()
+    for _ in range(iterations):
+        func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def measure(func, iterations):
+    elapsed = timeit.timeit(func, number=iterations)
+    return {
+        'us_per_call': round(elapsed / iterations * 1e6, 3),
+        'peak_bytes': peak_bytes(func, min(iterations, 1000)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--iterations', type=int, default=20000)
+    args = parser.parse_args()
+
+    results = {}
+    for name, (inline, registry) in CASES.items():
+        assert button_texts(inline()) == button_texts(registry())
+        results[name] = {
+            'inline': measure(inline, args.iterations),
+            'registry': measure(registry, args.iterations),
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
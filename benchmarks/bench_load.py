@@ -0,0 +1,355 @@
+"""Нагрузочный тест бота целиком: виртуальные клиенты против одного процесса бота.
+
+Бот запускается отдельным процессом с обработчиками bot/bot.py и получает
+апдейты через getUpdates (polling) или webhook Django. Telegram изображает
+fake_bot_api.py. Виртуальные пользователи приходят потоком Пуассона с
+частотой --arrival-rate, проходят сценарии из telegram_updates.py
+(новые - покупку бокса, вернувшиеся - список своих боксов) и после каждого
+нажатия ждут ответа бота. Печатаются пропускная способность, время от
+нажатия до ответа и доля ошибок для обоих режимов.
+Запуск: python benchmarks/bench_load.py --users 2000 --arrival-rate 20 --think-time 1
+"""
+import argparse
+import heapq
+import itertools
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from common import create_test_database, destroy_test_database, percentile, setup_django
+
+setup_django()
+
+import requests
+from django.db import connection
+from django.utils import timezone
+
+from fake_bot_api import FakeBotAPI
+from storage.models import Box, Promocodes, User
+from telegram_updates import buy_box_funnel, client_boxes
+
+MODES = ('polling', 'webhook')
+TOKEN = '123456:LOADTEST'
+WEBHOOK_SECRET = 'load-test'
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+BATCH_SIZE = 5000
+PROMO_CODE = 'LOAD10'
+RETURNING_BOXES = 3
+# chat_id новых клиентов не пересекаются между режимами
+NEW_CHAT_IDS = itertools.count(10 ** 6)
+
+
+def serve(args):
+    """Процесс бота: обработчики и настройки как в bot/bot.py и bot/webhook.py."""
+    from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+    from django.core.wsgi import get_wsgi_application
+    from telegram import Bot
+    from telegram.ext import JobQueue, Updater
+    from telegram.utils.request import Request
+
+    from bot.outbox import OutboxSender, get_outbox
+    from bot.webhook import create_dispatcher, get_dispatcher
+
+    connection.settings_dict['NAME'] = args.db
+    if args.serve == 'polling':
+        # пул соединений и интервал опроса как у Updater в bot/bot.py
+        bot = Bot(TOKEN, base_url=os.environ['TELEGRAM_API_URL'], request=Request(con_pool_size=8))
+        dispatcher = create_dispatcher(bot, workers=args.workers, send_outbox=True)
+        dispatcher.job_queue = JobQueue()
+        dispatcher.job_queue.set_dispatcher(dispatcher)
+        updater = Updater(dispatcher=dispatcher, workers=None)
+        updater.start_polling(args.poll_interval)
+        updater.idle()
+        return
+
+    class QuietRequestHandler(WSGIRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    dispatcher = get_dispatcher()
+    if get_outbox() is not None:
+        # в бою Outbox отправляет отдельный процесс BOT_MODE=webhook bot/bot.py
+        OutboxSender(get_outbox(), dispatcher.bot).start()
+    server = ThreadedWSGIServer(('127.0.0.1', args.port), QuietRequestHandler)
+    server.set_app(get_wsgi_application())
+    server.serve_forever()
+
+
+def seed(returning_users, boxes_count):
+    """Вернувшиеся клиенты с боксами, промокод и остальные боксы склада у одного клиента."""
+    now = timezone.now()
+    User.objects.bulk_create(
+        (User(tg_username=f'user{number}', chat_id=10 ** 9 + number, phone='9990000000')
+         for number in range(returning_users)),
+        batch_size=BATCH_SIZE,
+    )
+    other = User.objects.create(tg_username='other', chat_id=10 ** 9 - 1)
+    users = list(User.objects.filter(chat_id__gte=10 ** 9).values_list('id', 'chat_id'))
+
+    def make_box(user_id):
+        return Box(user_id=user_id, weight=25, volume=1, price=2500, discount=0, description='', paid_from=now,
+                   paid_till=now + timedelta(days=random.randint(-30, 365)))
+
+    boxes = [make_box(user_id) for user_id, _ in users for _ in range(RETURNING_BOXES)]
+    boxes += [make_box(other.id) for _ in range(max(0, boxes_count - len(boxes)))]
+    Box.objects.bulk_create(boxes, batch_size=BATCH_SIZE)
+    Promocodes.objects.create(name=PROMO_CODE, discount=10, valid_from=now - timedelta(days=1),
+                              valid_till=now + timedelta(days=30))
+    box_ids = dict(Box.objects.filter(user__chat_id__gte=10 ** 9).values_list('user__chat_id', 'id'))
+    return [(chat_id, box_ids[chat_id]) for _, chat_id in users]
+
+
+class LoadGenerator:
+    """Планировщик виртуальных пользователей.
+
+    Один поток отправляет нажатия по времени из кучи, ответы приходят из
+    потоков fake_bot_api через on_send: первый sendMessage/sendDocument в
+    чат после нажатия считается ответом, следующее нажатие - через
+    случайное время на раздумье.
+    """
+
+    def __init__(self, ingest, think_time, reply_timeout):
+        self.ingest = ingest
+        self.think_time = think_time
+        self.reply_timeout = reply_timeout
+        self.latencies = []
+        self.steps_sent = 0
+        self.flows_completed = 0
+        self.timeouts = 0
+        self.ingest_errors = 0
+        self._events = []
+        self._sequence = itertools.count()
+        self._waiting = {}
+        self.active = 0
+        self._changed = threading.Condition()
+
+    def _schedule(self, when, user, position=None):
+        heapq.heappush(self._events, (when, next(self._sequence), user, position))
+        self._changed.notify()
+
+    def add_user(self, arrive_at, chat_id, steps):
+        with self._changed:
+            self.active += 1
+            self._schedule(arrive_at, {'chat_id': chat_id, 'steps': steps, 'position': 0, 'sent_at': None})
+
+    def _finish(self, user):
+        self._waiting.pop(user['chat_id'], None)
+        self.active -= 1
+        self._changed.notify()
+
+    def on_send(self, chat_id, method, called_at):
+        with self._changed:
+            user = self._waiting.pop(chat_id, None)
+            if user is None:
+                return
+            self.latencies.append(called_at - user['sent_at'])
+            user['position'] += 1
+            if user['position'] == len(user['steps']):
+                self.flows_completed += 1
+                self._finish(user)
+            else:
+                self._schedule(called_at + random.expovariate(1 / self.think_time), user)
+
+    def on_ingest_error(self, user, position):
+        with self._changed:
+            if self._waiting.get(user['chat_id']) is user and user['position'] == position:
+                self.ingest_errors += 1
+                self._finish(user)
+
+    def run(self, deadline):
+        while True:
+            with self._changed:
+                while True:
+                    now = time.perf_counter()
+                    if not self.active or now > deadline:
+                        return
+                    if self._events and self._events[0][0] <= now:
+                        break
+                    self._changed.wait(self._events[0][0] - now if self._events else 0.1)
+                _, _, user, timeout_position = heapq.heappop(self._events)
+                if timeout_position is not None:
+                    # проверка таймаута: ответа на это нажатие так и не было
+                    if self._waiting.get(user['chat_id']) is user and user['position'] == timeout_position:
+                        self.timeouts += 1
+                        self._finish(user)
+                    continue
+                position = user['position']
+                user['sent_at'] = now
+                self._waiting[user['chat_id']] = user
+                self._schedule(now + self.reply_timeout, user, position)
+                self.steps_sent += 1
+            self.ingest(user['steps'][position].update, lambda: self.on_ingest_error(user, position))
+
+
+def make_webhook_ingest(url, connections):
+    """POST апдейтов в webhook, не больше connections одновременно, как max_connections в Telegram."""
+    pool = ThreadPoolExecutor(connections)
+    sessions = threading.local()
+
+    def post(update, on_error):
+        if not hasattr(sessions, 'session'):
+            sessions.session = requests.Session()
+        try:
+            response = sessions.session.post(url, json=update, headers={SECRET_TOKEN_HEADER: WEBHOOK_SECRET},
+                                             timeout=60)
+            if response.status_code != 200:
+                on_error()
+        except requests.RequestException:
+            on_error()
+
+    return lambda update, on_error: pool.submit(post, update, on_error), pool
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def wait_until(check, timeout=60):
+    deadline = time.monotonic() + timeout
+    while not check():
+        if time.monotonic() > deadline:
+            raise RuntimeError('Bot process did not start')
+        time.sleep(0.1)
+
+
+def webhook_ready(port):
+    try:
+        socket.create_connection(('127.0.0.1', port), timeout=1).close()
+    except OSError:
+        return False
+    return True
+
+
+def run_mode(mode, args, db_path, workdir, returning):
+    generator = None
+    api = FakeBotAPI(latency=args.api_latency, record_calls=False,
+                     on_send=lambda *call: generator.on_send(*call)).start()
+    port = free_port()
+    env = dict(
+        os.environ,
+        TELEGRAM_TOKEN=TOKEN,
+        TELEGRAM_API_URL=api.base_url,
+        TELEGRAM_WEBHOOK_SECRET=WEBHOOK_SECRET,
+        BOT_WORKERS=str(args.workers),
+        BOT_SESSIONS_DB=os.path.join(workdir, f'sessions-{mode}.sqlite3'),
+        BOT_OUTBOX_DB=os.path.join(workdir, f'outbox-{mode}.sqlite3') if not args.no_outbox else '',
+    )
+    bot_process = subprocess.Popen(
+        [sys.executable, __file__, '--serve', mode, '--db', db_path, '--port', str(port),
+         '--workers', str(args.workers), '--poll-interval', str(args.poll_interval)],
+        env=env,
+        # error_handler_function бота печатает ошибки в stdout, там только JSON
+        stdout=sys.stderr,
+    )
+    pool = None
+    try:
+        if mode == 'polling':
+            ingest = lambda update, on_error: api.push_update(update)
+            wait_until(lambda: api.method_counts['getUpdates'] or bot_process.poll() is not None)
+        else:
+            ingest, pool = make_webhook_ingest(f'http://127.0.0.1:{port}/telegram/webhook/', args.webhook_connections)
+            wait_until(lambda: webhook_ready(port) or bot_process.poll() is not None)
+        if bot_process.poll() is not None:
+            raise RuntimeError(f'Bot process exited with code {bot_process.returncode}')
+
+        generator = LoadGenerator(ingest, args.think_time, args.reply_timeout)
+        started = time.perf_counter()
+        arrive_at = started
+        # у каждого вернувшегося свой чат: ответы различаются по chat_id
+        returning_users = iter(returning)
+        kinds = [True] * len(returning) + [False] * (args.users - len(returning))
+        random.shuffle(kinds)
+        for is_returning in kinds:
+            arrive_at += random.expovariate(args.arrival_rate)
+            if is_returning:
+                chat_id, box_id = next(returning_users)
+                steps = client_boxes(chat_id, box_id)
+            else:
+                chat_id = next(NEW_CHAT_IDS)
+                steps = buy_box_funnel(chat_id, PROMO_CODE)
+            generator.add_user(arrive_at, chat_id, steps)
+        generator.run(arrive_at + args.drain)
+        elapsed = time.perf_counter() - started
+    finally:
+        if pool:
+            pool.shutdown(wait=False, cancel_futures=True)
+        # под перегрузкой очередь апдейтов разбиралась бы минутами
+        bot_process.kill()
+        bot_process.wait()
+        api.stop()
+
+    latencies = [latency * 1000 for latency in generator.latencies]
+    errors = generator.timeouts + generator.ingest_errors
+    return {
+        'virtual_users': args.users,
+        'flows_completed': generator.flows_completed,
+        'flows_unfinished': generator.active,
+        'steps_sent': generator.steps_sent,
+        'replies_per_sec': round(len(latencies) / elapsed, 1),
+        'click_to_reply_ms': {
+            'p50': round(percentile(latencies, 50), 1),
+            'p90': round(percentile(latencies, 90), 1),
+            'p99': round(percentile(latencies, 99), 1),
+            'max': round(max(latencies), 1),
+        } if latencies else None,
+        'timeouts': generator.timeouts,
+        'ingest_errors': generator.ingest_errors,
+        'error_rate': round(errors / max(generator.steps_sent, 1), 4),
+        'elapsed_sec': round(elapsed, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--serve', choices=MODES, help='запустить процесс бота (используется самим тестом)')
+    parser.add_argument('--db')
+    parser.add_argument('--port', type=int)
+    parser.add_argument('--modes', choices=MODES, nargs='+', default=list(MODES))
+    parser.add_argument('--users', type=int, default=2000, help='Число виртуальных пользователей')
+    parser.add_argument('--arrival-rate', type=float, default=20, help='Новых пользователей в секунду')
+    parser.add_argument('--think-time', type=float, default=1.0, help='Среднее время между нажатиями, с')
+    parser.add_argument('--returning-share', type=float, default=0.3,
+                        help='Доля клиентов, которые смотрят свои боксы, остальные покупают бокс')
+    parser.add_argument('--reply-timeout', type=float, default=30, help='Нет ответа дольше - ошибка')
+    parser.add_argument('--drain', type=float, default=60, help='Сколько ждать после прихода последнего')
+    parser.add_argument('--boxes', type=int, default=20000)
+    parser.add_argument('--workers', type=int, default=0, help='BOT_WORKERS процесса бота')
+    parser.add_argument('--no-outbox', action='store_true',
+                        help='Отвечать напрямую, без Outbox и его лимита ~30 сообщений в секунду')
+    parser.add_argument('--poll-interval', type=float, default=1.0,
+                        help='poll_interval процесса бота, в bot/bot.py 1.0')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='Задержка ответа Bot API, с')
+    parser.add_argument('--webhook-connections', type=int, default=40,
+                        help='Одновременных запросов в webhook, в Telegram max_connections по умолчанию 40')
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+        return
+
+    random.seed(0)
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        db_path = os.path.join(workdir, 'bench.sqlite3')
+        old_name = create_test_database(db_path)
+        returning = seed(int(args.users * args.returning_share), args.boxes)
+        connection.close()
+        for mode in args.modes:
+            results[mode] = run_mode(mode, args, db_path, workdir, returning)
+        destroy_test_database(old_name)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""Задержка обработчика и пропускная способность отправки: напрямую и через Outbox.
+
+Ответы уходят в локальный фейковый Bot API (benchmarks/fake_bot_api.py).
+Запуск: python benchmarks/bench_outbox.py --messages 300 --chats 100 --api-latency 0.05
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup
+
+from common import percentile
+from fake_bot_api import FakeBotAPI
+
+import bot.outbox as outbox_module
+from bot.outbox import OutboxSender, configure_outbox, send_message
+
+REPLY_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton('В начало', callback_data='start')]])
+
+
+def replay(bot, messages, chats):
+    latencies = []
+    for number in range(messages):
+        # каждый третий ответ - промежуточный текст без кнопок, его можно склеить
+        reply_markup = REPLY_MARKUP if number % 3 == 2 else None
+        started = time.perf_counter()
+        send_message(bot, chat_id=number % chats, text=f'Ответ {number}', reply_markup=reply_markup)
+        latencies.append((time.perf_counter() - started) * 1000)
+    return latencies
+
+
+def summary(latencies, elapsed, api, messages):
+    return {
+        'handler_p50_ms': round(percentile(latencies, 50), 3),
+        'handler_p99_ms': round(percentile(latencies, 99), 3),
+        'delivered_per_sec': round(messages / elapsed, 1),
+        'api_calls': len(api.calls),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=300)
+    parser.add_argument('--chats', type=int, default=100)
+    parser.add_argument('--api-latency', type=float, default=0.05)
+    parser.add_argument('--rate-limit-share', type=float, default=0.02)
+    parser.add_argument('--global-rate', type=float, default=30)
+    args = parser.parse_args()
+    results = {}
+
+    api = FakeBotAPI(latency=args.api_latency).start()
+    bot = Bot('123:fake', base_url=api.base_url)
+    started = time.perf_counter()
+    latencies = replay(bot, args.messages, args.chats)
+    results['direct'] = summary(latencies, time.perf_counter() - started, api, args.messages)
+    api.stop()
+
+    api = FakeBotAPI(latency=args.api_latency, rate_limit_share=args.rate_limit_share).start()
+    bot = Bot('123:fake', base_url=api.base_url)
+    with tempfile.TemporaryDirectory() as workdir:
+        outbox = configure_outbox(os.path.join(workdir, 'outbox.sqlite3'))
+        sender = OutboxSender(outbox, bot, global_rate=args.global_rate)
+        started = time.perf_counter()
+        sender.start()
+        latencies = replay(bot, args.messages, args.chats)
+        while len(outbox):
+            time.sleep(0.05)
+        elapsed = time.perf_counter() - started
+        sender.stop()
+        outbox.close()
+        outbox_module._outbox = None
+    results['outbox'] = summary(latencies, elapsed, api, args.messages)
+    results['outbox']['coalesced'] = sender.coalesced
+    api.stop()
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
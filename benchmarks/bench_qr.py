@@ -0,0 +1,73 @@
+"""Сравнивает задержку выдачи QR кода: старый путь через qua.png и пул в памяти.
+
+Запуск: python benchmarks/bench_qr.py --requests 500 --concurrency 8
+"""
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import qrcode
+
+from common import percentile
+from bot.qr import QRCodePool, get_random_code
+
+
+def file_based_handler(workdir):
+    # то, что раньше делали client_self_transfer / sends_qar_code
+    filename = os.path.join(workdir, 'qua.png')
+    qrcode.make(get_random_code()).save(filename)
+    with open(filename, 'rb') as file:
+        return len(file.read())
+
+
+def pool_handler(pool):
+    _, png = pool.get()
+    return len(png)
+
+
+def run(handler, requests, concurrency, pause):
+    def timed(_):
+        started = time.perf_counter()
+        size = handler()
+        elapsed = time.perf_counter() - started
+        # имитируем паузу между заказами, за которую пул успевает пополниться
+        time.sleep(pause)
+        return elapsed, size
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed, range(requests)))
+    latencies = [elapsed * 1000 for elapsed, _ in results]
+    return {
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'mean_ms': round(statistics.mean(latencies), 3),
+        'png_bytes': round(statistics.mean(size for _, size in results)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=300)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--pause', type=float, default=0.01)
+    parser.add_argument('--pool-size', type=int, default=32)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        file_based = run(lambda: file_based_handler(workdir), args.requests, args.concurrency, args.pause)
+
+    pool = QRCodePool(size=args.pool_size)
+    while pool.qsize() < args.pool_size:
+        time.sleep(0.01)
+    pooled = run(lambda: pool_handler(pool), args.requests, args.concurrency, args.pause)
+    pool.shutdown()
+
+    print(json.dumps({'file_based': file_based, 'pool': pooled}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
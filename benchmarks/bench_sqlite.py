@@ -0,0 +1,201 @@
+"""Конкуренция админки и бота за db.sqlite3 в профилях SQLITE_PROFILE=default и production.
+
+Одновременно работают:
+- admin: правка бокса как в change view - чтение, сохранение и LogEntry в одной транзакции;
+- changelist: список боксов админки - COUNT и страница с пользователями;
+- bot: оформление заказа как в client_save_transfer - пользователь, бокс и заявка.
+Каждый профиль запускается в отдельном процессе, потому что настройки
+читаются при импорте settings.
+Запуск: python benchmarks/bench_sqlite.py --duration 5 --bot-threads 8 --admin-threads 2
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import timedelta
+
+from common import create_test_database, destroy_test_database, percentile, setup_django
+
+PROFILES = ('default', 'production')
+
+
+def seed(users_count, boxes_count):
+    from django.contrib.auth.models import User as AdminUser
+    from django.utils import timezone
+
+    from storage.models import Box, User
+
+    User.objects.bulk_create(
+        User(tg_username=f'user{number}', chat_id=number) for number in range(users_count)
+    )
+    user_ids = list(User.objects.values_list('id', flat=True))
+    now = timezone.now()
+    Box.objects.bulk_create(
+        (
+            Box(
+                user_id=random.choice(user_ids),
+                weight=10,
+                volume=1,
+                paid_from=now,
+                paid_till=now + timedelta(days=random.randint(-30, 365)),
+                description='',
+            )
+            for _ in range(boxes_count)
+        ),
+        batch_size=5000,
+    )
+    admin = AdminUser.objects.create_superuser('admin', 'admin@example.com', 'admin')
+    return admin.id, user_ids, list(Box.objects.values_list('id', flat=True))
+
+
+def admin_edit(admin_id, user_ids, box_ids, hold):
+    from django.contrib.admin.models import CHANGE, LogEntry
+    from django.contrib.contenttypes.models import ContentType
+    from django.db import transaction
+
+    from storage.models import Box
+
+    with transaction.atomic():
+        box = Box.objects.get(pk=random.choice(box_ids))
+        box.description = f'Правка {time.time()}'
+        box.save()
+        # форма и связанные объекты сохраняются внутри той же транзакции
+        time.sleep(hold)
+        LogEntry.objects.log_action(
+            admin_id, ContentType.objects.get_for_model(Box).id, box.id, str(box), CHANGE, 'description',
+        )
+
+
+def admin_changelist(admin_id, user_ids, box_ids, hold):
+    from storage.models import Box
+
+    boxes = Box.objects.select_related('user').order_by('-id')
+    boxes.count()
+    list(boxes[:100])
+
+
+def bot_checkout(admin_id, user_ids, box_ids, hold):
+    from django.utils import timezone
+
+    from storage.models import Box, TransferRequest, User
+
+    user = User.objects.get(pk=random.choice(user_ids))
+    user.address = 'г. Москва'
+    user.save()
+    box = Box.objects.create(
+        user=user,
+        weight=25,
+        volume=1,
+        paid_from=timezone.now(),
+        paid_till=timezone.now() + timedelta(days=90),
+        description='',
+    )
+    TransferRequest.objects.create(box=box, transfer_type=0, address=user.address, time_arrive='9-13',
+                                   is_complete=False)
+
+
+WORKLOADS = {
+    'admin': admin_edit,
+    'changelist': admin_changelist,
+    'bot': bot_checkout,
+}
+
+
+def worker(operation, context, deadline, interval, stats):
+    from django.db import OperationalError, connections
+
+    try:
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            try:
+                operation(*context)
+            except OperationalError:
+                stats['errors'] += 1
+            else:
+                stats['latencies'].append((time.perf_counter() - started) * 1000)
+            # админ думает между правками, бот и список работают без пауз
+            time.sleep(max(0, interval - (time.perf_counter() - started)))
+    finally:
+        connections.close_all()
+
+
+def run_profile(args):
+    os.environ['SQLITE_PROFILE'] = args.profile
+    setup_django()
+    from django.conf import settings
+    from django.db import connection
+
+    with tempfile.TemporaryDirectory() as workdir:
+        old_name = create_test_database(os.path.join(workdir, 'bench.sqlite3'))
+        context = (*seed(args.users, args.boxes), args.admin_hold)
+        journal_mode = connection.cursor().execute('PRAGMA journal_mode').fetchone()[0]
+
+        threads_count = {'admin': args.admin_threads, 'changelist': args.changelist_threads,
+                         'bot': args.bot_threads}
+        intervals = {'admin': 1 / args.admin_rate, 'changelist': 0, 'bot': 0}
+        stats = {name: [] for name in WORKLOADS}
+        threads = []
+        deadline = time.monotonic() + args.duration
+        for name, operation in WORKLOADS.items():
+            for _ in range(threads_count[name]):
+                thread_stats = {'latencies': [], 'errors': 0}
+                stats[name].append(thread_stats)
+                threads.append(threading.Thread(
+                    target=worker, args=(operation, context, deadline, intervals[name], thread_stats),
+                ))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        destroy_test_database(old_name)
+
+    result = {
+        'journal_mode': journal_mode,
+        'busy_timeout_sec': settings.DATABASES['default']['OPTIONS']['timeout'],
+    }
+    for name, thread_stats in stats.items():
+        latencies = [latency for item in thread_stats for latency in item['latencies']]
+        result[name] = {
+            'ops_per_sec': round(len(latencies) / args.duration, 1),
+            'p50_ms': round(percentile(latencies, 50), 2) if latencies else None,
+            'p99_ms': round(percentile(latencies, 99), 2) if latencies else None,
+            'locked_errors': sum(item['errors'] for item in thread_stats),
+        }
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--profile', choices=PROFILES, help='запустить один профиль в этом процессе')
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--boxes', type=int, default=20000)
+    parser.add_argument('--bot-threads', type=int, default=8)
+    parser.add_argument('--admin-threads', type=int, default=2)
+    parser.add_argument('--changelist-threads', type=int, default=2)
+    parser.add_argument('--admin-rate', type=float, default=5, help='правок в секунду на поток админки')
+    parser.add_argument('--admin-hold', type=float, default=0.005,
+                        help='сколько секунд админка держит транзакцию открытой')
+    args, _ = parser.parse_known_args()
+
+    if args.profile:
+        run_profile(args)
+        return
+
+    results = {}
+    for profile in PROFILES:
+        output = subprocess.run(
+            [sys.executable, __file__, '--profile', profile, *sys.argv[1:]],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        results[profile] = json.loads(output.strip().splitlines()[-1])
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""Пропускная способность обработки апдейтов при 1, 4 и 16 потоках ChatWorkerPool.
+
+Каждый апдейт пишет бокс и заявку в SQLite и ждет ответа "Telegram API".
+Запуск: python benchmarks/bench_workers.py --updates 400 --chats 50
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+from datetime import timedelta
+from types import SimpleNamespace
+
+from common import create_test_database, destroy_test_database, setup_django
+
+setup_django()
+
+from django.utils import timezone
+
+from bot.concurrency import ChatWorkerPool
+from storage.models import Box, TransferRequest, User
+
+
+def make_handler(api_latency, processed):
+    def handler(update, context):
+        box = Box.objects.create(
+            user_id=update.user_id,
+            weight=10,
+            volume=1,
+            paid_from=timezone.now(),
+            paid_till=timezone.now() + timedelta(days=30),
+            description='',
+        )
+        TransferRequest.objects.create(box=box, transfer_type=0, address='', is_complete=False)
+        # ответ пользователю через Bot API
+        time.sleep(api_latency)
+        processed.append((update.effective_chat.id, update.sequence))
+    return handler
+
+
+def run(workers, users, updates, api_latency):
+    processed = []
+    handler = make_handler(api_latency, processed)
+    pool = ChatWorkerPool(workers)
+    started = time.perf_counter()
+    for number in range(updates):
+        user = users[number % len(users)]
+        update = SimpleNamespace(
+            effective_chat=SimpleNamespace(id=user.chat_id),
+            user_id=user.id,
+            sequence=number,
+        )
+        pool.submit(user.chat_id, handler, update, None)
+    pool.join()
+    elapsed = time.perf_counter() - started
+    pool.stop()
+
+    last_seen = {}
+    ordered = True
+    for chat_id, sequence in processed:
+        if sequence < last_seen.get(chat_id, -1):
+            ordered = False
+        last_seen[chat_id] = sequence
+    return {
+        'workers': workers,
+        'updates_per_sec': round(updates / elapsed, 1),
+        'elapsed_sec': round(elapsed, 3),
+        'per_chat_order_kept': ordered,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--updates', type=int, default=400)
+    parser.add_argument('--chats', type=int, default=50)
+    parser.add_argument('--api-latency', type=float, default=0.02)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 16])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        old_name = create_test_database(os.path.join(workdir, 'bench.sqlite3'))
+        users = [
+            User.objects.create(tg_username=f'user{number}', chat_id=number)
+            for number in range(args.chats)
+        ]
+        results = [run(workers, users, args.updates, args.api_latency) for workers in args.workers]
+        destroy_test_database(old_name)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+import os
+import sys
+
+PROJECT_PATH = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+if PROJECT_PATH not in sys.path:
+    sys.path.insert(0, PROJECT_PATH)
+
+
+def setup_django():
+    """Настраивает Django для бенчмарков без .env файла."""
+    os.chdir(PROJECT_PATH)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'self_storage.settings')
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    os.environ.setdefault('DEBUG', 'False')
+    os.environ.setdefault('ALLOWED_HOSTS', '*')
+
+    import django
+    django.setup()
+
+
+def create_test_database(name):
+    """Создает отдельную БД с миграциями, рабочая db.sqlite3 не затрагивается."""
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+
+    setup_test_environment()
+    connection.settings_dict['TEST']['NAME'] = name
+    return connection.creation.create_test_db(verbosity=0, autoclobber=True)
+
+
+def destroy_test_database(old_name):
+    from django.db import connection
+    from django.test.utils import teardown_test_environment
+
+    connection.creation.destroy_test_db(old_name, verbosity=0)
+    teardown_test_environment()
+
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    index = min(len(samples) - 1, int(round(pct / 100 * (len(samples) - 1))))
+    return samples[index]
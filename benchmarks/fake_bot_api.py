@@ -0,0 +1,137 @@
+"""Локальный HTTP сервер, который отвечает как Telegram Bot API.
+
+Используется бенчмарками: бот подключается к нему через base_url
+(TELEGRAM_API_URL=http://127.0.0.1:<port>/bot). Апдейты для getUpdates
+кладутся в очередь через push_update и отдаются с учетом offset и
+long polling, как в Telegram.
+"""
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CHAT_ID_FIELD = re.compile(rb'name="chat_id"\r\n\r\n(-?\d+)')
+
+
+class FakeBotAPI:
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, rate_limit_share=0.0, record_calls=True,
+                 on_send=None):
+        self.latency = latency
+        self.rate_limit_share = rate_limit_share
+        # при долгой нагрузке тела запросов не копятся, остаются счетчики по методам
+        self.record_calls = record_calls
+        # on_send(chat_id, method, время) вызывается на каждое отправленное ботом сообщение
+        self.on_send = on_send
+        self.calls = []
+        self.method_counts = Counter()
+        self._calls_lock = threading.Lock()
+        self._message_ids = iter(range(1, 10 ** 12))
+        self._updates = deque()
+        self._update_ids = itertools.count(1)
+        self._updates_changed = threading.Condition()
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                method = self.path.rsplit('/', 1)[-1]
+                status, response = api.handle(method, body, self.headers.get('Content-Type', ''))
+                data = json.dumps(response).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address
+        return f'http://{host}:{port}/bot'
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def parse_chat_id(self, body, content_type):
+        if content_type.startswith('application/json'):
+            chat_id = json.loads(body or b'{}').get('chat_id')
+            return int(chat_id) if chat_id is not None else None
+        match = CHAT_ID_FIELD.search(body)
+        return int(match.group(1)) if match else None
+
+    def push_update(self, update):
+        """Ставит апдейт в очередь getUpdates, update_id назначается по порядку."""
+        with self._updates_changed:
+            update = dict(update, update_id=next(self._update_ids))
+            self._updates.append(update)
+            self._updates_changed.notify_all()
+        return update
+
+    def get_updates(self, body, content_type):
+        params = json.loads(body or b'{}') if content_type.startswith('application/json') else {}
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        deadline = time.monotonic() + float(params.get('timeout') or 0)
+        with self._updates_changed:
+            while True:
+                # апдейты до offset бот подтвердил, Telegram их больше не отдает
+                while self._updates and self._updates[0]['update_id'] < offset:
+                    self._updates.popleft()
+                remaining = deadline - time.monotonic()
+                if self._updates or remaining <= 0:
+                    return list(itertools.islice(self._updates, limit))
+                self._updates_changed.wait(remaining)
+
+    def handle(self, method, body, content_type):
+        if method == 'getUpdates':
+            with self._calls_lock:
+                self.method_counts[method] += 1
+            return 200, {'ok': True, 'result': self.get_updates(body, content_type)}
+        if self.latency:
+            time.sleep(self.latency)
+        if method == 'getMe':
+            return 200, {'ok': True, 'result': {
+                'id': 1, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_storage_bot',
+            }}
+        if method == 'getMyCommands':
+            return 200, {'ok': True, 'result': []}
+
+        chat_id = self.parse_chat_id(body, content_type)
+        if method.startswith('send') and random.random() < self.rate_limit_share:
+            return 429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                         'parameters': {'retry_after': 1}}
+
+        called_at = time.perf_counter()
+        with self._calls_lock:
+            self.method_counts[method] += 1
+            if self.record_calls:
+                self.calls.append((called_at, method, chat_id, body))
+        if method.startswith('send') and self.on_send:
+            self.on_send(chat_id, method, called_at)
+        if method.startswith('send'):
+            return 200, {'ok': True, 'result': {
+                'message_id': next(self._message_ids),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+            }}
+        return 200, {'ok': True, 'result': True}
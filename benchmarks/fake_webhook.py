@@ -0,0 +1,87 @@
+"""Локальный отправитель апдейтов в webhook, как это делает Telegram.
+
+Шлет /start и цепочку нажатий кнопок от имени одного пользователя.
+Запуск: python benchmarks/fake_webhook.py http://127.0.0.1:8000/telegram/webhook/ --secret s3cr3t
+"""
+import argparse
+import itertools
+import time
+
+import requests
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+_update_ids = itertools.count(1)
+
+
+def make_user(user_id, username):
+    return {'id': user_id, 'is_bot': False, 'first_name': username, 'username': username}
+
+
+def make_chat(user_id, username):
+    return {'id': user_id, 'type': 'private', 'username': username}
+
+
+def message_update(user_id, username, text):
+    message = {
+        'message_id': next(_update_ids),
+        'date': int(time.time()),
+        'from': make_user(user_id, username),
+        'chat': make_chat(user_id, username),
+        'text': text,
+    }
+    if text.startswith('/'):
+        command = text.split()[0]
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+    return {'update_id': next(_update_ids), 'message': message}
+
+
+def callback_update(user_id, username, data):
+    return {
+        'update_id': next(_update_ids),
+        'callback_query': {
+            'id': str(next(_update_ids)),
+            'from': make_user(user_id, username),
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': {
+                'message_id': next(_update_ids),
+                'date': int(time.time()),
+                'chat': make_chat(user_id, username),
+                'text': '',
+            },
+        },
+    }
+
+
+def post_update(session, url, secret, update):
+    response = session.post(url, json=update, headers={SECRET_TOKEN_HEADER: secret})
+    response.raise_for_status()
+    return response
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('url')
+    parser.add_argument('--secret', required=True)
+    parser.add_argument('--user-id', type=int, default=100500)
+    parser.add_argument('--username', default='webhook_tester')
+    args = parser.parse_args()
+
+    flow = [
+        message_update(args.user_id, args.username, '/start'),
+        callback_update(args.user_id, args.username, 'client_buy_box'),
+        callback_update(args.user_id, args.username, 'client_set_weight_10'),
+        callback_update(args.user_id, args.username, 'client_set_volume_1'),
+        callback_update(args.user_id, args.username, 'client_rent_period_3'),
+    ]
+    with requests.Session() as session:
+        for update in flow:
+            started = time.perf_counter()
+            response = post_update(session, args.url, args.secret, update)
+            elapsed = (time.perf_counter() - started) * 1000
+            print(f'{response.status_code} {elapsed:.1f}ms update_id={update["update_id"]}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""Апдейты Telegram в виде JSON и сценарии пользователей бота для бенчмарков.
+
+Сценарий - список шагов (имя обработчика, апдейт), как их по очереди
+присылает один пользователь. Импортировать после setup_django(): кнопки
+берутся из bot.keyboards.
+"""
+import itertools
+import time
+from collections import namedtuple
+
+from bot import callbacks
+from bot.keyboards import TIME_ARRIVE_RANGES
+
+Step = namedtuple('Step', 'name update')
+
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(1)
+
+
+def user_json(chat_id):
+    return {'id': chat_id, 'is_bot': False, 'first_name': f'User {chat_id}', 'username': f'user{chat_id}'}
+
+
+def message_json(chat_id, text, entities=None):
+    message = {
+        'message_id': next(_message_ids),
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': user_json(chat_id),
+        'text': text,
+    }
+    if entities:
+        message['entities'] = entities
+    return message
+
+
+def command_update(chat_id, command, *args):
+    text = ' '.join((f'/{command}', *args))
+    entities = [{'type': 'bot_command', 'offset': 0, 'length': len(command) + 1}]
+    return {'update_id': next(_update_ids), 'message': message_json(chat_id, text, entities)}
+
+
+def text_update(chat_id, text):
+    return {'update_id': next(_update_ids), 'message': message_json(chat_id, text)}
+
+
+def callback_update(chat_id, data):
+    return {
+        'update_id': next(_update_ids),
+        'callback_query': {
+            'id': str(next(_update_ids)),
+            'from': user_json(chat_id),
+            'chat_instance': str(chat_id),
+            'message': message_json(chat_id, 'menu'),
+            'data': data,
+        },
+    }
+
+
+def new_client_start(chat_id, utm_source='vk'):
+    return [Step('start', command_update(chat_id, 'start', utm_source))]
+
+
+def buy_box_funnel(chat_id, promo_code, utm_source='vk'):
+    """Новый клиент от /start до заявки на вывоз вещей (client_save_transfer)."""
+    return [
+        *new_client_start(chat_id, utm_source),
+        Step('client_buy_box', callback_update(chat_id, callbacks.CLIENT_BUY_BOX.pack())),
+        Step('client_set_weight', callback_update(chat_id, callbacks.CLIENT_SET_WEIGHT.pack(25))),
+        Step('client_set_volume', callback_update(chat_id, callbacks.CLIENT_SET_VOLUME.pack(0.5))),
+        Step('client_ask_promo', callback_update(chat_id, callbacks.CLIENT_ASK_PROMO.pack())),
+        Step('client_apply_promo', text_update(chat_id, promo_code)),
+        Step('client_rent_period', callback_update(chat_id, callbacks.CLIENT_RENT_PERIOD.pack(3))),
+        Step('client_ask_phone', callback_update(chat_id, callbacks.CLIENT_ASK_PHONE.pack())),
+        Step('client_ask_address', text_update(chat_id, '9990001122')),
+        Step('client_ask_time_arrive', text_update(chat_id, 'г. Москва, ул. Ленина 1')),
+        Step('client_time_arrive', callback_update(chat_id, callbacks.CLIENT_TIME_ARRIVE.pack(TIME_ARRIVE_RANGES[0]))),
+        Step('client_save_transfer', callback_update(chat_id, callbacks.CLIENT_SAVE_TRANSFER.pack())),
+    ]
+
+
+def client_boxes(chat_id, box_id):
+    """Клиент со многими боксами смотрит список и один бокс."""
+    return [
+        Step('start', command_update(chat_id, 'start')),
+        Step('client_listboxes', callback_update(chat_id, callbacks.CLIENT_LISTBOXES.pack())),
+        Step('client_show_box', callback_update(chat_id, callbacks.CLIENT_SHOW_BOX.pack(box_id))),
+    ]
+
+
+def owner_reports(chat_id, transfer_id):
+    """Владелец открывает все отчеты из своего меню."""
+    return [
+        Step('start', command_update(chat_id, 'start')),
+        Step('owner_promos', callback_update(chat_id, callbacks.OWNER_PROMOS.pack())),
+        Step('unpaid_boxes', callback_update(chat_id, callbacks.UNPAID_BOXES.pack())),
+        Step('transfers', callback_update(chat_id, callbacks.TRANSFERS.pack())),
+        Step('transfers_page', callback_update(chat_id, callbacks.TRANSFERS_PAGE.pack('after', transfer_id))),
+        Step('transfer_box', callback_update(chat_id, callbacks.TRANSFER_BOX.pack(transfer_id))),
+        Step('utm_sources', callback_update(chat_id, callbacks.UTM_SOURCES.pack())),
+        Step('storage_stats', callback_update(chat_id, callbacks.STORAGE_STATS.pack())),
+    ]
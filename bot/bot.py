@@ -1,31 +1,52 @@
 from environs import Env
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, ParseMode, MessageEntity
+from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup, Update, ParseMode, MessageEntity
 from telegram.ext import (
     Updater,
     CommandHandler,
-    CallbackQueryHandler,
     CallbackContext,
     Filters,
     MessageHandler,
     ConversationHandler,
 )
 
-import os, sys
+import logging
+import os, signal, sys, threading
 from datetime import datetime, timedelta
 from pytz import timezone
 import django
 DJANGO_PROJECT_PATH = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
-sys.path.append(DJANGO_PROJECT_PATH)
+sys.path.insert(0, DJANGO_PROJECT_PATH)
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "self_storage.settings")
-django.setup()
-
-from django.template.loader import render_to_string
-from django.db.models import Count
-
-from storage.models import User, Box, Promocodes, TransferRequest
+# при приеме апдейтов через webhook модуль импортируется уже настроенным Django
+from django.apps import apps
+if not apps.ready:
+    django.setup()
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.functions import Now
+
+from storage import analytics, bulk
+from storage.models import User, Box, Promocodes, TransferRequest, UtmSourceCounter
+
+from bot import callbacks, keyboards, metrics, profiling
+from bot.callbacks import CallbackRouter
+from bot.concurrency import ChatWorkerPool, dispatch_by_chat
+from bot.outbox import OutboxSender, configure_outbox, send_document, send_message
+from bot.qr import get_pool, get_qr_document
+from bot.rendering import load_templates, render, render_each, render_static
+from bot.reminders import ReminderScheduler
+from bot.reports import iter_report_messages, send_report
+from bot.sessions import SQLitePersistence
+from bot.tariffs import (
+    apply_discount,
+    get_monthly_price,
+    get_price_examples,
+    get_quote,
+    promo_codes,
+)
 
-import qrcode
-import random
+logger = logging.getLogger(__name__)
 
 STATIC_PAGES = (
     'forbidden_cargo',
@@ -33,25 +54,7 @@ STATIC_PAGES = (
     'prices',
 )
 
-WEIGHT_RANGE = {
-    'до 10кг': 10,
-    'от 10 до 25кг': 25,
-    'от 25 до 40кг': 40,
-    'от 40 до 70кг': 70,
-    'от 70 до 100кг': 100,
-    'больше 100кг': 200,
-    'Я не знаю :(': 0,
-}
-
-VOLUME_RANGE = {
-    'до 0.1м³': 0.1,
-    'от 0.1 до 0.5м³': 0.5,
-    'от 0.5 до 1м³': 1,
-    'от 1 до 2м³': 2,
-    'от 2 до 4м³': 4,
-    'больше 4 м³': 8,
-    'Я не знаю :(': 0,
-}
+TRANSFERS_PAGE_SIZE = 8
 
 STORAGE_INFO = {
     'address': 'г. Москва, ул. Ленина 104',
@@ -60,17 +63,7 @@ STORAGE_INFO = {
 }
 
 def get_template(template_name, template_context):
-    template_filepath = f'{template_name}.html'
-    return render_to_string(template_filepath, template_context)
-
-
-def calculate_price(weight, volume):
-    if not volume:
-        volume = sum(VOLUME_RANGE.values()) / (len(VOLUME_RANGE) or 1)
-    if not weight:
-        weight = sum(WEIGHT_RANGE.values()) / (len(WEIGHT_RANGE) or 1)
-    price = weight * volume * 100
-    return round(price)
+    return render(template_name, template_context)
 
 
 def start(update: Update, context):
@@ -81,10 +74,13 @@ def start(update: Update, context):
         _, *utm_source = update.message.text.split()
 
     user, is_new_user = User.objects.get_or_create(
-        tg_username=update.effective_user.username,
         chat_id=update.effective_chat.id,
+        defaults={'tg_username': update.effective_user.username},
     )
-    context.user_data['user'] = user
+    if user.tg_username != update.effective_user.username:
+        user.tg_username = update.effective_user.username
+        user.save(update_fields=['tg_username'])
+    context.user_data['user_id'] = user.id
 
     if is_new_user and utm_source:
         context.user_data['utm_source'] = utm_source[0]
@@ -92,121 +88,79 @@ def start(update: Update, context):
     has_boxes = user.boxes.all().count()
     reply_text = f'Здравствуйте {update.effective_user.username}!\n'
     if user.from_owner:
-        buttons = [
-            [InlineKeyboardButton("Промокоды", callback_data='owner_promos')],
-            [InlineKeyboardButton("Просроченные боксы", callback_data='unpaid_boxes')],
-            [InlineKeyboardButton("Заявки на трансфер", callback_data='transfers')],
-            [InlineKeyboardButton("Источники клиентов", callback_data='utm_sources')],
-
-        ]
+        reply_markup = keyboards.OWNER_MENU
     elif has_boxes:
-        buttons = [
-            [InlineKeyboardButton("Список ваших боксов", callback_data='client_listboxes')],
-            [InlineKeyboardButton("Купить еще один бокс", callback_data='client_buy_box')],
-        ]
+        reply_markup = keyboards.CLIENT_MENU
     else:
-        reply_text += get_template('new_client_welcome', {})
-        buttons = [
-            [InlineKeyboardButton("Купить бокс", callback_data='client_buy_box')],
-        ]
-    reply_markup = InlineKeyboardMarkup(buttons)
-    context.bot.send_message(text=reply_text, reply_markup=reply_markup, chat_id=update.effective_chat.id)
+        reply_text += render_static('new_client_welcome', {'price_examples': get_price_examples()})
+        reply_markup = keyboards.NEW_CLIENT_MENU
+    send_message(context.bot, text=reply_text, reply_markup=reply_markup, chat_id=update.effective_chat.id)
 
 
 def owner_promos(update: Update, context):
     query = update.callback_query
     query.answer()
-    promos = Promocodes.objects.all()
-
-    reply_text = 'Действующих промокодов нет'
-    if promos:
-        promo_html = [get_template('promos', {'promo': promo}) for promo in promos]
-        reply_text = '\n'.join(promo_html)
+    promos = Promocodes.objects.order_by('id')
 
-    buttons = [
-        [InlineKeyboardButton(f'В начало', callback_data=f'start')],
-    ]
-
-    reply_markup = InlineKeyboardMarkup(buttons)
-    query.bot.send_message(text=reply_text, reply_markup=reply_markup, chat_id=update.effective_chat.id)
+    reply_markup = keyboards.TO_START
+    messages = iter_report_messages(promos, 'promos', 'promo')
+    send_report(query.bot, update.effective_chat.id, messages, 'Действующих промокодов нет', reply_markup)
 
 
 def client_listboxes(update: Update, context):
     query = update.callback_query
     query.answer()
-    boxes = context.user_data['user'].boxes.all()
+    boxes = list(Box.objects.filter(user_id=context.user_data['user_id']))
     reply_text = 'Список ваших боксов\n'
-    buttons = []
-    for box in boxes:
-        button_text = get_template('client_box', {'box': box})
-        buttons.append(
-            [InlineKeyboardButton(button_text, callback_data=f'client_show_box_{box.id}')]
-        )
-    buttons.append([InlineKeyboardButton('В начало', callback_data=f'start')])
-    reply_markup = InlineKeyboardMarkup(buttons)
-    query.bot.send_message(text=reply_text, reply_markup=reply_markup, chat_id=update.effective_chat.id)
+    reply_markup = keyboards.build_box_list_keyboard(boxes, render_each('client_box', boxes, 'box'))
+    send_message(query.bot, text=reply_text, reply_markup=reply_markup, chat_id=update.effective_chat.id)
 
 
 def client_show_box(update: Update, context):
     query = update.callback_query
     query.answer()
 
-    box_id = int(query.data.split('_')[-1])
+    box_id, = context.args
     box = Box.objects.get(pk=box_id)
-    context.user_data['current_box'] = box
+    context.user_data['current_box_id'] = box.id
 
     reply_text = get_template('showbox', {'box': box})
-    buttons = [
-        [InlineKeyboardButton(f'Заказать доставку вещей', callback_data=f'pick up all the things')],
-        [InlineKeyboardButton(f'Хочу забрать самостоятельно', callback_data=f'pick it up myself')],
-        [InlineKeyboardButton(f'Изменить описание', callback_data=f'change_description')]
-    ]
-    reply_markup = InlineKeyboardMarkup(buttons)
-    query.bot.send_message(text=reply_text, reply_markup=reply_markup, chat_id=update.effective_chat.id)
+    reply_markup = keyboards.BOX_ACTIONS
+    send_message(query.bot, text=reply_text, reply_markup=reply_markup, chat_id=update.effective_chat.id)
 
 
 def change_description(update: Update, context):
 
     context.user_data['ask_change_description'] = True
     reply_text = 'Введите новое описание для содержимого бокса:'
-    context.bot.send_message(text=reply_text, chat_id=update.effective_chat.id)
+    send_message(context.bot, text=reply_text, chat_id=update.effective_chat.id)
 
 
 def client_apply_description(update: Update, context):
 
-    Box.objects.filter(pk=context.user_data['current_box'].id).update(description=context.user_data['description'])
+    Box.objects.filter(pk=context.user_data['current_box_id']) \
+        .update(description=context.user_data['description'], updated_at=Now())
 
-    box = Box.objects.get(pk=context.user_data['current_box'].id)
+    box = Box.objects.get(pk=context.user_data['current_box_id'])
 
     reply_text = get_template('showbox', {'box': box})
-    buttons = [
-        [InlineKeyboardButton(f'Заказать доставку вещей', callback_data=f'pick up all the things')],
-        [InlineKeyboardButton(f'Хочу забрать самостоятельно', callback_data=f'pick it up myself')],
-        [InlineKeyboardButton(f'Изменить описание', callback_data=f'change_description')]
-    ]
-    reply_markup = InlineKeyboardMarkup(buttons)
-    context.bot.send_message(text=reply_text, reply_markup=reply_markup, chat_id=update.effective_chat.id)
+    reply_markup = keyboards.BOX_ACTIONS
+    send_message(context.bot, text=reply_text, reply_markup=reply_markup, chat_id=update.effective_chat.id)
 
 def client_buy_box(update: Update, context):
     query = update.callback_query
     query.answer()
 
     reply_text = 'Укажите вес вещей, которые вы хотите хранить в боксе:'
-
-    buttons = []
-    for weight_k, weight_v in WEIGHT_RANGE.items():
-        buttons.append(
-            [InlineKeyboardButton(weight_k, callback_data=f'client_set_weight_{weight_v}')]
-        )
-    reply_markup = InlineKeyboardMarkup(buttons)
-    query.bot.send_message(text=reply_text, reply_markup=reply_markup, chat_id=update.effective_chat.id)
+    reply_markup = keyboards.WEIGHTS
+    send_message(query.bot, text=reply_text, reply_markup=reply_markup, chat_id=update.effective_chat.id)
 
 
 def client_set_weight(update: Update, context):
     query = update.callback_query
     query.answer()
 
-    weight = int(query.data.split('_')[-1])
+    weight, = context.args
     context.user_data['weight'] = weight
 
     reply_text = ''
@@ -216,23 +170,19 @@ def client_set_weight(update: Update, context):
 
     reply_text += 'Теперь укажите объем груза. Объем рассчитывается как перемножение' \
                   ' трех величин в метрах: высоты, ширины и длины:'
-    buttons = []
-    for volume_k, volume_v in VOLUME_RANGE.items():
-        buttons.append(
-            [InlineKeyboardButton(volume_k, callback_data=f'client_set_volume_{volume_v}')]
-        )
-    reply_markup = InlineKeyboardMarkup(buttons)
-    query.bot.send_message(text=reply_text, reply_markup=reply_markup, chat_id=update.effective_chat.id)
+    reply_markup = keyboards.VOLUMES
+    send_message(query.bot, text=reply_text, reply_markup=reply_markup, chat_id=update.effective_chat.id)
 
 
 def client_set_volume(update: Update, context):
     query = update.callback_query
     query.answer()
 
-    volume = float(query.data.split('_')[-1])
-    price = calculate_price(context.user_data['weight'], volume)
+    volume, = context.args
+    price = get_monthly_price(context.user_data['weight'], volume)
     context.user_data['volume'] = volume
     context.user_data['price'] = price
+    context.user_data['discount'] = 0
 
     reply_text = ''
     if not context.user_data['weight'] and not volume:
@@ -246,38 +196,58 @@ def client_set_volume(update: Update, context):
         reply_text += f'Цена вашего бокса составляет: {price} руб. в месяц\n\n' \
                       f'Укажите период аренды:'
 
-    buttons = [
-        [InlineKeyboardButton(f'1 месяц', callback_data=f'client_rent_period_1')],
-        [InlineKeyboardButton(f'3 месяца', callback_data=f'client_rent_period_3')],
-        [InlineKeyboardButton(f'6 месяцев', callback_data=f'client_rent_period_6')],
-        [InlineKeyboardButton(f'12 месяцев', callback_data=f'client_rent_period_12')],
-    ]
-    reply_markup = InlineKeyboardMarkup(buttons)
-    query.bot.send_message(text=reply_text, reply_markup=reply_markup, chat_id=update.effective_chat.id)
+    reply_markup = keyboards.RENT_PERIODS_MENU
+    if price:
+        reply_markup = keyboards.RENT_PERIODS_WITH_PROMO
+    send_message(query.bot, text=reply_text, reply_markup=reply_markup, chat_id=update.effective_chat.id)
+
+
+def client_ask_promo(update: Update, context):
+    query = update.callback_query
+    query.answer()
+
+    context.user_data['ask_promo'] = True
+    reply_text = 'Введите промокод:'
+    send_message(query.bot, text=reply_text, chat_id=update.effective_chat.id)
+
+
+def client_apply_promo(update: Update, context):
+    discount = promo_codes.get_discount(context.user_data['promo_code'])
+    monthly_price = get_monthly_price(context.user_data['weight'], context.user_data['volume'])
+
+    if discount:
+        context.user_data['discount'] = discount
+        context.user_data['price'] = apply_discount(monthly_price, discount)
+        reply_text = f'Промокод применен, скидка {discount}%.\n' \
+                     f'Цена вашего бокса составляет: {context.user_data["price"]} руб. в месяц\n\n'
+    else:
+        reply_text = 'Такого промокода нет или срок его действия закончился.\n\n'
+    reply_text += 'Укажите период аренды:'
+
+    reply_markup = keyboards.RENT_PERIODS_MENU
+    send_message(context.bot, text=reply_text, reply_markup=reply_markup, chat_id=update.effective_chat.id)
 
 
 def client_rent_period(update: Update, context):
     query = update.callback_query
     query.answer()
 
-    user = context.user_data['user']
+    user = User.objects.only('phone').get(pk=context.user_data['user_id'])
 
-    period = int(query.data.split('_')[-1])
+    period, = context.args
     context.user_data['period'] = period
 
-    data_for_transfer_request = f'client_ask_phone'
-    if user.phone:
-        data_for_transfer_request = f'client_ask_address'
-
     context.user_data['transfer_type'] = 0
 
     reply_text = 'Как ваши вещи окажутся на складе?'
-    buttons = [
-        [InlineKeyboardButton(f'Нужно забрать вещи по адресу', callback_data=data_for_transfer_request)],
-        [InlineKeyboardButton(f'Доставлю свои вещи сам', callback_data=f'client_self_transfer')],
-    ]
-    reply_markup = InlineKeyboardMarkup(buttons)
-    query.bot.send_message(text=reply_text, reply_markup=reply_markup, chat_id=update.effective_chat.id)
+    quote = get_quote(context.user_data['weight'], context.user_data['volume'], period,
+                      context.user_data.get('discount', 0))
+    if context.user_data.get('price'):
+        reply_text = f'Стоимость хранения за весь срок: {quote.total_price} руб.\n\n{reply_text}'
+    reply_markup = keyboards.PICKUP_WAYS_ASK_PHONE
+    if user.phone:
+        reply_markup = keyboards.PICKUP_WAYS_ASK_ADDRESS
+    send_message(query.bot, text=reply_text, reply_markup=reply_markup, chat_id=update.effective_chat.id)
 
 
 def client_ask_phone(update: Update, context):
@@ -285,47 +255,37 @@ def client_ask_phone(update: Update, context):
     # is asking phone
     context.user_data['ask_phone'] = True
     reply_text = 'Пожалуйста, введите ваш номер телефона:'
-    context.bot.send_message(text=reply_text, chat_id=update.effective_chat.id)
+    send_message(context.bot, text=reply_text, chat_id=update.effective_chat.id)
 
 def client_ask_address(update: Update, context):
 
     # is asking address
     context.user_data['ask_address'] = True
     reply_text = 'Пожалуйста, введите ваш адрес:'
-    context.bot.send_message(text=reply_text, chat_id=update.effective_chat.id)
+    send_message(context.bot, text=reply_text, chat_id=update.effective_chat.id)
 
 def client_ask_time_arrive(update: Update, context):
 
     reply_text = 'В какое время вам удобно, чтобы приехали наши грузчики?'
-    buttons = [
-        [InlineKeyboardButton(f'9-13', callback_data=f'client_time_arrive_9-13')],
-        [InlineKeyboardButton(f'13-18', callback_data=f'client_time_arrive_13-18')],
-        [InlineKeyboardButton(f'18-22', callback_data=f'client_time_arrive_18-22')],
-    ]
-    reply_markup = InlineKeyboardMarkup(buttons)
-    context.bot.send_message(text=reply_text, reply_markup=reply_markup, chat_id=update.effective_chat.id)
+    reply_markup = keyboards.TIME_ARRIVE
+    send_message(context.bot, text=reply_text, reply_markup=reply_markup, chat_id=update.effective_chat.id)
 
 
 def client_time_arrive(update: Update, context):
     query = update.callback_query
     query.answer()
 
-    time_arrive = query.data.split('_')[-1]
+    time_arrive, = context.args
     context.user_data['time_arrive'] = time_arrive
 
     reply_text = 'Подтвердите согласие на обработку персональных данных. Полный текст доступен по адресу:' \
                  'http://some.url/text.pdf'
 
     if context.user_data['transfer_type'] == 0:
-        data_for_transfer_request = 'client_save_transfer'
+        reply_markup = keyboards.CONSENT_PICKUP
     else:
-        data_for_transfer_request = 'client_save_delivery_transfer'
-
-    buttons = [
-        [InlineKeyboardButton(f'Согласен на обработку перс.данных', callback_data=data_for_transfer_request)],
-    ]
-    reply_markup = InlineKeyboardMarkup(buttons)
-    context.bot.send_message(text=reply_text, reply_markup=reply_markup, chat_id=update.effective_chat.id)
+        reply_markup = keyboards.CONSENT_DELIVERY
+    send_message(context.bot, text=reply_text, reply_markup=reply_markup, chat_id=update.effective_chat.id)
 
 
 def client_save_transfer(update: Update, context):
@@ -333,45 +293,43 @@ def client_save_transfer(update: Update, context):
     query.answer()
 
     # save user phone & address in DB
-    user = context.user_data['user']
+    user = User.objects.get(pk=context.user_data['user_id'])
     if context.user_data.get('phone'):
         user.phone = context.user_data['phone']
     user.address = context.user_data['address']
-    user.save()
-
-    # save box in DB
-    box = Box.objects.create(
-        user=context.user_data['user'],
-        weight=context.user_data['weight'],
-        volume=context.user_data['volume'],
-        paid_from=datetime.now(),
-        paid_till=datetime.now() + timedelta(days = context.user_data['period'] * 30),
-        description='',
-    )
 
-    # save transfer in DB
-    TransferRequest.objects.create(
-        box=box,
-        transfer_type=0,
-        address=context.user_data['address'],
-        time_arrive=context.user_data['time_arrive'],
-        is_complete=False,
-    )
+    with transaction.atomic():
+        user.save(update_fields=['phone', 'address'])
+
+        # save box in DB
+        box = Box.objects.create(
+            user_id=context.user_data['user_id'],
+            weight=context.user_data['weight'],
+            volume=context.user_data['volume'],
+            paid_from=datetime.now(),
+            paid_till=datetime.now() + timedelta(days = context.user_data['period'] * 30),
+            description='',
+            price=context.user_data.get('price'),
+            discount=context.user_data.get('discount') or 0,
+        )
 
-    utm_source = context.user_data.get('utm_source')
-    if utm_source:
-        context.user_data['user'].utm_source = utm_source
-        context.user_data['user'].save()
+        # save transfer in DB
+        TransferRequest.objects.create(
+            box=box,
+            transfer_type=0,
+            address=context.user_data['address'],
+            time_arrive=context.user_data['time_arrive'],
+            is_complete=False,
+        )
+
+        UtmSourceCounter.objects.record_order(user.id, context.user_data.get('utm_source'))
 
     context.user_data['transfer_type'] = None
     context.user_data['utm_source'] = None
 
     reply_text = 'Спасибо за ваш заказ! Наши грузчики позвонят вам за 1 час до приезда'
-    buttons = [
-        [InlineKeyboardButton('В начало', callback_data=f'start')]
-    ]
-    reply_markup = InlineKeyboardMarkup(buttons)
-    query.bot.send_message(text=reply_text, reply_markup=reply_markup, chat_id=update.effective_chat.id)
+    reply_markup = keyboards.TO_START
+    send_message(query.bot, text=reply_text, reply_markup=reply_markup, chat_id=update.effective_chat.id)
 
 
 def client_save_delivery_transfer(update: Update, context):
@@ -380,7 +338,7 @@ def client_save_delivery_transfer(update: Update, context):
 
     # save transfer in DB
     TransferRequest.objects.create(
-        box=context.user_data['current_box'],
+        box_id=context.user_data['current_box_id'],
         transfer_type=1,
         address=context.user_data['address'],
         time_arrive=context.user_data['time_arrive'],
@@ -388,46 +346,41 @@ def client_save_delivery_transfer(update: Update, context):
     )
 
     context.user_data['transfer_type'] = None
-    context.user_data['current_box'] = None
+    context.user_data['current_box_id'] = None
 
     reply_text = 'Спасибо за ваш заказ! Наши грузчики позвонят вам за 1 час до приезда'
-    buttons = [
-        [InlineKeyboardButton('В начало', callback_data=f'start')]
-    ]
-    reply_markup = InlineKeyboardMarkup(buttons)
-    query.bot.send_message(text=reply_text, reply_markup=reply_markup, chat_id=update.effective_chat.id)
+    reply_markup = keyboards.TO_START
+    send_message(query.bot, text=reply_text, reply_markup=reply_markup, chat_id=update.effective_chat.id)
 
 
 def client_self_transfer(update: Update, context):
     query = update.callback_query
     query.answer()
 
-    reply_text = get_template('storage_info', {'storage': STORAGE_INFO})
+    reply_text = render_static('storage_info', {'storage': STORAGE_INFO})
+
+    with transaction.atomic():
+        # save box in DB
+        Box.objects.create(
+            user_id=context.user_data['user_id'],
+            weight=context.user_data['weight'],
+            volume=context.user_data['volume'],
+            paid_from=datetime.now(),
+            paid_till=datetime.now() + timedelta(days = context.user_data['period'] * 30),
+            description='',
+            price=context.user_data.get('price'),
+            discount=context.user_data.get('discount') or 0,
+        )
 
-    # save box in DB
-    Box.objects.create(
-        user=context.user_data['user'],
-        weight=context.user_data['weight'],
-        volume=context.user_data['volume'],
-        paid_from=datetime.now(),
-        paid_till=datetime.now() + timedelta(days = context.user_data['period'] * 30),
-        description='',
-    )
+        # save utm_source for new users with completed order
+        UtmSourceCounter.objects.record_order(context.user_data['user_id'], context.user_data.get('utm_source'))
 
-    # save utm_source for new users with completed order
-    utm_source = context.user_data.get('utm_source')
-    if utm_source:
-        context.user_data['user'].utm_source = utm_source
-        context.user_data['user'].save()
+    context.user_data['utm_source'] = None
 
-    buttons = [
-        [InlineKeyboardButton('В начало', callback_data=f'start')]
-    ]
-    reply_markup = InlineKeyboardMarkup(buttons)
-    get_random_qua_cod()
-    with open('qua.png', 'rb') as file:
-        query.bot.send_document(caption=reply_text, reply_markup=reply_markup, document=file,
-                                chat_id=update.effective_chat.id)
+    reply_markup = keyboards.TO_START
+    _, document = get_qr_document()
+    send_document(query.bot, caption=reply_text, reply_markup=reply_markup, document=document,
+                  chat_id=update.effective_chat.id)
 
 
 def message_handler(update, context):
@@ -439,6 +392,10 @@ def message_handler(update, context):
         context.user_data['address'] = update.message.text
         context.user_data['ask_address'] = False
         client_ask_time_arrive(update, context)
+    elif context.user_data.get('ask_promo'):
+        context.user_data['promo_code'] = update.message.text
+        context.user_data['ask_promo'] = False
+        client_apply_promo(update, context)
     elif context.user_data.get('ask_change_description'):
         context.user_data['description'] = update.message.text
         context.user_data['ask_change_description'] = False
@@ -447,7 +404,8 @@ def message_handler(update, context):
 
 
 def error_handler_function(update, context):
-    print(f"Update: {update} caused error: {context.error}")
+    # исключения обработчиков считает metrics, здесь только трейсбек в лог
+    logger.error('Update %s caused error', update, exc_info=context.error)
 
 
 def unpaid_boxes(update: Update, context):
@@ -455,79 +413,203 @@ def unpaid_boxes(update: Update, context):
     query.answer()
     tz=timezone('Europe/Moscow')      
     current_datetime=datetime.now(tz)
-    boxes = Box.objects.filter(paid_till__lte=current_datetime).prefetch_related('user')
-    reply_text = 'Просроченных боксов нет'
-    if boxes:
-        unpaix_boxes_html = [get_template('unpaid_boxes', {'box': box}) for box in boxes]
-        reply_text = 'Список боксов с просроченной оплатой:\n\n'
-        reply_text += '\n'.join(unpaix_boxes_html)
-
-    buttons = [[InlineKeyboardButton(f'В начало', callback_data=f'start')]]
-    reply_markup = InlineKeyboardMarkup(buttons)
-    query.bot.send_message(text=reply_text, reply_markup=reply_markup, chat_id=update.effective_chat.id)
+    boxes = Box.objects.filter(paid_till__lte=current_datetime) \
+        .select_related('user') \
+        .only('id', 'paid_till', 'user__phone') \
+        .order_by('paid_till', 'id')
+
+    reply_markup = keyboards.TO_START
+    messages = iter_report_messages(boxes, 'unpaid_boxes', 'box',
+                                    header='Список боксов с просроченной оплатой:\n\n')
+    send_report(query.bot, update.effective_chat.id, messages, 'Просроченных боксов нет', reply_markup)
+
+
+def get_transfers_page(direction='after', cursor=None):
+    """Страница очереди заявок по ключу id, обычно один запрос к БД.
+
+    Возвращает заявки страницы по возрастанию id и признаки наличия
+    предыдущей и следующей страниц. Если заявки страницы уже выполнены
+    и листать некуда, возвращается первая страница.
+    """
+    open_transfers = TransferRequest.objects.filter(is_complete=False) \
+        .only('id', 'box_id', 'transfer_type')
+
+    if direction == 'before':
+        page = list(open_transfers.filter(id__lt=cursor).order_by('-id')[:TRANSFERS_PAGE_SIZE + 1])
+        if not page:
+            return get_transfers_page()
+        has_prev = len(page) > TRANSFERS_PAGE_SIZE
+        return page[:TRANSFERS_PAGE_SIZE][::-1], has_prev, True
+
+    if cursor is not None:
+        open_transfers = open_transfers.filter(id__gt=cursor)
+    page = list(open_transfers.order_by('id')[:TRANSFERS_PAGE_SIZE + 1])
+    if not page and cursor is not None:
+        return get_transfers_page()
+    has_next = len(page) > TRANSFERS_PAGE_SIZE
+    return page[:TRANSFERS_PAGE_SIZE], cursor is not None, has_next
 
 
 def transfers(update: Update, context):
     query = update.callback_query
     query.answer()
-    transfers = TransferRequest.objects.filter(is_complete=False)[:8]
+
+    # первая страница или (after|before, id заявки)
+    direction, cursor = context.args or ('after', None)
+
+    page, has_prev, has_next = get_transfers_page(direction, cursor)
     reply_text = 'Заявок на перевозку нет'
-    buttons = []
-    for transfer in transfers:
+    if page:
         reply_text = 'Список заявок на перевозку грузов\n'
-        button_text = f'Бокс № {transfer.box.id}, {transfer.get_transfer_type_display()}'
-        buttons.append(
-            [InlineKeyboardButton(button_text, callback_data=f'transfer_box_{transfer.id}')],
-        )
-    buttons.append([InlineKeyboardButton(f'В начало', callback_data=f'start')])
-    reply_markup = InlineKeyboardMarkup(buttons)
-    query.bot.send_message(text=reply_text, reply_markup=reply_markup, chat_id=update.effective_chat.id)
+    reply_markup = keyboards.build_transfers_keyboard(page, has_prev, has_next)
+    send_message(query.bot, text=reply_text, reply_markup=reply_markup, chat_id=update.effective_chat.id)
 
 
 def utm_sources(update: Update, context):
     query = update.callback_query
     query.answer()
 
-    count_utm_sources = User.objects.all() \
-        .values('utm_source') \
-        .annotate(count=Count('pk', distinct=True))
+    counters = UtmSourceCounter.objects.order_by('utm_source')
+
+    reply_text = get_template('utm_sources', {'utm_sources': counters})
+
+    reply_markup = keyboards.TO_START
+    send_message(query.bot, text=reply_text, reply_markup=reply_markup, chat_id=update.effective_chat.id)
 
-    reply_text = get_template('utm_sources', {'utm_sources': count_utm_sources})
 
-    buttons = [[InlineKeyboardButton(f'В начало', callback_data=f'start')]]
-    reply_markup = InlineKeyboardMarkup(buttons)
-    query.bot.send_message(text=reply_text, reply_markup=reply_markup, chat_id=update.effective_chat.id)
+def storage_stats(update: Update, context):
+    query = update.callback_query
+    query.answer()
+
+    # сводка читается из StorageDailyStats, устаревшая пересчитывается в фоне
+    stats = analytics.get_latest_stats()
+    if stats is None:
+        reply_text = 'Сводка по складу еще считается, попробуйте через минуту'
+    else:
+        churn = analytics.get_churn(stats)
+        reply_text = get_template('storage_stats', {
+            'stats': stats,
+            'churn_percent': None if churn is None else churn * 100,
+            'monthly_revenue': analytics.get_monthly_revenue(),
+        })
+
+    reply_markup = keyboards.TO_START
+    send_message(query.bot, text=reply_text, reply_markup=reply_markup, chat_id=update.effective_chat.id)
 
 
 def transfer_box(update: Update, context):
     query = update.callback_query
     query.answer()
 
-    transfer_id = query.data.split('_')[-1]
+    transfer_id, = context.args
 
     transfer_request = TransferRequest.objects.get(id=transfer_id)
     reply_text = get_template('transfer_info', {'transfer': transfer_request})
 
-    buttons = [
-        [InlineKeyboardButton(f'Пометить трансфер как выполненный', callback_data=f'transfer_complete_{transfer_id}')],
-    ]
-    reply_markup = InlineKeyboardMarkup(buttons)
-    query.bot.send_message(text=reply_text, reply_markup=reply_markup, chat_id=update.effective_chat.id)
+    reply_markup = keyboards.build_transfer_keyboard(transfer_id)
+    send_message(query.bot, text=reply_text, reply_markup=reply_markup, chat_id=update.effective_chat.id)
 
 
 def transfer_complete(update: Update, context):
     query = update.callback_query
     query.answer()
 
-    transfer_id = query.data.split('_')[-1]
+    transfer_id, = context.args
 
-    TransferRequest.objects.filter(id=transfer_id).update(is_complete=True)
+    bulk.complete_transfers(TransferRequest.objects.filter(id=transfer_id))
     reply_text = f'Трансфер {transfer_id} выполнен'
-    buttons = [
-        [InlineKeyboardButton(f'В начало', callback_data=f'start')],
-    ]
-    reply_markup = InlineKeyboardMarkup(buttons)
-    query.bot.send_message(text=reply_text, reply_markup=reply_markup, chat_id=update.effective_chat.id)
+    reply_markup = keyboards.TO_START
+    send_message(query.bot, text=reply_text, reply_markup=reply_markup, chat_id=update.effective_chat.id)
+
+
+BULK_COMMANDS_HELP = 'Массовые команды:\n' \
+                     '/complete_transfers <номера заявок> - отметить заявки выполненными\n' \
+                     '/extend_rentals <месяцев> <номера боксов> - продлить аренду\n' \
+                     '/apply_promo <промокод> <номера боксов> - применить промокод'
+
+
+def is_owner(update: Update):
+    return User.objects.filter(chat_id=update.effective_chat.id, from_owner=True).exists()
+
+
+def parse_ids(args):
+    """Номера через пробел или запятую, None если что-то не число."""
+    ids = [item for arg in args for item in arg.split(',') if item]
+    if not ids or not all(item.isdigit() for item in ids):
+        return None
+    return [int(item) for item in ids]
+
+
+def owner_complete_transfers(update: Update, context):
+    if not is_owner(update):
+        return
+    transfer_ids = parse_ids(context.args)
+    if transfer_ids is None:
+        reply_text = BULK_COMMANDS_HELP
+    else:
+        count = bulk.complete_transfers(TransferRequest.objects.filter(id__in=transfer_ids))
+        reply_text = f'Отмечено выполненными: {count} из {len(transfer_ids)}'
+    send_message(context.bot, text=reply_text, reply_markup=keyboards.TO_START, chat_id=update.effective_chat.id)
+
+
+def owner_extend_rentals(update: Update, context):
+    if not is_owner(update):
+        return
+    months, *box_args = context.args or ('',)
+    box_ids = parse_ids(box_args)
+    if not months.isdigit() or not int(months) or box_ids is None:
+        reply_text = BULK_COMMANDS_HELP
+    else:
+        count = bulk.extend_rentals(Box.objects.filter(id__in=box_ids), int(months))
+        reply_text = f'Продлено боксов: {count} из {len(box_ids)} на {months} мес.'
+    send_message(context.bot, text=reply_text, reply_markup=keyboards.TO_START, chat_id=update.effective_chat.id)
+
+
+def owner_apply_promo(update: Update, context):
+    if not is_owner(update):
+        return
+    promo_name, *box_args = context.args or ('',)
+    box_ids = parse_ids(box_args)
+    promo = Promocodes.objects.filter(name__iexact=promo_name).first() if promo_name else None
+    if box_ids is None:
+        reply_text = BULK_COMMANDS_HELP
+    elif promo is None:
+        reply_text = f'Промокод {promo_name} не найден'
+    else:
+        try:
+            count = bulk.apply_promo(Box.objects.filter(id__in=box_ids), promo)
+        except ValueError:
+            reply_text = f'Промокод {promo.name} сейчас не действует, скидка не применена'
+        else:
+            reply_text = f'Промокод {promo.name} применен к боксам: {count} из {len(box_ids)}'
+    send_message(context.bot, text=reply_text, reply_markup=keyboards.TO_START, chat_id=update.effective_chat.id)
+
+
+PROFILE_COMMAND_HELP = 'Профилирование бота:\n' \
+                       '/profile on [N] - профилировать каждый N-й апдейт\n' \
+                       '/profile dump - сохранить отчет, не выключая\n' \
+                       '/profile off - выключить и сохранить отчет\n' \
+                       '/profile - текущее состояние'
+
+
+def owner_profile(update: Update, context):
+    if not is_owner(update):
+        return
+    action, *args = context.args or ('',)
+    profiler = profiling.profiler
+    if action == 'on' and (not args or args[0].isdigit() and int(args[0])):
+        profiler.start(int(args[0]) if args else None)
+        reply_text = profiler.status()
+    elif action == 'dump':
+        reply_text = f'Отчет сохранен в {profiler.dump(settings.BOT_PROFILE_DIR)}'
+    elif action == 'off':
+        profiler.stop()
+        reply_text = f'Профилирование выключено, отчет в {profiler.dump(settings.BOT_PROFILE_DIR)}'
+    elif not action:
+        reply_text = f'{profiler.status()}\n\n{PROFILE_COMMAND_HELP}'
+    else:
+        reply_text = PROFILE_COMMAND_HELP
+    send_message(context.bot, text=reply_text, reply_markup=keyboards.TO_START, chat_id=update.effective_chat.id)
 ###########################################################################################################
 
 
@@ -537,11 +619,11 @@ def sends_boxing_info(update: Update, _) -> None:
         [
             InlineKeyboardButton(
                 "Забрать все вещи",
-                callback_data='pick up all the things'
+                callback_data=callbacks.PICK_UP_ALL.pack()
             ),
             InlineKeyboardButton(
                 "Забрать часть вещей",
-                callback_data='pick up some things'
+                callback_data=callbacks.PICK_UP_SOME.pack()
             )
         ]
     ]
@@ -569,7 +651,7 @@ def offers_ways_pick_up_things(update, context):
     context.user_data['ask_address'] = True
     context.user_data['transfer_type'] = 1
 
-    context.bot.send_message(text=reply_text, chat_id=update.effective_chat.id)
+    send_message(context.bot, text=reply_text, chat_id=update.effective_chat.id)
 
     '''
     keyboard = [
@@ -615,76 +697,143 @@ def sends_qar_code(update, context):
     query = update.callback_query
     query.answer()
 
-    reply_text = get_template('storage_info', {'storage': STORAGE_INFO})
+    reply_text = render_static('storage_info', {'storage': STORAGE_INFO})
 
-    buttons = [
-        [InlineKeyboardButton(f'В начало', callback_data=f'start')],
-    ]
-    reply_markup = InlineKeyboardMarkup(buttons)
+    reply_markup = keyboards.TO_START
 
-    get_random_qua_cod()
-    with open('qua.png', 'rb') as file:
-        query.bot.send_document(caption=reply_text, reply_markup=reply_markup, document=file,
-                                chat_id=update.effective_chat.id)
+    _, document = get_qr_document()
+    send_document(query.bot, caption=reply_text, reply_markup=reply_markup, document=document,
+                  chat_id=update.effective_chat.id)
 
-def get_random_qua_cod():
-    random_code = ''
-    number_digits = 12
-    for number in range(number_digits):
-        random_code = random_code + random.choice(list(
-            '123456789qwertyuiopasdfghjklzxcvbnmQWERTYUIOPASDFGHJKLZXCVBNM'))
-    filename = "qua.png"
-    img = qrcode.make(random_code)
-    img.save(filename)
 
-
-if __name__ == '__main__':
-    env = Env()
-    env.read_env()
-    tg_token = env('TELEGRAM_TOKEN')
-
-    updater = Updater(tg_token, use_context=True)
-    app = updater.dispatcher
+def register_handlers(app):
+    router = CallbackRouter()
 
     # common handlers
-    app.add_handler(CallbackQueryHandler(start, pattern='^start$'))
+    router.add(callbacks.START, start)
 
     # owner handlers
-    app.add_handler(CallbackQueryHandler(owner_promos, pattern='^owner_promos$'))
-    app.add_handler(CallbackQueryHandler(unpaid_boxes, pattern='^unpaid_boxes'))       
-    app.add_handler(CallbackQueryHandler(transfers, pattern='^transfers$'))
-    app.add_handler(CallbackQueryHandler(transfer_box, pattern='^transfer_box_'))
-    app.add_handler(CallbackQueryHandler(transfer_complete, pattern='^transfer_complete_'))
-    app.add_handler(CallbackQueryHandler(utm_sources, pattern='^utm_sources$'))
+    router.add(callbacks.OWNER_PROMOS, owner_promos)
+    router.add(callbacks.UNPAID_BOXES, unpaid_boxes)
+    router.add(callbacks.TRANSFERS, transfers)
+    router.add(callbacks.TRANSFERS_PAGE, transfers)
+    router.add(callbacks.TRANSFER_BOX, transfer_box)
+    router.add(callbacks.TRANSFER_COMPLETE, transfer_complete)
+    router.add(callbacks.UTM_SOURCES, utm_sources)
+    router.add(callbacks.STORAGE_STATS, storage_stats)
 
     # existing client handlers
-    app.add_handler(CallbackQueryHandler(client_listboxes, pattern='^client_listboxes$'))
-    app.add_handler(CallbackQueryHandler(client_show_box, pattern='^client_show_box_'))
+    router.add(callbacks.CLIENT_LISTBOXES, client_listboxes)
+    router.add(callbacks.CLIENT_SHOW_BOX, client_show_box)
 
     # new box handlers
-    app.add_handler(CallbackQueryHandler(client_buy_box, pattern='^client_buy_box$'))
-    app.add_handler(CallbackQueryHandler(client_set_weight, pattern='^client_set_weight_'))
-    app.add_handler(CallbackQueryHandler(client_set_volume, pattern='^client_set_volume_'))
-    app.add_handler(CallbackQueryHandler(client_rent_period, pattern='^client_rent_period_'))
-    app.add_handler(CallbackQueryHandler(client_ask_phone, pattern='^client_ask_phone$'))
-    app.add_handler(CallbackQueryHandler(client_ask_address, pattern='^client_ask_address$'))
-    app.add_handler(CallbackQueryHandler(client_time_arrive, pattern='^client_time_arrive_'))
-    app.add_handler(CallbackQueryHandler(client_save_delivery_transfer, pattern='^client_save_delivery_transfer$'))
-    app.add_handler(CallbackQueryHandler(client_save_transfer, pattern='^client_save_transfer$'))
-    app.add_handler(CallbackQueryHandler(client_self_transfer, pattern='^client_self_transfer$'))
-    app.add_handler(CallbackQueryHandler(change_description, pattern='^change_description'))
-
-    app.add_handler(CallbackQueryHandler(sends_boxing_info,pattern='^there is already a boxing$'))
-    app.add_handler(CallbackQueryHandler(offers_ways_pick_up_things,pattern='^' + 'pick up all the things' + '$'))
-    app.add_handler(CallbackQueryHandler(offers_ways_pick_up_things,pattern='^' + 'pick up some things' + '$'))
-    app.add_handler(CallbackQueryHandler(sends_qar_code,pattern='^' + "pick it up myself" + '$'))
-    app.add_handler(CallbackQueryHandler(get_client_information,pattern='^' + "need a courier for delivery" + '$'))
-
+    router.add(callbacks.CLIENT_BUY_BOX, client_buy_box)
+    router.add(callbacks.CLIENT_SET_WEIGHT, client_set_weight)
+    router.add(callbacks.CLIENT_SET_VOLUME, client_set_volume)
+    router.add(callbacks.CLIENT_ASK_PROMO, client_ask_promo)
+    router.add(callbacks.CLIENT_RENT_PERIOD, client_rent_period)
+    router.add(callbacks.CLIENT_ASK_PHONE, client_ask_phone)
+    router.add(callbacks.CLIENT_ASK_ADDRESS, client_ask_address)
+    router.add(callbacks.CLIENT_TIME_ARRIVE, client_time_arrive)
+    router.add(callbacks.CLIENT_SAVE_DELIVERY_TRANSFER, client_save_delivery_transfer)
+    router.add(callbacks.CLIENT_SAVE_TRANSFER, client_save_transfer)
+    router.add(callbacks.CLIENT_SELF_TRANSFER, client_self_transfer)
+    router.add(callbacks.CHANGE_DESCRIPTION, change_description)
+
+    router.add(callbacks.THERE_IS_BOXING, sends_boxing_info)
+    router.add(callbacks.PICK_UP_ALL, offers_ways_pick_up_things)
+    router.add(callbacks.PICK_UP_SOME, offers_ways_pick_up_things)
+    router.add(callbacks.PICK_UP_MYSELF, sends_qar_code)
+    router.add(callbacks.NEED_COURIER, get_client_information)
+
+    app.add_handler(router)
     app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("complete_transfers", owner_complete_transfers))
+    app.add_handler(CommandHandler("extend_rentals", owner_extend_rentals))
+    app.add_handler(CommandHandler("apply_promo", owner_apply_promo))
+    app.add_handler(CommandHandler("profile", owner_profile))
 
     # app.add_handler(MessageHandler(Filters.text, confirms_application))
     app.add_handler(MessageHandler(Filters.text, message_handler))
     app.add_error_handler(error_handler_function)
+    profiling.instrument_dispatcher(app)
+    metrics.instrument_dispatcher(app)
 
-    updater.start_polling(1.0)
-    updater.idle()
+
+if __name__ == '__main__':
+    env = Env()
+    env.read_env()
+    tg_token = env('TELEGRAM_TOKEN')
+
+    webhook = env.str('BOT_MODE', 'polling') == 'webhook'
+    updater = None
+    if webhook:
+        # апдейты принимает Django (bot.views.telegram_webhook), а этот процесс регистрирует адрес
+        # и остается единственным отправителем Outbox и напоминаний для всех процессов Django
+        bot = Bot(tg_token, base_url=env.str('TELEGRAM_API_URL', None))
+        metrics.instrument_request(bot.request)
+        bot.set_webhook(
+            url=env.str('TELEGRAM_WEBHOOK_URL'),
+            api_kwargs={'secret_token': env.str('TELEGRAM_WEBHOOK_SECRET')},
+        )
+    else:
+        # прогреваем пул QR кодов и кэш шаблонов до первых заказов
+        get_pool()
+        load_templates()
+
+        persistence = None
+        if settings.BOT_SESSIONS_DB:
+            persistence = SQLitePersistence(settings.BOT_SESSIONS_DB)
+
+        updater = Updater(tg_token, use_context=True, base_url=env.str('TELEGRAM_API_URL', None),
+                          persistence=persistence)
+        register_handlers(updater.dispatcher)
+        bot = updater.bot
+
+    # ответы уходят через очередь в SQLite, обработчики не ждут Bot API
+    outbox_sender = None
+    if settings.BOT_OUTBOX_DB:
+        outbox_sender = OutboxSender(configure_outbox(settings.BOT_OUTBOX_DB), bot)
+        outbox_sender.start()
+
+    reminders = None
+    if settings.BOT_REMINDER_LEAD_DAYS:
+        reminders = ReminderScheduler(bot, lead=timedelta(days=settings.BOT_REMINDER_LEAD_DAYS))
+        reminders.start()
+
+    metrics_writer = None
+    if settings.BOT_METRICS_FILE:
+        metrics_writer = metrics.SnapshotWriter(settings.BOT_METRICS_FILE)
+        metrics_writer.start()
+
+    chat_pool = None
+    if webhook:
+        stopped = threading.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: stopped.set())
+        while not stopped.wait(1):
+            pass
+    else:
+        # kill -USR1 включает профилирование, повторный - выключает и сохраняет отчет,
+        # kill -USR2 сохраняет отчет, не выключая
+        signal.signal(signal.SIGUSR1, lambda *_: profiling.profiler.toggle(settings.BOT_PROFILE_DIR))
+        signal.signal(signal.SIGUSR2, lambda *_: profiling.profiler.dump(settings.BOT_PROFILE_DIR))
+
+        # BOT_WORKERS > 0 включает параллельную обработку апдейтов разных чатов
+        workers = env.int('BOT_WORKERS', 0)
+        if workers:
+            chat_pool = ChatWorkerPool(workers)
+            dispatch_by_chat(updater.dispatcher, chat_pool)
+
+        updater.start_polling(1.0)
+        updater.idle()
+
+    if chat_pool:
+        chat_pool.stop()
+    if reminders:
+        reminders.stop()
+    if outbox_sender:
+        outbox_sender.stop()
+    if metrics_writer:
+        metrics_writer.stop()
+    profiling.profiler.stop()
@@ -0,0 +1,141 @@
+from telegram import Update
+from telegram.ext import Handler
+
+# ограничение Bot API на callback_data
+MAX_CALLBACK_DATA = 64
+SEPARATOR = ':'
+
+
+class CallbackAction:
+    """Действие кнопки: короткий код и типы аргументов.
+
+    В callback_data попадает строка вида "код:арг1:арг2", например "sb:15"
+    вместо "client_show_box_15". legacy - имя, с которого начиналась
+    callback_data раньше: по нему разбираются кнопки в уже отправленных
+    сообщениях.
+    """
+
+    def __init__(self, code, legacy, *arg_types):
+        if SEPARATOR in code:
+            raise ValueError(f'Callback code {code!r} must not contain {SEPARATOR!r}')
+        self.code = code
+        self.legacy = legacy
+        self.arg_types = arg_types
+
+    def __repr__(self):
+        return f'CallbackAction({self.code!r}, {self.legacy!r})'
+
+    def pack(self, *args):
+        if len(args) != len(self.arg_types):
+            raise ValueError(f'{self!r} expects {len(self.arg_types)} arguments, got {len(args)}')
+        parts = [self.code]
+        for arg in args:
+            arg = str(arg)
+            if SEPARATOR in arg:
+                raise ValueError(f'Callback argument {arg!r} must not contain {SEPARATOR!r}')
+            parts.append(arg)
+        data = SEPARATOR.join(parts)
+        if len(data.encode()) > MAX_CALLBACK_DATA:
+            raise ValueError(f'Callback data {data!r} is longer than {MAX_CALLBACK_DATA} bytes')
+        return data
+
+    def unpack(self, args):
+        """Приводит строковые аргументы к типам действия, ValueError при несовпадении."""
+        if len(args) != len(self.arg_types):
+            raise ValueError(f'{self!r} expects {len(self.arg_types)} arguments, got {len(args)}')
+        return tuple(arg_type(arg) for arg_type, arg in zip(self.arg_types, args))
+
+
+START = CallbackAction('st', 'start')
+
+# owner
+OWNER_PROMOS = CallbackAction('op', 'owner_promos')
+UNPAID_BOXES = CallbackAction('ub', 'unpaid_boxes')
+TRANSFERS = CallbackAction('tr', 'transfers')
+# направление (after/before) и id заявки, от которой листать
+TRANSFERS_PAGE = CallbackAction('tp', 'transfers', str, int)
+TRANSFER_BOX = CallbackAction('tb', 'transfer_box', int)
+TRANSFER_COMPLETE = CallbackAction('tc', 'transfer_complete', int)
+UTM_SOURCES = CallbackAction('us', 'utm_sources')
+STORAGE_STATS = CallbackAction('an', 'storage_stats')
+
+# client
+CLIENT_LISTBOXES = CallbackAction('cl', 'client_listboxes')
+CLIENT_SHOW_BOX = CallbackAction('sb', 'client_show_box', int)
+CLIENT_BUY_BOX = CallbackAction('bb', 'client_buy_box')
+CLIENT_SET_WEIGHT = CallbackAction('sw', 'client_set_weight', int)
+CLIENT_SET_VOLUME = CallbackAction('sv', 'client_set_volume', float)
+CLIENT_ASK_PROMO = CallbackAction('ap', 'client_ask_promo')
+CLIENT_RENT_PERIOD = CallbackAction('rp', 'client_rent_period', int)
+CLIENT_ASK_PHONE = CallbackAction('ph', 'client_ask_phone')
+CLIENT_ASK_ADDRESS = CallbackAction('ad', 'client_ask_address')
+CLIENT_TIME_ARRIVE = CallbackAction('ta', 'client_time_arrive', str)
+CLIENT_SAVE_DELIVERY_TRANSFER = CallbackAction('sd', 'client_save_delivery_transfer')
+CLIENT_SAVE_TRANSFER = CallbackAction('sa', 'client_save_transfer')
+CLIENT_SELF_TRANSFER = CallbackAction('ss', 'client_self_transfer')
+CHANGE_DESCRIPTION = CallbackAction('cd', 'change_description')
+
+# выдача вещей из бокса
+THERE_IS_BOXING = CallbackAction('xb', 'there is already a boxing')
+PICK_UP_ALL = CallbackAction('pa', 'pick up all the things')
+PICK_UP_SOME = CallbackAction('ps', 'pick up some things')
+PICK_UP_MYSELF = CallbackAction('pm', 'pick it up myself')
+NEED_COURIER = CallbackAction('nc', 'need a courier for delivery')
+
+
+class CallbackRouter(Handler):
+    """Один обработчик вместо цепочки CallbackQueryHandler с регулярками.
+
+    Действие находится по коду из callback_data поиском в словаре, аргументы
+    разбираются один раз и передаются обработчику в context.args, само
+    действие - в context.callback_action. Старые callback_data без кода
+    ищутся по (legacy, число аргументов), отрезая аргументы с конца по "_".
+    """
+
+    def __init__(self):
+        super().__init__(self._call_route)
+        self.routes = {}
+        self._by_code = {}
+        self._by_legacy = {}
+        self._max_args = 0
+
+    def add(self, action, callback):
+        if action.code in self._by_code:
+            raise ValueError(f'Callback code {action.code!r} is already routed')
+        self._by_code[action.code] = action
+        self._by_legacy[action.legacy, len(action.arg_types)] = action
+        self._max_args = max(self._max_args, len(action.arg_types))
+        self.routes[action] = callback
+
+    def decode(self, data):
+        """Возвращает (действие, аргументы) или None, если данные не распознаны."""
+        try:
+            if SEPARATOR in data:
+                code, *args = data.split(SEPARATOR)
+                action = self._by_code.get(code)
+                return (action, action.unpack(args)) if action else None
+
+            action = self._by_code.get(data)
+            if action is None or action.arg_types:
+                action = self._by_legacy.get((data, 0))
+            if action:
+                return action, ()
+            for args_count in range(1, self._max_args + 1):
+                legacy, *args = data.rsplit('_', args_count)
+                action = self._by_legacy.get((legacy, len(args)))
+                if action:
+                    return action, action.unpack(args)
+        except ValueError:
+            return None
+        return None
+
+    def check_update(self, update):
+        if isinstance(update, Update) and update.callback_query and update.callback_query.data:
+            return self.decode(update.callback_query.data)
+        return None
+
+    def collect_additional_context(self, context, update, dispatcher, check_result):
+        context.callback_action, context.args = check_result
+
+    def _call_route(self, update, context):
+        return self.routes[context.callback_action](update, context)
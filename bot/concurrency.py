@@ -0,0 +1,106 @@
+import logging
+import queue
+import threading
+
+from django.db import close_old_connections, connections
+
+from bot.callbacks import CallbackRouter
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class ChatWorkerPool:
+    """Пул потоков для обработчиков бота с сохранением порядка внутри чата.
+
+    Апдейты одного чата всегда попадают в очередь одного и того же потока,
+    поэтому обрабатываются строго по очереди, а разные чаты не ждут друг друга.
+    Каждый поток держит своё соединение с БД и переиспользует его с учетом
+    CONN_MAX_AGE, как это делает Django между HTTP запросами.
+    """
+
+    def __init__(self, workers=4):
+        if workers < 1:
+            raise ValueError('workers must be positive')
+        self._queues = [queue.Queue() for _ in range(workers)]
+        self._threads = [
+            threading.Thread(target=self._run, args=(tasks,), name=f'chat-worker-{number}', daemon=True)
+            for number, tasks in enumerate(self._queues)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    @property
+    def workers(self):
+        return len(self._threads)
+
+    def submit(self, chat_id, func, *args):
+        self._queues[hash(chat_id) % len(self._queues)].put((func, args))
+
+    def _run(self, tasks):
+        try:
+            while True:
+                task = tasks.get()
+                if task is _STOP:
+                    break
+                func, args = task
+                close_old_connections()
+                try:
+                    func(*args)
+                except Exception:
+                    logger.exception('Unhandled error in %s', threading.current_thread().name)
+                finally:
+                    close_old_connections()
+                    tasks.task_done()
+        finally:
+            connections.close_all()
+
+    def join(self):
+        """Ждет, пока все поставленные задачи будут выполнены."""
+        for tasks in self._queues:
+            tasks.join()
+
+    def stop(self):
+        for tasks in self._queues:
+            tasks.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+
+
+def run_in_chat_worker(pool, callback):
+    def wrapper(update, context):
+        chat_id = update.effective_chat.id if update.effective_chat else None
+
+        def run():
+            try:
+                callback(update, context)
+            except Exception as error:
+                context.dispatcher.dispatch_error(update, error)
+            # диспетчер сохранил user_data до того, как обработчик отработал в пуле
+            if context.dispatcher.persistence:
+                context.dispatcher.update_persistence(update)
+
+        pool.submit(chat_id, run)
+
+    wrapper.__name__ = callback.__name__
+    wrapper.__wrapped__ = callback
+    return wrapper
+
+
+def wrap_handlers(dispatcher, wrap):
+    """Заменяет каждый обработчик диспетчера на wrap(callback, route), route - имя функции."""
+    for handlers in dispatcher.handlers.values():
+        for handler in handlers:
+            if isinstance(handler, CallbackRouter):
+                for action, callback in handler.routes.items():
+                    handler.routes[action] = wrap(callback, callback.__name__)
+            else:
+                handler.callback = wrap(handler.callback, handler.callback.__name__)
+
+
+def dispatch_by_chat(dispatcher, pool):
+    """Переводит все зарегистрированные обработчики на выполнение в пуле."""
+    for handlers in dispatcher.handlers.values():
+        for handler in handlers:
+            handler.callback = run_in_chat_worker(pool, handler.callback)
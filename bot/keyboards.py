@@ -0,0 +1,137 @@
+import json
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from bot import callbacks
+from bot.tariffs import RENT_PERIODS, VOLUME_RANGE, WEIGHT_RANGE
+
+
+class StaticInlineKeyboardMarkup(InlineKeyboardMarkup):
+    """Клавиатура, которая сериализуется один раз при создании.
+
+    Bot API получает reply_markup строкой JSON, поэтому для неизменяемых
+    меню to_json возвращает готовую строку вместо обхода всех кнопок.
+    """
+
+    def __init__(self, inline_keyboard, **kwargs):
+        super().__init__(inline_keyboard, **kwargs)
+        self._dict = super().to_dict()
+        self._json = json.dumps(self._dict)
+
+    def to_dict(self):
+        return self._dict
+
+    def to_json(self):
+        return self._json
+
+
+def build_keyboard(rows, markup_class=InlineKeyboardMarkup):
+    """Собирает клавиатуру из строк вида [(текст, callback_data), ...]."""
+    return markup_class([
+        [InlineKeyboardButton(text, callback_data=callback_data) for text, callback_data in row]
+        for row in rows
+    ])
+
+
+def build_static_keyboard(rows):
+    return build_keyboard(rows, StaticInlineKeyboardMarkup)
+
+
+TIME_ARRIVE_RANGES = ('9-13', '13-18', '18-22')
+
+TO_START_ROW = (('В начало', callbacks.START.pack()),)
+
+TO_START = build_static_keyboard([TO_START_ROW])
+
+OWNER_MENU = build_static_keyboard([
+    (('Промокоды', callbacks.OWNER_PROMOS.pack()),),
+    (('Просроченные боксы', callbacks.UNPAID_BOXES.pack()),),
+    (('Заявки на трансфер', callbacks.TRANSFERS.pack()),),
+    (('Источники клиентов', callbacks.UTM_SOURCES.pack()),),
+    (('Загрузка склада и выручка', callbacks.STORAGE_STATS.pack()),),
+])
+
+CLIENT_MENU = build_static_keyboard([
+    (('Список ваших боксов', callbacks.CLIENT_LISTBOXES.pack()),),
+    (('Купить еще один бокс', callbacks.CLIENT_BUY_BOX.pack()),),
+])
+
+NEW_CLIENT_MENU = build_static_keyboard([
+    (('Купить бокс', callbacks.CLIENT_BUY_BOX.pack()),),
+])
+
+BOX_ACTIONS = build_static_keyboard([
+    (('Заказать доставку вещей', callbacks.PICK_UP_ALL.pack()),),
+    (('Хочу забрать самостоятельно', callbacks.PICK_UP_MYSELF.pack()),),
+    (('Изменить описание', callbacks.CHANGE_DESCRIPTION.pack()),),
+])
+
+WEIGHTS = build_static_keyboard(
+    ((weight_k, callbacks.CLIENT_SET_WEIGHT.pack(weight_v)),) for weight_k, weight_v in WEIGHT_RANGE.items()
+)
+
+VOLUMES = build_static_keyboard(
+    ((volume_k, callbacks.CLIENT_SET_VOLUME.pack(volume_v)),) for volume_k, volume_v in VOLUME_RANGE.items()
+)
+
+_RENT_PERIOD_ROWS = [
+    ((period_k, callbacks.CLIENT_RENT_PERIOD.pack(period_v)),) for period_k, period_v in RENT_PERIODS.items()
+]
+
+RENT_PERIODS_MENU = build_static_keyboard(_RENT_PERIOD_ROWS)
+
+RENT_PERIODS_WITH_PROMO = build_static_keyboard(
+    _RENT_PERIOD_ROWS + [(('У меня есть промокод', callbacks.CLIENT_ASK_PROMO.pack()),)]
+)
+
+# клиенту без телефона сначала нужно его спросить
+PICKUP_WAYS_ASK_PHONE = build_static_keyboard([
+    (('Нужно забрать вещи по адресу', callbacks.CLIENT_ASK_PHONE.pack()),),
+    (('Доставлю свои вещи сам', callbacks.CLIENT_SELF_TRANSFER.pack()),),
+])
+
+PICKUP_WAYS_ASK_ADDRESS = build_static_keyboard([
+    (('Нужно забрать вещи по адресу', callbacks.CLIENT_ASK_ADDRESS.pack()),),
+    (('Доставлю свои вещи сам', callbacks.CLIENT_SELF_TRANSFER.pack()),),
+])
+
+TIME_ARRIVE = build_static_keyboard(
+    ((time_arrive, callbacks.CLIENT_TIME_ARRIVE.pack(time_arrive)),) for time_arrive in TIME_ARRIVE_RANGES
+)
+
+CONSENT_PICKUP = build_static_keyboard([
+    (('Согласен на обработку перс.данных', callbacks.CLIENT_SAVE_TRANSFER.pack()),),
+])
+
+CONSENT_DELIVERY = build_static_keyboard([
+    (('Согласен на обработку перс.данных', callbacks.CLIENT_SAVE_DELIVERY_TRANSFER.pack()),),
+])
+
+
+def build_box_list_keyboard(boxes, button_texts):
+    rows = [((text, callbacks.CLIENT_SHOW_BOX.pack(box.id)),) for box, text in zip(boxes, button_texts)]
+    rows.append(TO_START_ROW)
+    return build_keyboard(rows)
+
+
+def build_transfers_keyboard(page, has_prev, has_next):
+    rows = [
+        ((f'Бокс № {transfer.box_id}, {transfer.get_transfer_type_display()}',
+          callbacks.TRANSFER_BOX.pack(transfer.id)),)
+        for transfer in page
+    ]
+    navigation = []
+    if page and has_prev:
+        navigation.append(('Назад', callbacks.TRANSFERS_PAGE.pack('before', page[0].id)))
+    if page and has_next:
+        navigation.append(('Дальше', callbacks.TRANSFERS_PAGE.pack('after', page[-1].id)))
+    if navigation:
+        rows.append(navigation)
+    rows.append(TO_START_ROW)
+    return build_keyboard(rows)
+
+
+def build_transfer_keyboard(transfer_id):
+    return build_keyboard([
+        (('Пометить трансфер как выполненный', callbacks.TRANSFER_COMPLETE.pack(transfer_id)),),
+    ])
@@ -0,0 +1,209 @@
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+
+from django.db import connection
+
+from bot import routes
+from bot.concurrency import wrap_handlers
+from self_storage import slow_queries
+
+logger = logging.getLogger(__name__)
+
+# границы корзин гистограммы времени обработчика, секунды
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# вызовы Bot API вне обработчиков: напоминания, сообщения Outbox без обработчика
+BACKGROUND_ROUTE = 'background'
+
+METRICS = {
+    'bot_handler_seconds': ('histogram', 'Time spent in a bot handler'),
+    'bot_handler_errors_total': ('counter', 'Exceptions raised by a bot handler'),
+    'bot_handler_db_queries_total': ('counter', 'Database queries made by a bot handler'),
+    'bot_handler_db_seconds_total': ('counter', 'Time spent in database queries by a bot handler'),
+    'bot_telegram_requests_total': ('counter', 'Bot API requests'),
+    'bot_telegram_seconds_total': ('counter', 'Time spent in Bot API requests'),
+}
+
+
+class Registry:
+    """Счетчики и гистограммы процесса, ключ - (имя, метки).
+
+    Все обновления идут под одной блокировкой: на апдейт бота их несколько,
+    это микросекунды против миллисекунд самого обработчика.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)
+        # значения гистограммы: счетчики корзин, затем сумма и количество
+        self._histograms = defaultdict(lambda: [0] * (len(LATENCY_BUCKETS) + 1) + [0.0, 0])
+
+    def inc(self, name, labels, value=1):
+        with self._lock:
+            self._counters[name, labels] += value
+
+    def observe(self, name, labels, value):
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, value)
+        with self._lock:
+            histogram = self._histograms[name, labels]
+            histogram[bucket] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def snapshot(self):
+        """Текущие значения в JSON-совместимом виде."""
+        with self._lock:
+            return {
+                'counters': [[name, list(labels), value] for (name, labels), value in self._counters.items()],
+                'histograms': [
+                    [name, list(labels), list(values)] for (name, labels), values in self._histograms.items()
+                ],
+            }
+
+
+registry = Registry()
+_current = threading.local()
+
+
+def format_labels(labels):
+    escaped = (
+        (key, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for key, value in labels
+    )
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+def render(snapshots):
+    """Текст в формате Prometheus из снимков нескольких процессов.
+
+    snapshots - словарь {имя процесса: снимок}, имя попадает в метку process.
+    """
+    samples = defaultdict(list)
+    for process, snapshot in sorted(snapshots.items()):
+        for name, labels, value in snapshot['counters']:
+            samples[name].append(((('process', process), *map(tuple, labels)), value))
+        for name, labels, values in snapshot['histograms']:
+            samples[name].append(((('process', process), *map(tuple, labels)), values))
+
+    lines = []
+    for name, (metric_type, description) in METRICS.items():
+        if name not in samples:
+            continue
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        for labels, value in sorted(samples[name]):
+            if metric_type != 'histogram':
+                lines.append(f'{name}{format_labels(labels)} {value}')
+                continue
+            cumulative = 0
+            for bound, count in zip((*LATENCY_BUCKETS, '+Inf'), value):
+                cumulative += count
+                lines.append(f'{name}_bucket{format_labels((*labels, ("le", bound)))} {cumulative}')
+            lines.append(f'{name}_sum{format_labels(labels)} {value[-2]}')
+            lines.append(f'{name}_count{format_labels(labels)} {value[-1]}')
+    return '\n'.join(lines) + '\n'
+
+
+def read_snapshot(filename):
+    try:
+        with open(filename) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def write_snapshot(filename):
+    """Пишет снимок registry атомарно: читатель не увидит половину файла."""
+    temporary = f'{filename}.tmp'
+    with open(temporary, 'w') as file:
+        json.dump(registry.snapshot(), file, separators=(',', ':'))
+    os.replace(temporary, filename)
+
+
+class SnapshotWriter(threading.Thread):
+    """Раз в interval секунд сохраняет метрики процесса бота для страницы /metrics Django."""
+
+    def __init__(self, filename, interval=15.0):
+        super().__init__(name='metrics-writer', daemon=True)
+        self.filename = str(filename)
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                write_snapshot(self.filename)
+            except OSError:
+                logger.exception('Failed to write bot metrics')
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        write_snapshot(self.filename)
+
+
+def count_queries(execute, sql, params, many, context):
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        _current.db_seconds += time.perf_counter() - started
+        _current.db_queries += 1
+
+
+def instrument_callback(callback, route):
+    """Оборачивает обработчик: время, запросы к БД и исключения с меткой route."""
+    labels = (('route', route),)
+
+    def wrapper(update, context):
+        _current.db_queries = 0
+        _current.db_seconds = 0.0
+        started = time.perf_counter()
+        try:
+            with routes.handling(route), connection.execute_wrapper(count_queries), slow_queries.origin(route):
+                return callback(update, context)
+        except Exception as error:
+            registry.inc('bot_handler_errors_total', (*labels, ('error', type(error).__name__)))
+            raise
+        finally:
+            registry.observe('bot_handler_seconds', labels, time.perf_counter() - started)
+            registry.inc('bot_handler_db_queries_total', labels, _current.db_queries)
+            registry.inc('bot_handler_db_seconds_total', labels, _current.db_seconds)
+
+    wrapper.__name__ = callback.__name__
+    wrapper.__wrapped__ = callback
+    return wrapper
+
+
+def instrument_request(request):
+    """Считает время запросов к Bot API по методу и обработчику, который их сделал.
+
+    Для сообщений из Outbox это обработчик, который поставил их в очередь.
+    """
+    post = request.post
+
+    def timed_post(url, data=None, timeout=None):
+        started = time.perf_counter()
+        try:
+            return post(url, data, timeout)
+        finally:
+            labels = (('route', routes.get_route() or BACKGROUND_ROUTE),
+                      ('method', url.rsplit('/', 1)[-1]))
+            registry.inc('bot_telegram_requests_total', labels)
+            registry.inc('bot_telegram_seconds_total', labels, time.perf_counter() - started)
+
+    request.post = timed_post
+
+
+def instrument_dispatcher(dispatcher):
+    """Метрики для всех обработчиков диспетчера.
+
+    Вызывать до dispatch_by_chat, чтобы время считалось в потоке пула,
+    без ожидания в очереди чата.
+    """
+    wrap_handlers(dispatcher, instrument_callback)
+    instrument_request(dispatcher.bot.request)
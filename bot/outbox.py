@@ -0,0 +1,310 @@
+import io
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram.constants import MAX_MESSAGE_LENGTH
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError, Unauthorized
+
+from bot import routes
+
+logger = logging.getLogger(__name__)
+
+# лимиты Bot API: ~30 сообщений в секунду всего и ~1 в секунду в один чат
+GLOBAL_RATE = 30
+CHAT_INTERVAL = 1.0
+MAX_ATTEMPTS = 8
+MAX_BACKOFF = 300
+# за проход читается не больше FETCH_LIMIT чатов и COALESCE_ROWS сообщений каждого
+FETCH_LIMIT = 500
+COALESCE_ROWS = 20
+SENDER_THREADS = 4
+
+
+class RateLimiter:
+    """Token bucket: не больше rate вызовов в секунду с запасом burst."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens < 1:
+                delay = (1 - self._tokens) / self.rate
+                time.sleep(delay)
+                self._updated = time.monotonic()
+                self._tokens = 0
+            else:
+                self._tokens -= 1
+
+
+class Outbox:
+    """Очередь исходящих сообщений в локальной таблице SQLite.
+
+    Обработчик только записывает сообщение в таблицу и сразу возвращается,
+    отправляет их OutboxSender. Строка удаляется после успешной отправки,
+    поэтому падение процесса не теряет ответы клиентам.
+    """
+
+    def __init__(self, filename):
+        self.filename = str(filename)
+        self.wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.filename, timeout=10, check_same_thread=False)
+        with self._connection:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS bot_outbox ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                'chat_id INTEGER NOT NULL, '
+                'method TEXT NOT NULL, '
+                'payload TEXT NOT NULL, '
+                'document BLOB, '
+                'attempts INTEGER NOT NULL DEFAULT 0, '
+                'next_attempt REAL NOT NULL DEFAULT 0, '
+                'route TEXT)'
+            )
+            columns = {row[1] for row in self._connection.execute('PRAGMA table_info(bot_outbox)')}
+            if 'route' not in columns:
+                # очередь, созданная до появления колонки route
+                self._connection.execute('ALTER TABLE bot_outbox ADD COLUMN route TEXT')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS bot_outbox_chat_idx ON bot_outbox (chat_id, id)')
+
+    def enqueue(self, chat_id, method, payload, document=None, route=None):
+        """route - обработчик, от имени которого OutboxSender потом отправит сообщение."""
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT INTO bot_outbox (chat_id, method, payload, document, route) VALUES (?, ?, ?, ?, ?)',
+                (chat_id, method, json.dumps(payload, ensure_ascii=False), document, route),
+            )
+        self.wakeup.set()
+
+    def fetch(self, limit=FETCH_LIMIT, rows_per_chat=COALESCE_ROWS, now=None):
+        """Первые сообщения чатов, у которых первое в очереди пора отправлять.
+
+        Чаты берутся по порядку их первого сообщения, поэтому длинная очередь
+        одного чата занимает одно место из limit и не задерживает остальные.
+        """
+        with self._lock:
+            return self._connection.execute(
+                'WITH heads AS ('
+                '  SELECT head.chat_id, head.id FROM bot_outbox AS head'
+                '  WHERE head.id IN (SELECT MIN(id) FROM bot_outbox GROUP BY chat_id) AND head.next_attempt <= ?'
+                '  ORDER BY head.id LIMIT ?'
+                ') '
+                'SELECT id, chat_id, method, payload, document, attempts, next_attempt, route FROM ('
+                '  SELECT message.*, ROW_NUMBER() OVER (PARTITION BY message.chat_id ORDER BY message.id) AS position'
+                '  FROM bot_outbox AS message JOIN heads ON message.chat_id = heads.chat_id'
+                ') WHERE position <= ? ORDER BY id',
+                (time.time() if now is None else now, limit, rows_per_chat),
+            ).fetchall()
+
+    def delete(self, ids):
+        with self._lock, self._connection:
+            self._connection.executemany('DELETE FROM bot_outbox WHERE id = ?', [(id_,) for id_ in ids])
+
+    def reschedule(self, id_, attempts, next_attempt):
+        with self._lock, self._connection:
+            self._connection.execute(
+                'UPDATE bot_outbox SET attempts = ?, next_attempt = ? WHERE id = ?',
+                (attempts, next_attempt, id_),
+            )
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM bot_outbox').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def coalesce(rows, limit=MAX_MESSAGE_LENGTH):
+    """Склеивает подряд идущие текстовые сообщения одного чата в одно.
+
+    Кнопки есть только у последнего сообщения пачки, поэтому склеиваются
+    сообщения без reply_markup и одно завершающее с ним.
+    Возвращает (ids, method, payload, document).
+    """
+    id_, _, method, payload, document, *_ = rows[0]
+    payload = json.loads(payload)
+    ids = [id_]
+    if method != 'send_message':
+        return ids, method, payload, document
+
+    for id_, _, next_method, next_payload, _, attempts, *_ in rows[1:]:
+        if next_method != 'send_message' or 'reply_markup' in payload or attempts:
+            break
+        next_payload = json.loads(next_payload)
+        text = f"{payload['text']}\n\n{next_payload['text']}"
+        if len(text) > limit:
+            break
+        payload = {**next_payload, 'text': text}
+        ids.append(id_)
+    return ids, method, payload, None
+
+
+class OutboxSender(threading.Thread):
+    """Фоновый поток, который вычитывает Outbox и отправляет сообщения через Bot API.
+
+    Разные чаты отправляются параллельно в threads потоков, но за проход
+    в каждый чат уходит не больше одного запроса, так что порядок внутри
+    чата сохраняется.
+    """
+
+    def __init__(self, outbox, bot, global_rate=GLOBAL_RATE, chat_interval=CHAT_INTERVAL,
+                 threads=SENDER_THREADS):
+        super().__init__(name='outbox-sender', daemon=True)
+        self.outbox = outbox
+        self.bot = bot
+        self.chat_interval = chat_interval
+        self.limiter = RateLimiter(global_rate)
+        self.sent = 0
+        self.coalesced = 0
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='outbox-send')
+        self._stats_lock = threading.Lock()
+        self._chat_ready_at = {}
+        self._paused_till = 0
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                delay = self.send_due()
+            except Exception:
+                logger.exception('Outbox sender pass failed')
+                delay = 1
+            self.outbox.wakeup.wait(delay)
+            self.outbox.wakeup.clear()
+
+    def send_due(self):
+        """Отправляет все, что можно отправить сейчас, и возвращает паузу до следующего прохода."""
+        now = time.monotonic()
+        if self._paused_till > now:
+            return self._paused_till - now
+
+        rows = self.outbox.fetch()
+        if not rows:
+            self._chat_ready_at.clear()
+            return 1
+
+        by_chat = OrderedDict()
+        for row in rows:
+            by_chat.setdefault(row[1], []).append(row)
+
+        wall_now = time.time()
+        next_wakeup = 1
+        ready = []
+        for chat_id, chat_rows in by_chat.items():
+            next_attempt = chat_rows[0][6]
+            ready_at = self._chat_ready_at.get(chat_id, 0)
+            wait = max(ready_at - now, next_attempt - wall_now)
+            if wait > 0:
+                next_wakeup = min(next_wakeup, wait)
+                continue
+            ready.append((chat_id, chat_rows))
+
+        # list() дожидается всех отправок прохода, ошибки пробрасываются сюда
+        list(self._executor.map(lambda item: self._send(*item), ready))
+        if ready:
+            return 0
+        return max(next_wakeup, 0.01)
+
+    def _send(self, chat_id, chat_rows):
+        ids, method, payload, document = coalesce(chat_rows)
+        attempts = chat_rows[0][5]
+        if document is not None:
+            payload['document'] = io.BytesIO(document)
+            payload['document'].name = payload.pop('filename', 'document')
+
+        if self._paused_till > time.monotonic():
+            return
+        self.limiter.acquire()
+        try:
+            # склеенные сообщения считаются в метриках за обработчиком первого
+            with routes.handling(chat_rows[0][7]):
+                getattr(self.bot, method)(chat_id=chat_id, **payload)
+        except RetryAfter as error:
+            self._paused_till = time.monotonic() + error.retry_after
+            return
+        except (BadRequest, Unauthorized):
+            # повторять бессмысленно: чат удален, бот заблокирован или неверный запрос
+            logger.exception('Dropping outbox messages %s for chat %s', ids, chat_id)
+            self.outbox.delete(ids)
+            return
+        except NetworkError:
+            self._retry_later(ids, chat_id, attempts)
+            return
+        except TelegramError:
+            logger.exception('Dropping outbox messages %s for chat %s', ids, chat_id)
+            self.outbox.delete(ids)
+            return
+        except Exception:
+            self._retry_later(ids, chat_id, attempts)
+            return
+
+        self.outbox.delete(ids)
+        with self._stats_lock:
+            self.sent += 1
+            self.coalesced += len(ids) - 1
+        self._chat_ready_at[chat_id] = time.monotonic() + self.chat_interval
+
+    def _retry_later(self, ids, chat_id, attempts):
+        attempts += 1
+        if attempts >= MAX_ATTEMPTS:
+            logger.exception('Giving up on outbox messages %s for chat %s', ids, chat_id)
+            self.outbox.delete(ids)
+            return
+        backoff = min(2 ** attempts, MAX_BACKOFF)
+        self.outbox.reschedule(ids[0], attempts, time.time() + backoff)
+
+    def stop(self):
+        self._stopped.set()
+        self.outbox.wakeup.set()
+        self.join()
+        self._executor.shutdown()
+
+
+_outbox = None
+
+
+def configure_outbox(filename):
+    global _outbox
+    _outbox = Outbox(filename)
+    return _outbox
+
+
+def get_outbox():
+    return _outbox
+
+
+def send_message(bot, chat_id, text, reply_markup=None):
+    """Отправляет сообщение через Outbox, а если он не настроен - сразу."""
+    if _outbox is None:
+        return bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
+    payload = {'text': text}
+    if reply_markup is not None:
+        payload['reply_markup'] = reply_markup.to_json()
+    _outbox.enqueue(chat_id, 'send_message', payload, route=routes.get_route())
+
+
+def send_document(bot, chat_id, document, caption=None, reply_markup=None):
+    if _outbox is None:
+        return bot.send_document(chat_id=chat_id, document=document, caption=caption,
+                                 reply_markup=reply_markup)
+    payload = {'caption': caption, 'filename': getattr(document, 'name', 'document')}
+    if reply_markup is not None:
+        payload['reply_markup'] = reply_markup.to_json()
+    _outbox.enqueue(chat_id, 'send_document', payload, document=document.getvalue(), route=routes.get_route())
@@ -0,0 +1,248 @@
+import cProfile
+import itertools
+import json
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+from bot.concurrency import wrap_handlers
+from self_storage.slow_queries import slow_query_log
+
+logger = logging.getLogger(__name__)
+
+# профилируется каждый N-й апдейт
+PROFILE_SAMPLE_EVERY = 10
+# как часто снимаются стеки потоков, которые обрабатывают выбранный апдейт
+STACK_SAMPLE_INTERVAL = 0.005
+# как часто снимается tracemalloc и считается размер user_data
+MEMORY_SNAPSHOT_INTERVAL = 60.0
+TRACEMALLOC_FRAMES = 10
+TOP_LINES = 30
+# размер user_data за последние снимки, для отчета хватает последних часов
+MEMORY_HISTORY = 120
+
+
+def user_data_summary(user_data, top=10):
+    """Число пользователей, общий размер user_data в байтах JSON и самые большие записи."""
+    sizes = []
+    for user_id, data in list(user_data.items()):
+        try:
+            size = len(json.dumps(data, default=repr, ensure_ascii=False))
+        except (RuntimeError, ValueError):
+            # обработчик изменил словарь во время подсчета
+            continue
+        sizes.append((size, user_id, len(data)))
+    sizes.sort(reverse=True)
+    return {
+        'users': len(sizes),
+        'bytes': sum(size for size, _, _ in sizes),
+        'largest': [{'user_id': user_id, 'bytes': size, 'keys': keys} for size, user_id, keys in sizes[:top]],
+    }
+
+
+class Profiler:
+    """Профилирование работающего бота, включается без перезапуска.
+
+    Пока профилирование включено, каждый sample_every-й апдейт выполняется
+    под cProfile, статистика копится по обработчикам. Параллельно поток
+    снимает стеки этих апдейтов в формате collapsed stacks (flamegraph.pl,
+    speedscope), а другой поток раз в memory_interval секунд сравнивает
+    tracemalloc с моментом включения и запоминает размер user_data.
+    """
+
+    def __init__(self, sample_every=PROFILE_SAMPLE_EVERY, memory_interval=MEMORY_SNAPSHOT_INTERVAL):
+        self.sample_every = sample_every
+        self.memory_interval = memory_interval
+        self.enabled = False
+        self.user_data = {}
+        self._updates = itertools.count()
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._samples = Counter()
+        self._stacks = Counter()
+        self._running = {}
+        self._memory_baseline = None
+        self._memory_top = []
+        self._memory_history = []
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def start(self, sample_every=None):
+        with self._lock:
+            if self.enabled:
+                return
+            if sample_every:
+                self.sample_every = sample_every
+            self._stats = {}
+            self._samples.clear()
+            self._stacks.clear()
+            self._memory_top = []
+            self._memory_history = []
+            self._stopped.clear()
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self._memory_baseline = tracemalloc.take_snapshot()
+            self._threads = [
+                threading.Thread(target=self._sample_stacks, name='profiler-stacks', daemon=True),
+                threading.Thread(target=self._snapshot_memory, name='profiler-memory', daemon=True),
+            ]
+            for thread in self._threads:
+                thread.start()
+            self.enabled = True
+        logger.info('Profiling started, every %s update', self.sample_every)
+
+    def stop(self):
+        with self._lock:
+            if not self.enabled:
+                return
+            self.enabled = False
+            self._stopped.set()
+        for thread in self._threads:
+            thread.join()
+        with self._lock:
+            self._take_memory_snapshot()
+            tracemalloc.stop()
+            self._memory_baseline = None
+        logger.info('Profiling stopped')
+
+    def toggle(self, directory):
+        """Включает профилирование или выключает его с сохранением отчета, для сигнала."""
+        if not self.enabled:
+            self.start()
+            return None
+        self.stop()
+        return self.dump(directory)
+
+    def run(self, route, callback, update, context):
+        if not self.enabled or next(self._updates) % self.sample_every:
+            return callback(update, context)
+
+        thread_id = threading.get_ident()
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+: в процессе уже работает другой профилировщик
+            logger.warning('Another profiler is active, %s runs without profiling', route)
+            return callback(update, context)
+        try:
+            self._running[thread_id] = route
+            return callback(update, context)
+        finally:
+            profile.disable()
+            self._running.pop(thread_id, None)
+            with self._lock:
+                if route in self._stats:
+                    self._stats[route].add(profile)
+                else:
+                    self._stats[route] = pstats.Stats(profile)
+                self._samples[route] += 1
+
+    def status(self):
+        with self._lock:
+            lines = [f'Профилирование {"включено" if self.enabled else "выключено"}, '
+                     f'каждый {self.sample_every}-й апдейт']
+            lines += [f'{route}: {count}' for route, count in self._samples.most_common()]
+            if self._memory_history:
+                _, traced, user_data = self._memory_history[-1]
+                lines.append(f'Память: {traced // 1024} КБ с включения, user_data: '
+                             f'{user_data["users"]} польз., {user_data["bytes"] // 1024} КБ')
+        return '\n'.join(lines)
+
+    def dump(self, directory):
+        """Сохраняет отчеты в новую папку внутри directory и возвращает ее путь.
+
+        <route>.prof - pstats для snakeviz или pstats.Stats, <route>.txt -
+        самые тяжелые функции, stacks.txt - collapsed stacks всех
+        обработчиков, memory.txt - рост памяти и размер user_data,
+        slow_queries.txt - самые затратные запросы к БД.
+        """
+        path = os.path.join(directory, time.strftime('%Y%m%d-%H%M%S'))
+        os.makedirs(path, exist_ok=True)
+        with self._lock:
+            for route, stats in self._stats.items():
+                stats.dump_stats(os.path.join(path, f'{route}.prof'))
+                with open(os.path.join(path, f'{route}.txt'), 'w') as file:
+                    stats.stream = file
+                    print(f'{route}: {self._samples[route]} updates', file=file)
+                    stats.sort_stats('cumulative').print_stats(TOP_LINES)
+                    stats.stream = sys.stdout
+            with open(os.path.join(path, 'stacks.txt'), 'w') as file:
+                for stack, count in self._stacks.most_common():
+                    file.write(f'{stack} {count}\n')
+            if self.enabled:
+                self._take_memory_snapshot()
+            with open(os.path.join(path, 'memory.txt'), 'w') as file:
+                file.write('time\ttraced_kb\tuser_data_users\tuser_data_kb\n')
+                for taken_at, traced, user_data in self._memory_history:
+                    file.write(f'{time.strftime("%H:%M:%S", time.localtime(taken_at))}\t{traced // 1024}\t'
+                               f'{user_data["users"]}\t{user_data["bytes"] // 1024}\n')
+                if self._memory_history:
+                    file.write('\nLargest user_data:\n')
+                    for entry in self._memory_history[-1][2]['largest']:
+                        file.write(f'{entry["user_id"]}\t{entry["bytes"]} bytes\t{entry["keys"]} keys\n')
+                file.write('\nGrowth since profiling started:\n')
+                file.writelines(f'{line}\n' for line in self._memory_top)
+        with open(os.path.join(path, 'slow_queries.txt'), 'w') as file:
+            file.write(slow_query_log.format_top(slow_query_log.top()) + '\n')
+        logger.info('Profile saved to %s', path)
+        return path
+
+    def _sample_stacks(self):
+        # стек обрезается на run: кадры диспетчера одинаковы для всех апдейтов
+        stop_code = self.run.__func__.__code__
+        while not self._stopped.wait(STACK_SAMPLE_INTERVAL):
+            if not self._running:
+                continue
+            frames = sys._current_frames()
+            for thread_id, route in list(self._running.items()):
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None and frame.f_code is not stop_code:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                if stack:
+                    with self._lock:
+                        self._stacks[';'.join((route, *reversed(stack)))] += 1
+
+    def _snapshot_memory(self):
+        while not self._stopped.wait(self.memory_interval):
+            with self._lock:
+                self._take_memory_snapshot()
+
+    def _take_memory_snapshot(self):
+        # память самого профилировщика в отчет не попадает
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, cProfile.__file__),
+            tracemalloc.Filter(False, pstats.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
+        growth = snapshot.compare_to(self._memory_baseline, 'lineno')
+        self._memory_top = [str(stat) for stat in growth[:TOP_LINES]]
+        traced = sum(stat.size_diff for stat in growth)
+        self._memory_history.append((time.time(), traced, user_data_summary(self.user_data)))
+        del self._memory_history[:-MEMORY_HISTORY]
+
+
+profiler = Profiler()
+
+
+def profile_callback(callback, route):
+    def wrapper(update, context):
+        return profiler.run(route, callback, update, context)
+
+    wrapper.__name__ = callback.__name__
+    wrapper.__wrapped__ = callback
+    return wrapper
+
+
+def instrument_dispatcher(dispatcher):
+    """Профилирование всех обработчиков диспетчера, пока оно выключено - одна проверка флага."""
+    profiler.user_data = dispatcher.user_data
+    wrap_handlers(dispatcher, profile_callback)
@@ -0,0 +1,86 @@
+import io
+import queue
+import random
+import string
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import qrcode
+from qrcode.constants import ERROR_CORRECT_M
+
+CODE_ALPHABET = string.digits[1:] + string.ascii_letters
+CODE_LENGTH = 12
+
+
+def get_random_code(length=CODE_LENGTH):
+    return ''.join(random.choices(CODE_ALPHABET, k=length))
+
+
+def render_qr_code(code):
+    """Рендерит QR код в PNG с 1-битной палитрой и возвращает байты."""
+    qr = qrcode.QRCode(error_correction=ERROR_CORRECT_M, box_size=8, border=4)
+    qr.add_data(code)
+    qr.make(fit=True)
+    # PilImage из qrcode уже в режиме '1', optimize ужимает IDAT
+    img = qr.make_image()
+    buffer = io.BytesIO()
+    img.save(buffer, optimize=True)
+    return buffer.getvalue()
+
+
+class QRCodePool:
+    """Ограниченный пул заранее отрендеренных QR кодов.
+
+    Коды рендерятся в фоновых потоках, обработчик только забирает готовый
+    PNG из очереди. Если пул опустел, код рендерится прямо в обработчике.
+    """
+
+    def __init__(self, size=32, workers=2):
+        self.size = size
+        self._codes = queue.Queue(maxsize=size)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='qr-pool')
+        for _ in range(size):
+            self._executor.submit(self._fill)
+
+    def _fill(self):
+        code = get_random_code()
+        try:
+            self._codes.put_nowait((code, render_qr_code(code)))
+        except queue.Full:
+            pass
+
+    def get(self):
+        """Возвращает пару (код, PNG байты) и заказывает рендер замены."""
+        try:
+            code, png = self._codes.get_nowait()
+        except queue.Empty:
+            code = get_random_code()
+            png = render_qr_code(code)
+        self._executor.submit(self._fill)
+        return code, png
+
+    def qsize(self):
+        return self._codes.qsize()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = QRCodePool()
+    return _pool
+
+
+def get_qr_document(filename='qr.png'):
+    """Возвращает код и файлоподобный объект с PNG для send_document."""
+    code, png = get_pool().get()
+    document = io.BytesIO(png)
+    document.name = filename
+    return code, document
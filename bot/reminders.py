@@ -0,0 +1,129 @@
+import heapq
+import logging
+import threading
+from datetime import timedelta
+
+from django.db import close_old_connections, connections
+from django.utils import timezone
+
+from bot.outbox import send_message
+from bot.rendering import render
+from storage.models import Box
+
+logger = logging.getLogger(__name__)
+
+REMINDER_LEAD = timedelta(days=3)
+# на сколько вперед напоминания держатся в памяти
+REMINDER_HORIZON = timedelta(hours=6)
+REFRESH_INTERVAL = 60
+# запас на транзакции, которые выставили updated_at раньше, а закоммитились позже обновления
+CHANGES_OVERLAP = timedelta(minutes=1)
+
+
+class ReminderScheduler(threading.Thread):
+    """Напоминает клиентам об окончании оплаченного срока бокса.
+
+    В куче лежат только напоминания ближайшего horizon, их выбирает запрос
+    по индексу paid_till. Обновление инкрементальное: окно по paid_till
+    сдвигается вперед от водяного знака, а в уже пройденной части окна
+    читаются только боксы, созданные или измененные (updated_at) после
+    прошлого обновления. Перед отправкой paid_till перечитывается, чтобы
+    не напоминать о продленной аренде.
+    """
+
+    def __init__(self, bot, lead=REMINDER_LEAD, horizon=REMINDER_HORIZON,
+                 refresh_interval=REFRESH_INTERVAL):
+        super().__init__(name='box-reminders', daemon=True)
+        self.bot = bot
+        self.lead = lead
+        self.horizon = horizon
+        self.refresh_interval = refresh_interval
+        self.sent = 0
+        self._heap = []
+        self._scheduled = {}
+        # box_id -> paid_till, о котором уже напомнили
+        self._reminded = {}
+        self._paid_till_watermark = None
+        self._changed_since = None
+        self._stopped = threading.Event()
+
+    def _schedule(self, box_id, paid_till, chat_id):
+        if self._scheduled.get(box_id) == paid_till or self._reminded.get(box_id) == paid_till:
+            return
+        self._scheduled[box_id] = paid_till
+        heapq.heappush(self._heap, (paid_till - self.lead, box_id, paid_till, chat_id))
+
+    def _load(self, boxes):
+        rows = boxes.values_list('id', 'paid_till', 'user__chat_id').order_by()
+        for box_id, paid_till, chat_id in rows.iterator(chunk_size=2000):
+            self._schedule(box_id, paid_till, chat_id)
+
+    def refresh(self, now=None):
+        now = now or timezone.now()
+        window_end = now + self.lead + self.horizon
+
+        if self._paid_till_watermark is None:
+            # при старте пропущенные за время простоя напоминания не догоняем
+            self._paid_till_watermark = now + self.lead
+        else:
+            self._load(Box.objects.filter(
+                updated_at__gt=self._changed_since,
+                paid_till__gt=now,
+                paid_till__lte=self._paid_till_watermark,
+            ))
+        self._changed_since = now - CHANGES_OVERLAP
+
+        if window_end > self._paid_till_watermark:
+            self._load(Box.objects.filter(
+                paid_till__gt=self._paid_till_watermark,
+                paid_till__lte=window_end,
+            ))
+            self._paid_till_watermark = window_end
+        self._reminded = {box_id: paid_till for box_id, paid_till in self._reminded.items() if paid_till > now}
+
+    def fire_due(self, now=None):
+        now = now or timezone.now()
+        while self._heap and self._heap[0][0] <= now:
+            _, box_id, paid_till, chat_id = heapq.heappop(self._heap)
+            if self._scheduled.get(box_id) != paid_till:
+                continue
+            del self._scheduled[box_id]
+
+            current_paid_till = Box.objects.filter(pk=box_id).values_list('paid_till', flat=True).first()
+            if current_paid_till != paid_till:
+                # аренду продлили, напомним о новом сроке, если он уже в окне
+                if current_paid_till and now < current_paid_till <= self._paid_till_watermark:
+                    self._schedule(box_id, current_paid_till, chat_id)
+                continue
+
+            reply_text = render('box_expiry_reminder', {'box': {'id': box_id, 'paid_till': paid_till}})
+            send_message(self.bot, chat_id=chat_id, text=reply_text)
+            self._reminded[box_id] = paid_till
+            self.sent += 1
+
+    def seconds_until_next(self, now=None):
+        now = now or timezone.now()
+        if not self._heap:
+            return self.refresh_interval
+        delay = (self._heap[0][0] - now).total_seconds()
+        return max(0, min(delay, self.refresh_interval))
+
+    def run(self):
+        next_refresh = timezone.now()
+        try:
+            while not self._stopped.is_set():
+                close_old_connections()
+                try:
+                    if timezone.now() >= next_refresh:
+                        self.refresh()
+                        next_refresh = timezone.now() + timedelta(seconds=self.refresh_interval)
+                    self.fire_due()
+                except Exception:
+                    logger.exception('Box reminders failed')
+                self._stopped.wait(self.seconds_until_next())
+        finally:
+            connections.close_all()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
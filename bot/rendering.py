@@ -0,0 +1,74 @@
+from pathlib import Path
+
+from django.template import engines
+
+# разделитель для render_each, в шаблонах он встретиться не может
+ITEM_SEPARATOR = '\x00'
+
+_templates = {}
+_list_templates = {}
+_static_pages = {}
+
+
+def load_templates():
+    """Компилирует все шаблоны из каталогов TEMPLATES['DIRS'] один раз."""
+    engine = engines['django']
+    for directory in engine.dirs:
+        for template_path in sorted(Path(directory).glob('*.html')):
+            _templates[template_path.stem] = engine.get_template(template_path.name)
+    return _templates
+
+
+def get_compiled_template(template_name):
+    template = _templates.get(template_name)
+    if template is None:
+        template = engines['django'].get_template(f'{template_name}.html')
+        _templates[template_name] = template
+    return template
+
+
+def render(template_name, template_context):
+    return get_compiled_template(template_name).render(template_context)
+
+
+def _get_list_template(template_name, item_name):
+    key = (template_name, item_name)
+    template = _list_templates.get(key)
+    if template is None:
+        get_compiled_template(template_name)
+        source = (
+            '{% for item in items %}'
+            f"{{% include '{template_name}.html' with {item_name}=item %}}"
+            '{% if not forloop.last %}{{ separator|safe }}{% endif %}'
+            '{% endfor %}'
+        )
+        template = engines['django'].from_string(source)
+        _list_templates[key] = template
+    return template
+
+
+def render_many(template_name, items, item_name, separator='\n'):
+    """Рендерит шаблон для каждого элемента за один проход и склеивает результат."""
+    template = _get_list_template(template_name, item_name)
+    return template.render({'items': items, 'separator': separator})
+
+
+def render_each(template_name, items, item_name):
+    """Как render_many, но возвращает список строк, по одной на элемент."""
+    items = list(items)
+    if not items:
+        return []
+    return render_many(template_name, items, item_name, separator=ITEM_SEPARATOR).split(ITEM_SEPARATOR)
+
+
+def render_static(template_name, template_context=None):
+    """Рендерит страницу без изменяемых данных один раз за процесс.
+
+    Контекст учитывается только при первом вызове, поэтому сюда передаются
+    только константы вроде STORAGE_INFO.
+    """
+    page = _static_pages.get(template_name)
+    if page is None:
+        page = render(template_name, template_context or {})
+        _static_pages[template_name] = page
+    return page
@@ -0,0 +1,56 @@
+from telegram.constants import MAX_MESSAGE_LENGTH
+
+from bot.outbox import send_message
+from bot.rendering import render_each
+
+REPORT_CHUNK_SIZE = 500
+
+
+def iter_chunks(queryset, chunk_size=REPORT_CHUNK_SIZE):
+    """Читает queryset курсором порциями, не загружая его целиком."""
+    chunk = []
+    for obj in queryset.iterator(chunk_size=chunk_size):
+        chunk.append(obj)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def iter_report_messages(queryset, template_name, item_name, header='',
+                         limit=MAX_MESSAGE_LENGTH, chunk_size=REPORT_CHUNK_SIZE):
+    """Рендерит строки отчета и режет их на сообщения не длиннее limit.
+
+    Строки не разрываются между сообщениями, кроме строк длиннее limit.
+    """
+    message = header
+    for chunk in iter_chunks(queryset, chunk_size):
+        for row in render_each(template_name, chunk, item_name):
+            separator = '\n' if message and message != header else ''
+            if len(message) + len(separator) + len(row) > limit and message:
+                yield message
+                message, separator = '', ''
+            while len(row) > limit:
+                yield row[:limit]
+                row = row[limit:]
+            message = f'{message}{separator}{row}'
+    if message and message != header:
+        yield message
+
+
+def send_report(bot, chat_id, messages, empty_text, reply_markup=None):
+    """Отправляет сообщения отчета, кнопки прикрепляются к последнему.
+
+    Возвращает число отправленных сообщений.
+    """
+    sent = 0
+    previous = None
+    for message in messages:
+        if previous is not None:
+            send_message(bot, text=previous, chat_id=chat_id)
+            sent += 1
+        previous = message
+    send_message(bot, text=previous if previous is not None else empty_text,
+                 reply_markup=reply_markup, chat_id=chat_id)
+    return sent + 1
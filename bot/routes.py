@@ -0,0 +1,23 @@
+import threading
+from contextlib import contextmanager
+
+_current = threading.local()
+
+
+def get_route():
+    """Имя обработчика, который выполняется в текущем потоке, или None."""
+    return getattr(_current, 'route', None)
+
+
+@contextmanager
+def handling(route):
+    """Помечает текущий поток обработчиком route: метки метрик и строк Outbox.
+
+    Модуль не зависит от Django, чтобы его мог импортировать bot.outbox.
+    """
+    previous = get_route()
+    _current.route = route
+    try:
+        yield
+    finally:
+        _current.route = previous
@@ -0,0 +1,216 @@
+import json
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict, defaultdict
+
+from telegram.ext import BasePersistence
+
+from bot.concurrency import wrap_handlers
+
+logger = logging.getLogger(__name__)
+
+# увеличивать при несовместимом изменении ключей user_data
+SESSION_VERSION = 1
+
+# сколько прочитанных состояний помнит процесс в режиме shared
+KNOWN_SESSIONS_LIMIT = 10000
+
+
+def dump_session(data):
+    """Компактное представление user_data: только заполненные значения."""
+    state = {key: value for key, value in data.items() if value is not None and value is not False}
+    return json.dumps(state, separators=(',', ':'), ensure_ascii=False)
+
+
+class SQLitePersistence(BasePersistence):
+    """Хранит состояние диалогов (user_data) в локальной таблице SQLite.
+
+    Изменения копятся в памяти и пишутся одной транзакцией раз в
+    flush_interval секунд (write-behind), поэтому обработчик не ждет диска.
+    В user_data должны лежать только JSON-совместимые значения: id, строки,
+    числа, но не объекты моделей.
+
+    shared=True - для нескольких процессов с одной таблицей (webhook за
+    несколькими воркерами): перед обработчиком состояние перечитывается
+    (refresh_user_data), а пишется сразу и только если строку с тех пор
+    не изменил другой процесс. Ревизии помнятся для known_limit последних
+    пользователей: апдейт пользователя, вытесненного между чтением и
+    записью, не сохраняется.
+    """
+
+    def __init__(self, filename, flush_interval=1.0, shared=False, known_limit=KNOWN_SESSIONS_LIMIT):
+        super().__init__(store_user_data=True, store_chat_data=False, store_bot_data=False)
+        self.filename = str(filename)
+        self.flush_interval = flush_interval
+        self.shared = shared
+        self.known_limit = known_limit
+        # ревизия и состояние строки, прочитанной refresh_user_data, ревизия 0 - строки еще нет;
+        # самые давно прочитанные в начале
+        self._known = OrderedDict()
+        self._known_lock = threading.Lock()
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._stopped = threading.Event()
+
+        # все обращения к соединению идут под _write_lock
+        self._connection = sqlite3.connect(self.filename, timeout=10, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS bot_session ('
+                'user_id INTEGER PRIMARY KEY, version INTEGER NOT NULL, state TEXT NOT NULL, '
+                'revision INTEGER NOT NULL DEFAULT 0)'
+            )
+            columns = [row[1] for row in self._connection.execute('PRAGMA table_info(bot_session)')]
+            if 'revision' not in columns:
+                self._connection.execute('ALTER TABLE bot_session ADD COLUMN revision INTEGER NOT NULL DEFAULT 0')
+
+        if not shared:
+            self._flusher = threading.Thread(target=self._flush_periodically, name='session-flusher', daemon=True)
+            self._flusher.start()
+
+    def get_user_data(self):
+        user_data = defaultdict(dict)
+        if self.shared:
+            # каждое состояние читается перед своим апдейтом
+            return user_data
+        with self._write_lock:
+            rows = self._connection.execute('SELECT user_id, version, state FROM bot_session').fetchall()
+            for user_id, version, state in rows:
+                if version != SESSION_VERSION:
+                    # незавершенный диалог старого формата проще начать заново
+                    continue
+                user_data[user_id] = json.loads(state)
+        return user_data
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_bot_data(self):
+        return {}
+
+    def get_conversations(self, name):
+        return {}
+
+    def update_conversation(self, name, key, new_state):
+        pass
+
+    def refresh_user_data(self, user_id, data):
+        """Заменяет data состоянием пользователя из таблицы."""
+        with self._write_lock:
+            row = self._connection.execute(
+                'SELECT version, state, revision FROM bot_session WHERE user_id = ?', (user_id,)
+            ).fetchone()
+        data.clear()
+        if row is None:
+            self._remember(user_id, 0, None)
+            return
+        version, state, revision = row
+        if version == SESSION_VERSION:
+            data.update(json.loads(state))
+        self._remember(user_id, revision, dump_session(data))
+
+    def _remember(self, user_id, revision, state):
+        with self._known_lock:
+            self._known[user_id] = (revision, state)
+            self._known.move_to_end(user_id)
+            while len(self._known) > self.known_limit:
+                self._known.popitem(last=False)
+
+    def update_user_data(self, user_id, data):
+        state = dump_session(data)
+        if self.shared:
+            self._write_shared(user_id, state)
+            return
+        with self._pending_lock:
+            self._pending[user_id] = state
+
+    def _write_shared(self, user_id, state):
+        with self._known_lock:
+            known = self._known.get(user_id)
+        if known is None:
+            # состояние не перечитывалось в этом процессе или уже вытеснено, писать его нельзя
+            return
+        revision, known_state = known
+        if state == known_state:
+            return
+        with self._write_lock, self._connection:
+            if revision:
+                written = self._connection.execute(
+                    'UPDATE bot_session SET version = ?, state = ?, revision = revision + 1 '
+                    'WHERE user_id = ? AND revision = ?',
+                    (SESSION_VERSION, state, user_id, revision),
+                ).rowcount
+            else:
+                written = self._connection.execute(
+                    'INSERT OR IGNORE INTO bot_session (user_id, version, state, revision) VALUES (?, ?, ?, 1)',
+                    (user_id, SESSION_VERSION, state),
+                ).rowcount
+        if written:
+            self._remember(user_id, revision + 1, state)
+        else:
+            logger.warning('Session of user %s was changed by another process, update dropped', user_id)
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def update_bot_data(self, data):
+        pass
+
+    def _flush_periodically(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self._write_pending()
+            except sqlite3.Error:
+                logger.exception('Failed to write bot sessions')
+
+    def _write_pending(self):
+        with self._write_lock:
+            with self._pending_lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+            rows = [(user_id, SESSION_VERSION, state) for user_id, state in pending.items()]
+            try:
+                with self._connection:
+                    self._connection.executemany(
+                        'INSERT INTO bot_session (user_id, version, state) VALUES (?, ?, ?) '
+                        'ON CONFLICT (user_id) DO UPDATE SET version = excluded.version, state = excluded.state, '
+                        'revision = revision + 1',
+                        rows,
+                    )
+            except sqlite3.Error:
+                # вернем несохраненное, не затирая более свежие записи
+                with self._pending_lock:
+                    for user_id, state in pending.items():
+                        self._pending.setdefault(user_id, state)
+                raise
+            return len(rows)
+
+    def flush(self):
+        self._stopped.set()
+        self._write_pending()
+        with self._write_lock:
+            self._connection.close()
+
+
+def refresh_sessions(dispatcher):
+    """Перед каждым обработчиком перечитывает user_data из SQLitePersistence(shared=True).
+
+    Вызывать до dispatch_by_chat, чтобы состояние читалось в потоке пула,
+    когда предыдущие апдейты чата уже сохранены.
+    """
+    persistence = dispatcher.persistence
+
+    def refresh_callback(callback, route):
+        def wrapper(update, context):
+            if update.effective_user:
+                persistence.refresh_user_data(update.effective_user.id, context.user_data)
+            return callback(update, context)
+
+        wrapper.__name__ = callback.__name__
+        wrapper.__wrapped__ = callback
+        return wrapper
+
+    wrap_handlers(dispatcher, refresh_callback)
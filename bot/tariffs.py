@@ -0,0 +1,135 @@
+import threading
+import time
+from collections import namedtuple
+
+from storage.models import Promocodes
+
+WEIGHT_RANGE = {
+    'до 10кг': 10,
+    'от 10 до 25кг': 25,
+    'от 25 до 40кг': 40,
+    'от 40 до 70кг': 70,
+    'от 70 до 100кг': 100,
+    'больше 100кг': 200,
+    'Я не знаю :(': 0,
+}
+
+VOLUME_RANGE = {
+    'до 0.1м³': 0.1,
+    'от 0.1 до 0.5м³': 0.5,
+    'от 0.5 до 1м³': 1,
+    'от 1 до 2м³': 2,
+    'от 2 до 4м³': 4,
+    'больше 4 м³': 8,
+    'Я не знаю :(': 0,
+}
+
+RENT_PERIODS = {
+    '1 месяц': 1,
+    '3 месяца': 3,
+    '6 месяцев': 6,
+    '12 месяцев': 12,
+}
+
+# примеры для prices.html: вес и объем подобраны так, чтобы формула бота
+# давала прежние цены со страницы - 1200, 5400 и 600 рублей
+PRICE_EXAMPLES = (
+    ('хранение велосипеда', 15, 0.8),
+    ('хранение большого 2-метрового шкафа', 45, 1.2),
+    ('хранение 4-х шин радиуса 17 дюймов', 40, 0.15),
+)
+
+PROMO_CACHE_TTL = 60
+
+Quote = namedtuple('Quote', 'monthly_price discount total_price')
+
+
+def calculate_price(weight, volume):
+    if not volume:
+        volume = sum(VOLUME_RANGE.values()) / (len(VOLUME_RANGE) or 1)
+    if not weight:
+        weight = sum(WEIGHT_RANGE.values()) / (len(WEIGHT_RANGE) or 1)
+    price = weight * volume * 100
+    return round(price)
+
+
+def build_monthly_prices():
+    return {
+        (weight, volume): calculate_price(weight, volume)
+        for weight in WEIGHT_RANGE.values()
+        for volume in VOLUME_RANGE.values()
+    }
+
+
+def build_quotes(monthly_prices):
+    return {
+        (weight, volume, period): Quote(price, 0, price * period)
+        for (weight, volume), price in monthly_prices.items()
+        for period in RENT_PERIODS.values()
+    }
+
+
+MONTHLY_PRICES = build_monthly_prices()
+QUOTES = build_quotes(MONTHLY_PRICES)
+
+
+def get_monthly_price(weight, volume):
+    price = MONTHLY_PRICES.get((weight, volume))
+    if price is None:
+        price = calculate_price(weight, volume)
+    return price
+
+
+def apply_discount(price, discount):
+    return round(price * (100 - discount) / 100)
+
+
+def get_quote(weight, volume, period, discount=0):
+    quote = QUOTES.get((weight, volume, period))
+    if quote is None:
+        price = calculate_price(weight, volume)
+        quote = Quote(price, 0, price * period)
+    if not discount:
+        return quote
+    monthly_price = apply_discount(quote.monthly_price, discount)
+    return Quote(monthly_price, discount, monthly_price * period)
+
+
+def get_price_examples():
+    return [
+        {'title': title, 'price': get_monthly_price(weight, volume)}
+        for title, weight, volume in PRICE_EXAMPLES
+    ]
+
+
+class PromoCodes:
+    """Действующие промокоды в памяти: название -> скидка.
+
+    Перечитываются из БД не чаще раза в ttl секунд, поэтому проверка кода
+    в обработчике - это поиск в словаре.
+    """
+
+    def __init__(self, ttl=PROMO_CACHE_TTL):
+        self.ttl = ttl
+        self._discounts = {}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        active = Promocodes.objects.active().values_list('name', 'discount')
+        self._discounts = {name.strip().lower(): discount for name, discount in active}
+        self._loaded_at = time.monotonic()
+
+    def get_discount(self, promo_code):
+        """Скидка в % по коду или None, если такого действующего кода нет."""
+        with self._lock:
+            if self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl:
+                self._load()
+            return self._discounts.get(promo_code.strip().lower())
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+
+promo_codes = PromoCodes()
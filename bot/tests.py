@@ -1,3 +1,917 @@
-from django.test import TestCase
+import io
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+from telegram.constants import MAX_MESSAGE_LENGTH
+from telegram.error import BadRequest, NetworkError
+
+from bot import callbacks, keyboards, metrics, outbox, profiling, qr, rendering, routes
+from bot.bot import TRANSFERS_PAGE_SIZE, get_transfers_page
+from bot.callbacks import CallbackAction, CallbackRouter
+from bot.concurrency import ChatWorkerPool, run_in_chat_worker
+from bot.metrics import Registry
+from bot.outbox import MAX_ATTEMPTS, Outbox, OutboxSender, RateLimiter, coalesce
+from bot.profiling import Profiler, user_data_summary
+from bot.reminders import ReminderScheduler
+from bot.reports import iter_chunks, iter_report_messages, send_report
+from bot.sessions import SESSION_VERSION, SQLitePersistence
+from bot.tariffs import (
+    MONTHLY_PRICES, RENT_PERIODS, VOLUME_RANGE, WEIGHT_RANGE, PromoCodes, get_monthly_price,
+    get_price_examples, get_quote,
+)
+from bot.views import SECRET_TOKEN_HEADER
+from storage import bulk
+from storage.models import Box, Promocodes, TransferRequest, User
+
+
+class QRCodeTests(SimpleTestCase):
+
+    def test_render_one_bit_png(self):
+        image = Image.open(io.BytesIO(qr.render_qr_code('abc123')))
+
+        self.assertEqual((image.format, image.mode), ('PNG', '1'))
+
+    def test_random_code(self):
+        code = qr.get_random_code()
+
+        self.assertEqual(len(code), qr.CODE_LENGTH)
+        self.assertTrue(set(code) <= set(qr.CODE_ALPHABET))
+
+    def test_pool_renders_in_caller_when_empty(self):
+        pool = qr.QRCodePool(size=0)
+        self.addCleanup(pool.shutdown)
+
+        code, png = pool.get()
+
+        self.assertEqual(len(code), qr.CODE_LENGTH)
+        self.assertTrue(png.startswith(b'\x89PNG'))
+
+    def test_document(self):
+        pool = qr.QRCodePool(size=1, workers=1)
+        self.addCleanup(pool.shutdown)
+        with mock.patch.object(qr, 'get_pool', return_value=pool):
+            code, document = qr.get_qr_document()
+
+        self.assertEqual(document.name, 'qr.png')
+        self.assertTrue(document.read().startswith(b'\x89PNG'))
+
+
+class RenderingTests(SimpleTestCase):
+
+    def test_render_each_matches_render(self):
+        boxes = [Box(id=number, user=User(phone=f'+7999{number}')) for number in (1, 2, 3)]
+
+        self.assertEqual(
+            rendering.render_each('unpaid_boxes', boxes, 'box'),
+            [rendering.render('unpaid_boxes', {'box': box}) for box in boxes],
+        )
+        self.assertEqual(rendering.render_each('unpaid_boxes', [], 'box'), [])
+
+    def test_render_many_joins_items(self):
+        boxes = [Box(id=number, user=User(phone='1')) for number in (1, 2)]
+
+        text = rendering.render_many('unpaid_boxes', boxes, 'box', separator='\n---\n')
+
+        self.assertEqual(text.count('\n---\n'), 1)
+        self.assertIn('Заказ № 2', text)
+
+    def test_static_page_is_rendered_once(self):
+        with mock.patch.dict(rendering._static_pages, clear=True):
+            first = rendering.render_static('storage_info', {'storage': {'address': 'Москва'}})
+            second = rendering.render_static('storage_info', {'storage': {'address': 'Казань'}})
+
+        self.assertIn('Москва', first)
+        self.assertIs(first, second)
+
+
+class ChatWorkerPoolTests(SimpleTestCase):
+
+    def make_pool(self, workers):
+        pool = ChatWorkerPool(workers)
+        self.addCleanup(pool.stop)
+        return pool
+
+    def test_keeps_order_within_chat(self):
+        pool = self.make_pool(4)
+        handled = {1: [], 2: []}
+
+        def handle(chat_id, number):
+            # первые апдейты дольше, но порядок внутри чата не должен меняться
+            time.sleep(0.01 if number < 3 else 0)
+            handled[chat_id].append(number)
+
+        for number in range(6):
+            for chat_id in handled:
+                pool.submit(chat_id, handle, chat_id, number)
+        pool.join()
+
+        self.assertEqual(handled, {1: list(range(6)), 2: list(range(6))})
+
+    def test_chats_do_not_wait_for_each_other(self):
+        pool = self.make_pool(2)
+        release, handled = threading.Event(), threading.Event()
+        pool.submit(0, release.wait, 5)
+        pool.submit(1, handled.set)
+
+        self.assertTrue(handled.wait(5))
+        release.set()
+
+    def test_error_does_not_stop_worker(self):
+        pool = self.make_pool(1)
+        handled = []
+
+        with self.assertLogs('bot.concurrency', 'ERROR'):
+            pool.submit(1, lambda: 1 / 0)
+            pool.submit(1, handled.append, 'next')
+            pool.join()
+
+        self.assertEqual(handled, ['next'])
+
+    def test_workers_must_be_positive(self):
+        with self.assertRaises(ValueError):
+            ChatWorkerPool(0)
+
+    def test_wrapped_callback_reports_errors_and_saves_state(self):
+        pool = self.make_pool(1)
+        dispatcher = mock.Mock()
+        update = SimpleNamespace(effective_chat=SimpleNamespace(id=1))
+        error = RuntimeError('boom')
+
+        def callback(update, context):
+            raise error
+
+        wrapper = run_in_chat_worker(pool, callback)
+        wrapper(update, SimpleNamespace(dispatcher=dispatcher))
+        pool.join()
+
+        self.assertEqual(wrapper.__wrapped__, callback)
+        dispatcher.dispatch_error.assert_called_once_with(update, error)
+        dispatcher.update_persistence.assert_called_once_with(update)
+
+
+@override_settings(TELEGRAM_WEBHOOK_SECRET='secret')
+class WebhookViewTests(SimpleTestCase):
+
+    update = {'update_id': 1, 'message': {
+        'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'}, 'text': '/start',
+    }}
+
+    def post(self, body, secret):
+        headers = {} if secret is None else {'HTTP_' + SECRET_TOKEN_HEADER.upper().replace('-', '_'): secret}
+        with mock.patch('bot.views.get_dispatcher') as get_dispatcher:
+            response = self.client.post(
+                reverse('telegram_webhook'), body, content_type='application/json', **headers,
+            )
+        return response, get_dispatcher.return_value
+
+    def test_accepts_update_with_secret(self):
+        response, dispatcher = self.post(self.update, 'secret')
+
+        self.assertEqual(response.status_code, 200)
+        update = dispatcher.process_update.call_args.args[0]
+        self.assertEqual((update.update_id, update.message.text), (1, '/start'))
+
+    def test_rejects_wrong_or_missing_secret(self):
+        for secret in ('wrong', '', None):
+            response, dispatcher = self.post(self.update, secret)
+
+            self.assertEqual(response.status_code, 403)
+            dispatcher.process_update.assert_not_called()
+
+    @override_settings(TELEGRAM_WEBHOOK_SECRET='')
+    def test_rejects_everything_without_configured_secret(self):
+        response, dispatcher = self.post(self.update, '')
+
+        self.assertEqual(response.status_code, 403)
+        dispatcher.process_update.assert_not_called()
+
+    def test_bad_json(self):
+        response, dispatcher = self.post('{', 'secret')
+
+        self.assertEqual(response.status_code, 400)
+        dispatcher.process_update.assert_not_called()
+
+    def test_only_post(self):
+        response = self.client.get(reverse('telegram_webhook'))
+
+        self.assertEqual(response.status_code, 405)
+
+
+class TransfersPageTests(TestCase):
+
+    def setUp(self):
+        box = Box.objects.create(user=User.objects.create(tg_username='client', chat_id=1))
+        self.transfers = [
+            TransferRequest.objects.create(box=box, transfer_type=0, address='Москва')
+            for _ in range(TRANSFERS_PAGE_SIZE * 2 + 1)
+        ]
+        self.ids = [transfer.id for transfer in self.transfers]
+
+    def page_ids(self, direction='after', cursor=None):
+        page, has_prev, has_next = get_transfers_page(direction, cursor)
+        return [transfer.id for transfer in page], has_prev, has_next
+
+    def test_pages_forward_and_back(self):
+        first = self.ids[:TRANSFERS_PAGE_SIZE]
+        second = self.ids[TRANSFERS_PAGE_SIZE:TRANSFERS_PAGE_SIZE * 2]
+
+        self.assertEqual(self.page_ids(), (first, False, True))
+        self.assertEqual(self.page_ids('after', first[-1]), (second, True, True))
+        self.assertEqual(self.page_ids('after', second[-1]), (self.ids[-1:], True, False))
+        self.assertEqual(self.page_ids('before', self.ids[-1]), (second, True, True))
+        self.assertEqual(self.page_ids('before', second[0]), (first, False, True))
+
+    def test_skips_completed_transfers(self):
+        TransferRequest.objects.filter(id__in=self.ids[1:TRANSFERS_PAGE_SIZE + 1]).update(is_complete=True)
+
+        ids, has_prev, has_next = self.page_ids()
+
+        self.assertEqual(ids, [self.ids[0], *self.ids[TRANSFERS_PAGE_SIZE + 1:TRANSFERS_PAGE_SIZE * 2]])
+        self.assertTrue(has_next)
+
+    def test_empty_page_falls_back_to_first(self):
+        TransferRequest.objects.filter(id__lt=self.ids[TRANSFERS_PAGE_SIZE]).update(is_complete=True)
+        first = self.ids[TRANSFERS_PAGE_SIZE:TRANSFERS_PAGE_SIZE * 2]
+
+        self.assertEqual(self.page_ids('before', self.ids[TRANSFERS_PAGE_SIZE]), (first, False, True))
+        TransferRequest.objects.filter(id__gt=self.ids[TRANSFERS_PAGE_SIZE]).update(is_complete=True)
+        self.assertEqual(self.page_ids('after', self.ids[TRANSFERS_PAGE_SIZE]), (first[:1], False, False))
+
+
+class ReportTests(TestCase):
+
+    def rows(self):
+        return rendering.render_each('promos', Promocodes.objects.order_by('id'), 'promo')
+
+    def messages(self, **kwargs):
+        return list(iter_report_messages(Promocodes.objects.order_by('id'), 'promos', 'promo', **kwargs))
+
+    def test_chunks(self):
+        for number in range(5):
+            Promocodes.objects.create(name=str(number), discount=10)
+
+        chunks = list(iter_chunks(Promocodes.objects.order_by('id'), chunk_size=2))
+
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+
+    def test_long_report_is_split_between_rows(self):
+        for number in range(100):
+            Promocodes.objects.create(name=f'promo{number}' * 10, discount=10)
+
+        messages = self.messages(header='Промокоды:\n', chunk_size=7)
+
+        self.assertGreater(len(messages), 1)
+        self.assertTrue(all(len(message) <= MAX_MESSAGE_LENGTH for message in messages))
+        self.assertTrue(messages[0].startswith('Промокоды:\n'))
+        self.assertEqual('\n'.join(messages), 'Промокоды:\n' + '\n'.join(self.rows()))
+
+    def test_split_boundary(self):
+        promo = Promocodes.objects.create(name='', discount=10)
+        row_length = len(self.rows()[0])
+        # два одинаковых ряда с разделителем занимают ровно MAX_MESSAGE_LENGTH
+        promo.name = 'x' * ((MAX_MESSAGE_LENGTH - 1) // 2 - row_length)
+        promo.save()
+        Promocodes.objects.create(name=promo.name, discount=10)
+        header = 'x' * ((MAX_MESSAGE_LENGTH - 1) % 2)
+
+        self.assertEqual([len(message) for message in self.messages(header=header)], [MAX_MESSAGE_LENGTH])
+        self.assertEqual(len(self.messages(header=header + 'x')), 2)
+
+    def test_row_longer_than_message(self):
+        Promocodes.objects.create(name='x' * MAX_MESSAGE_LENGTH, discount=10)
+        row = self.rows()[0]
+
+        messages = self.messages()
+
+        self.assertEqual([len(message) for message in messages], [MAX_MESSAGE_LENGTH, len(row) - MAX_MESSAGE_LENGTH])
+        self.assertEqual(''.join(messages), row)
+
+    def test_send_report_attaches_markup_to_last_message(self):
+        bot, markup = mock.Mock(), object()
+
+        self.assertEqual(send_report(bot, 1, iter(['a', 'b']), 'пусто', markup), 2)
+        self.assertEqual(bot.send_message.call_args_list, [
+            mock.call(chat_id=1, text='a', reply_markup=None),
+            mock.call(chat_id=1, text='b', reply_markup=markup),
+        ])
+
+        bot.reset_mock()
+        self.assertEqual(send_report(bot, 1, iter([]), 'пусто', markup), 1)
+        bot.send_message.assert_called_once_with(chat_id=1, text='пусто', reply_markup=markup)
+
+
+class SessionTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.filename = os.path.join(directory.name, 'sessions.sqlite3')
+
+    def open(self, **kwargs):
+        persistence = SQLitePersistence(self.filename, flush_interval=3600, **kwargs)
+        self.addCleanup(persistence.flush)
+        return persistence
+
+    def test_round_trip(self):
+        persistence = self.open()
+        persistence.update_user_data(1, {'price': 1500, 'promo_code': 'summer', 'ask_promo': False, 'box': None})
+        persistence.flush()
+
+        self.assertEqual(self.open().get_user_data()[1], {'price': 1500, 'promo_code': 'summer'})
+
+    def test_old_version_is_dropped(self):
+        persistence = self.open()
+        persistence.update_user_data(1, {'price': 1500})
+        persistence.flush()
+        with sqlite3.connect(self.filename) as connection:
+            connection.execute('UPDATE bot_session SET version = ?', (SESSION_VERSION - 1,))
+
+        self.assertNotIn(1, self.open().get_user_data())
+
+    def test_shared_persistence_rereads_and_detects_conflicts(self):
+        first, second = self.open(shared=True), self.open(shared=True)
+        first_data, second_data = {}, {}
+
+        first.refresh_user_data(1, first_data)
+        first_data['price'] = 1500
+        first.update_user_data(1, first_data)
+
+        second.refresh_user_data(1, second_data)
+        self.assertEqual(second_data, {'price': 1500})
+        second_data['box'] = 7
+        second.update_user_data(1, second_data)
+
+        # first не перечитал состояние и не должен затереть запись second
+        with self.assertLogs('bot.sessions', 'WARNING'):
+            first.update_user_data(1, {'price': 1})
+        first.refresh_user_data(1, first_data)
+        self.assertEqual(first_data, {'price': 1500, 'box': 7})
+
+        state = first._connection.execute('SELECT state FROM bot_session').fetchone()[0]
+        self.assertEqual(json.loads(state), {'price': 1500, 'box': 7})
+
+    def test_known_states_are_bounded(self):
+        persistence = self.open(shared=True, known_limit=2)
+        for user_id in (1, 2, 3):
+            persistence.refresh_user_data(user_id, {})
+        persistence.refresh_user_data(2, {})
+
+        self.assertEqual(list(persistence._known), [3, 2])
+        # состояние вытесненного пользователя не пишется вслепую
+        persistence.update_user_data(1, {'price': 1500})
+        self.assertIsNone(persistence._connection.execute('SELECT state FROM bot_session WHERE user_id = 1').fetchone())
+        persistence.update_user_data(2, {'price': 1500})
+        self.assertEqual(list(persistence._known), [3, 2])
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class RecordingBot:
+
+    def __init__(self, errors=()):
+        self.sent = []
+        self.errors = list(errors)
+
+    def send_message(self, chat_id, **payload):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.sent.append((chat_id, payload['text']))
+
+
+class OutboxTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.outbox = Outbox(os.path.join(directory.name, 'outbox.sqlite3'))
+        self.addCleanup(self.outbox.close)
+
+    def make_sender(self, bot):
+        sender = OutboxSender(self.outbox, bot, global_rate=1000)
+        self.addCleanup(sender._executor.shutdown)
+        return sender
+
+    def test_coalesce_texts_until_keyboard(self):
+        for text in ('один', 'два'):
+            self.outbox.enqueue(1, 'send_message', {'text': text})
+        self.outbox.enqueue(1, 'send_message', {'text': 'три', 'reply_markup': '{}'})
+        self.outbox.enqueue(1, 'send_message', {'text': 'четыре'})
+
+        ids, method, payload, document = coalesce(self.outbox.fetch())
+
+        self.assertEqual(len(ids), 3)
+        self.assertEqual(payload, {'text': 'один\n\nдва\n\nтри', 'reply_markup': '{}'})
+
+    def test_coalesce_respects_length_limit(self):
+        for text in ('a' * 30, 'b' * 30):
+            self.outbox.enqueue(1, 'send_message', {'text': text})
+
+        ids, _, payload, _ = coalesce(self.outbox.fetch(), limit=50)
+
+        self.assertEqual(len(ids), 1)
+        self.assertEqual(payload['text'], 'a' * 30)
+
+    def test_fetch_does_not_starve_other_chats(self):
+        for number in range(30):
+            self.outbox.enqueue(1, 'send_message', {'text': str(number)})
+        self.outbox.enqueue(2, 'send_message', {'text': 'other'})
+
+        rows = self.outbox.fetch(limit=5, rows_per_chat=3)
+
+        self.assertEqual([row[1] for row in rows], [1, 1, 1, 2])
+
+    def test_fetch_skips_chats_waiting_for_retry(self):
+        self.outbox.enqueue(1, 'send_message', {'text': 'later'})
+        self.outbox.enqueue(2, 'send_message', {'text': 'now'})
+        first_id = self.outbox.fetch()[0][0]
+        self.outbox.reschedule(first_id, 1, time.time() + 60)
+
+        self.assertEqual([row[1] for row in self.outbox.fetch()], [2])
+
+    def test_rate_limiter(self):
+        clock = FakeClock()
+        with mock.patch('bot.outbox.time', clock):
+            limiter = RateLimiter(rate=2, burst=2)
+            for _ in range(4):
+                limiter.acquire()
+
+        self.assertAlmostEqual(clock.now - 1000, 1.0)
+
+    def test_send_coalesced_and_one_request_per_chat(self):
+        bot = RecordingBot()
+        sender = self.make_sender(bot)
+        self.outbox.enqueue(1, 'send_message', {'text': 'a'})
+        self.outbox.enqueue(1, 'send_message', {'text': 'b'})
+        self.outbox.enqueue(2, 'send_message', {'text': 'c'})
+
+        sender.send_due()
+
+        self.assertEqual(sorted(bot.sent), [(1, 'a\n\nb'), (2, 'c')])
+        self.assertEqual(len(self.outbox), 0)
+        self.assertEqual((sender.sent, sender.coalesced), (2, 1))
+
+    def test_network_error_is_retried_with_backoff(self):
+        sender = self.make_sender(RecordingBot([NetworkError('timeout')]))
+        self.outbox.enqueue(1, 'send_message', {'text': 'a'})
+
+        sender.send_due()
+
+        row = self.outbox._connection.execute('SELECT attempts, next_attempt FROM bot_outbox').fetchone()
+        self.assertEqual(row[0], 1)
+        self.assertGreater(row[1], time.time())
+
+    def test_gives_up_after_max_attempts(self):
+        sender = self.make_sender(RecordingBot([NetworkError('timeout')]))
+        self.outbox.enqueue(1, 'send_message', {'text': 'a'})
+        self.outbox._connection.execute('UPDATE bot_outbox SET attempts = ?', (MAX_ATTEMPTS - 1,))
+
+        with self.assertLogs('bot.outbox', 'ERROR'):
+            sender.send_due()
+
+        self.assertEqual(len(self.outbox), 0)
+
+    def test_bad_request_is_dropped(self):
+        bot = RecordingBot([BadRequest('chat not found')])
+        sender = self.make_sender(bot)
+        self.outbox.enqueue(1, 'send_message', {'text': 'a'})
+
+        with self.assertLogs('bot.outbox', 'ERROR'):
+            sender.send_due()
+
+        self.assertEqual(len(self.outbox), 0)
+        self.assertEqual(bot.sent, [])
+
+    def test_adds_route_column_to_old_queue(self):
+        filename = self.outbox.filename + '.old'
+        connection = sqlite3.connect(filename)
+        connection.execute(
+            'CREATE TABLE bot_outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER NOT NULL, '
+            'method TEXT NOT NULL, payload TEXT NOT NULL, document BLOB, '
+            'attempts INTEGER NOT NULL DEFAULT 0, next_attempt REAL NOT NULL DEFAULT 0)'
+        )
+        connection.execute("INSERT INTO bot_outbox (chat_id, method, payload) VALUES (1, 'send_message', '{}')")
+        connection.commit()
+        connection.close()
+
+        old_outbox = Outbox(filename)
+        self.addCleanup(old_outbox.close)
+        old_outbox.enqueue(1, 'send_message', {'text': 'a'}, route='start')
+
+        self.assertEqual([row[7] for row in old_outbox.fetch()], [None, 'start'])
+
+
+class ReminderTests(TestCase):
+
+    def setUp(self):
+        self.now = timezone.now()
+        self.user = User.objects.create(tg_username='client', chat_id=7)
+        self.bot = RecordingBot()
+        self.scheduler = ReminderScheduler(self.bot)
+
+    def create_box(self, paid_till):
+        return Box.objects.create(user=self.user, paid_till=paid_till)
+
+    def due(self, box):
+        return box.paid_till - self.scheduler.lead
+
+    def reminded_boxes(self):
+        return sorted(int(re.search(r'номер (\d+)', text).group(1)) for _, text in self.bot.sent)
+
+    def test_reminds_before_paid_till(self):
+        box = self.create_box(self.now + self.scheduler.lead + timedelta(hours=1))
+        self.scheduler.refresh(self.now)
+
+        self.scheduler.fire_due(self.now)
+        self.assertEqual(self.bot.sent, [])
+        self.scheduler.fire_due(self.due(box))
+        self.assertEqual(self.reminded_boxes(), [box.id])
+        self.assertEqual(self.bot.sent[0][0], 7)
+
+    def test_extended_box_is_not_reminded(self):
+        box = self.create_box(self.now + self.scheduler.lead + timedelta(hours=1))
+        self.scheduler.refresh(self.now)
+
+        bulk.extend_rentals(Box.objects.filter(pk=box.pk), 1)
+        self.scheduler.fire_due(self.due(box))
+
+        self.assertEqual(self.bot.sent, [])
+
+    def test_refresh_reads_only_new_and_changed_boxes(self):
+        # в пройденной части окна при старте, сам по себе больше не перечитывается
+        old = self.create_box(self.now + timedelta(hours=1))
+        Box.objects.filter(pk=old.pk).update(updated_at=self.now - timedelta(hours=1))
+        edited = self.create_box(self.now + timedelta(days=30))
+        self.scheduler.refresh(self.now)
+
+        edited.paid_till = self.now + timedelta(hours=2)
+        edited.save()
+        created = self.create_box(self.now + timedelta(hours=3))
+        with self.assertNumQueries(2):
+            self.scheduler.refresh(self.now + timedelta(minutes=1))
+        self.scheduler.fire_due(self.now + timedelta(minutes=1))
+
+        self.assertEqual(self.reminded_boxes(), [edited.id, created.id])
+
+    def test_changed_box_is_reminded_once(self):
+        box = self.create_box(self.now + self.scheduler.lead + timedelta(hours=1))
+        self.scheduler.refresh(self.now)
+        self.scheduler.fire_due(self.due(box))
+
+        box.description = 'зимние шины'
+        box.save()
+        self.scheduler.refresh(self.due(box))
+        self.scheduler.fire_due(self.due(box))
+
+        self.assertEqual(len(self.bot.sent), 1)
+
+
+class TariffTests(SimpleTestCase):
+
+    def test_price_examples(self):
+        self.assertEqual([example['price'] for example in get_price_examples()], [1200, 5400, 600])
+        self.assertEqual(
+            rendering.render('prices', {'price_examples': get_price_examples()}),
+            'хранение велосипеда стоит 1200 рублей в месяц\n'
+            'хранение большого 2-метрового шкафа стоит 5400 рублей в месяц\n'
+            'хранение 4-х шин радиуса 17 дюймов стоит 600 рублей в месяц',
+        )
+
+    def test_quote_matrix(self):
+        self.assertEqual(len(MONTHLY_PRICES), len(WEIGHT_RANGE) * len(VOLUME_RANGE))
+        self.assertEqual(get_monthly_price(25, 2), 5000)
+        self.assertEqual(get_quote(25, 2, 3), (5000, 0, 15000))
+        self.assertEqual(get_quote(25, 2, 3, discount=10), (4500, 10, 13500))
+        for period in RENT_PERIODS.values():
+            self.assertEqual(get_quote(10, 0.1, period).total_price, 100 * period)
+
+    def test_price_outside_matrix(self):
+        # неизвестные вес и объем считаются средними по таблице
+        self.assertEqual(get_quote(15, 0.8, 1).monthly_price, 1200)
+        average_weight = sum(WEIGHT_RANGE.values()) / len(WEIGHT_RANGE)
+        self.assertEqual(get_monthly_price(0, 2), round(average_weight * 2 * 100))
+
+
+class PromoCodesCacheTests(TestCase):
+
+    def test_codes_are_cached_for_ttl(self):
+        Promocodes.objects.create(name='Summer', discount=10)
+        Promocodes.objects.create(name='old', discount=30, valid_till=timezone.now() - timedelta(days=1))
+        clock = FakeClock()
+        with mock.patch('bot.tariffs.time', clock):
+            codes = PromoCodes(ttl=60)
+            with self.assertNumQueries(1):
+                self.assertEqual(codes.get_discount(' summer '), 10)
+                self.assertIsNone(codes.get_discount('old'))
+
+            Promocodes.objects.create(name='new', discount=20)
+            with self.assertNumQueries(0):
+                self.assertIsNone(codes.get_discount('new'))
+            clock.sleep(61)
+            self.assertEqual(codes.get_discount('new'), 20)
+
+            Promocodes.objects.filter(name='new').delete()
+            codes.invalidate()
+            self.assertIsNone(codes.get_discount('new'))
+
+
+class KeyboardTests(SimpleTestCase):
+
+    def test_static_keyboard_json_matches_plain_markup(self):
+        rows = [(('В начало', callbacks.START.pack()),), (('a', 'b'), ('c', 'd'))]
+        static = keyboards.build_static_keyboard(rows)
+        plain = keyboards.build_keyboard(rows)
+
+        self.assertEqual(json.loads(static.to_json()), plain.to_dict())
+        self.assertIs(static.to_json(), static.to_json())
+
+    def test_menu_callback_data_is_routable(self):
+        router = callbacks.CallbackRouter()
+        for action in vars(callbacks).values():
+            if isinstance(action, CallbackAction):
+                router.add(action, lambda update, context: None)
+        for menu in (keyboards.WEIGHTS, keyboards.VOLUMES, keyboards.RENT_PERIODS_WITH_PROMO, keyboards.TIME_ARRIVE):
+            for row in menu.inline_keyboard:
+                for button in row:
+                    self.assertIsNotNone(router.decode(button.callback_data), button.callback_data)
+
+    def test_transfers_keyboard_navigation(self):
+        page = [TransferRequest(id=number, box_id=1, transfer_type=0) for number in (3, 4)]
+
+        def navigation(has_prev, has_next):
+            rows = keyboards.build_transfers_keyboard(page, has_prev, has_next).inline_keyboard
+            return [button.callback_data for button in rows[-2]] if len(rows) == 4 else []
+
+        self.assertEqual(navigation(True, True), ['tp:before:3', 'tp:after:4'])
+        self.assertEqual(navigation(False, True), ['tp:after:4'])
+        self.assertEqual(navigation(False, False), [])
+        rows = keyboards.build_transfers_keyboard([], True, True).inline_keyboard
+        self.assertEqual([[button.text for button in row] for row in rows], [['В начало']])
+
+
+class CallbackTests(SimpleTestCase):
+
+    def setUp(self):
+        self.router = CallbackRouter()
+        for action in (callbacks.START, callbacks.TRANSFERS, callbacks.TRANSFERS_PAGE,
+                       callbacks.CLIENT_SHOW_BOX, callbacks.CLIENT_SET_VOLUME, callbacks.PICK_UP_ALL):
+            self.router.add(action, lambda update, context: None)
+
+    def test_pack_and_decode(self):
+        data = callbacks.TRANSFERS_PAGE.pack('after', 15)
+
+        self.assertEqual(data, 'tp:after:15')
+        self.assertEqual(self.router.decode(data), (callbacks.TRANSFERS_PAGE, ('after', 15)))
+        self.assertEqual(self.router.decode(callbacks.START.pack()), (callbacks.START, ()))
+
+    def test_pack_rejects_bad_arguments(self):
+        with self.assertRaises(ValueError):
+            callbacks.CLIENT_SHOW_BOX.pack()
+        with self.assertRaises(ValueError):
+            callbacks.CLIENT_SET_VOLUME.pack('1:2')
+        with self.assertRaises(ValueError):
+            CallbackAction('xx', 'long', str).pack('x' * 64)
+        with self.assertRaises(ValueError):
+            CallbackAction('a:b', 'bad')
+
+    def test_decode_legacy_data(self):
+        self.assertEqual(self.router.decode('client_show_box_15'), (callbacks.CLIENT_SHOW_BOX, (15,)))
+        self.assertEqual(self.router.decode('client_set_volume_1.5'), (callbacks.CLIENT_SET_VOLUME, (1.5,)))
+        self.assertEqual(self.router.decode('pick up all the things'), (callbacks.PICK_UP_ALL, ()))
+        # transfers без аргументов и transfers с двумя - разные действия
+        self.assertEqual(self.router.decode('transfers'), (callbacks.TRANSFERS, ()))
+        self.assertEqual(self.router.decode('transfers_before_7'), (callbacks.TRANSFERS_PAGE, ('before', 7)))
+
+    def test_decode_unknown_data(self):
+        self.assertIsNone(self.router.decode('sb:abc'))
+        self.assertIsNone(self.router.decode('zz:1'))
+        self.assertIsNone(self.router.decode('client_show_box_abc'))
+        self.assertIsNone(self.router.decode('unknown'))
+
+    def test_duplicate_code(self):
+        with self.assertRaises(ValueError):
+            self.router.add(CallbackAction('st', 'other'), lambda update, context: None)
+
+
+class FakeRequest:
+
+    def __init__(self):
+        self.urls = []
+
+    def post(self, url, data=None, timeout=None):
+        self.urls.append(url)
+        return True
+
+
+class TimedBot:
+    """Бот, который, как telegram.Bot, отправляет сообщения через request.post."""
+
+    def __init__(self):
+        self.request = FakeRequest()
+        metrics.instrument_request(self.request)
+
+    def send_message(self, chat_id, **payload):
+        return self.request.post('https://api.telegram.org/botTOKEN/sendMessage', payload)
+
+
+class MetricsTests(TestCase):
+
+    def setUp(self):
+        self.registry = Registry()
+        patcher = mock.patch.object(metrics, 'registry', self.registry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def counters(self):
+        counters = self.registry.snapshot()['counters']
+        return {(name, tuple(map(tuple, labels))): value for name, labels, value in counters}
+
+    def test_render_prometheus_text(self):
+        self.registry.observe('bot_handler_seconds', (('route', 'start'),), 0.03)
+        self.registry.observe('bot_handler_seconds', (('route', 'start'),), 20)
+        self.registry.inc('bot_handler_errors_total', (('route', 'start'), ('error', 'Bad"Name\\')))
+
+        lines = metrics.render({'bot': self.registry.snapshot()}).splitlines()
+
+        self.assertEqual(lines[:3], [
+            '# HELP bot_handler_seconds Time spent in a bot handler',
+            '# TYPE bot_handler_seconds histogram',
+            'bot_handler_seconds_bucket{process="bot",route="start",le="0.005"} 0',
+        ])
+        # корзины накопительные: 0.03 попадает в le="0.05" и все следующие
+        self.assertIn('bot_handler_seconds_bucket{process="bot",route="start",le="0.025"} 0', lines)
+        self.assertIn('bot_handler_seconds_bucket{process="bot",route="start",le="0.05"} 1', lines)
+        self.assertIn('bot_handler_seconds_bucket{process="bot",route="start",le="10.0"} 1', lines)
+        self.assertIn('bot_handler_seconds_bucket{process="bot",route="start",le="+Inf"} 2', lines)
+        self.assertIn('bot_handler_seconds_sum{process="bot",route="start"} 20.03', lines)
+        self.assertIn('bot_handler_seconds_count{process="bot",route="start"} 2', lines)
+        self.assertIn('# TYPE bot_handler_errors_total counter', lines)
+        self.assertIn(r'bot_handler_errors_total{process="bot",route="start",error="Bad\"Name\\"} 1.0', lines)
+
+    def test_render_skips_empty_metrics(self):
+        self.assertEqual(metrics.render({'bot': self.registry.snapshot()}), '\n')
+
+    def test_instrument_callback_counts_queries_and_errors(self):
+        def start(update, context):
+            self.assertEqual(routes.get_route(), 'start')
+            User.objects.count()
+            raise ValueError('boom')
+
+        with self.assertRaises(ValueError):
+            metrics.instrument_callback(start, 'start')(None, None)
+
+        counters = self.counters()
+        self.assertEqual(counters['bot_handler_errors_total', (('route', 'start'), ('error', 'ValueError'))], 1)
+        self.assertEqual(counters['bot_handler_db_queries_total', (('route', 'start'),)], 1)
+        self.assertIsNone(routes.get_route())
+
+    def test_request_is_labeled_with_route(self):
+        bot = TimedBot()
+
+        with routes.handling('start'):
+            bot.send_message(1, text='a')
+        bot.send_message(1, text='b')
+
+        counters = self.counters()
+        self.assertEqual(counters['bot_telegram_requests_total', (('route', 'start'), ('method', 'sendMessage'))], 1)
+        self.assertEqual(
+            counters['bot_telegram_requests_total', (('route', metrics.BACKGROUND_ROUTE), ('method', 'sendMessage'))],
+            1,
+        )
+
+    def test_outbox_send_is_labeled_with_enqueuing_route(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        queue = Outbox(os.path.join(directory.name, 'outbox.sqlite3'))
+        self.addCleanup(queue.close)
+        bot = TimedBot()
+        sender = OutboxSender(queue, bot, global_rate=1000)
+        self.addCleanup(sender._executor.shutdown)
+
+        with mock.patch.object(outbox, '_outbox', queue), routes.handling('start'):
+            outbox.send_message(bot, 1, 'a')
+        self.assertEqual(bot.request.urls, [])
+        sender.send_due()
+
+        counters = self.counters()
+        self.assertEqual(counters['bot_telegram_requests_total', (('route', 'start'), ('method', 'sendMessage'))], 1)
+
+    @override_settings(METRICS_TOKEN='token', BOT_METRICS_FILE='')
+    def test_view_requires_token(self):
+        self.registry.inc('bot_telegram_requests_total', (('route', 'start'), ('method', 'sendMessage')))
+
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        self.assertEqual(self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer token')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(
+            'bot_telegram_requests_total{process="web",route="start",method="sendMessage"} 1.0',
+            response.content.decode(),
+        )
+
+
+class ProfilerTests(SimpleTestCase):
+
+    def setUp(self):
+        self.profiler = Profiler(sample_every=2, memory_interval=3600)
+        self.addCleanup(self.profiler.stop)
+
+    def test_disabled_profiler_only_calls_handler(self):
+        self.assertEqual(self.profiler.run('start', lambda update, context: 'done', None, None), 'done')
+        self.assertEqual(self.profiler._samples, {})
+
+    def test_profiles_every_nth_update(self):
+        self.profiler.start()
+        for _ in range(4):
+            self.profiler.run('start', lambda update, context: sum(range(100)), None, None)
+
+        self.assertEqual(self.profiler._samples, {'start': 2})
+        self.assertEqual(self.profiler._running, {})
+        self.assertIn('start: 2', self.profiler.status())
+
+    def test_handler_runs_when_profile_cannot_be_enabled(self):
+        self.profiler.start()
+        profile = mock.Mock(**{'enable.side_effect': ValueError('Another profiling tool is already active')})
+
+        with mock.patch('bot.profiling.cProfile.Profile', return_value=profile), \
+                self.assertLogs('bot.profiling', 'WARNING'):
+            result = self.profiler.run('start', lambda update, context: 'done', None, None)
+
+        self.assertEqual(result, 'done')
+        self.assertEqual(self.profiler._running, {})
+        self.assertEqual(self.profiler._samples, {})
+        profile.disable.assert_not_called()
+
+    def test_handler_error_still_records_sample(self):
+        self.profiler.start()
+
+        def start(update, context):
+            raise ValueError('boom')
+
+        with self.assertRaises(ValueError):
+            self.profiler.run('start', start, None, None)
+
+        self.assertEqual(self.profiler._samples, {'start': 1})
+        self.assertEqual(self.profiler._running, {})
+
+    def test_toggle_dumps_report(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.profiler.user_data = {1: {'box': 'x' * 100}, 2: {}}
+
+        self.assertIsNone(self.profiler.toggle(directory.name))
+        self.profiler.run('start', lambda update, context: None, None, None)
+        path = self.profiler.toggle(directory.name)
+
+        self.assertFalse(self.profiler.enabled)
+        self.assertEqual(
+            sorted(os.listdir(path)),
+            ['memory.txt', 'slow_queries.txt', 'stacks.txt', 'start.prof', 'start.txt'],
+        )
+        with open(os.path.join(path, 'memory.txt')) as file:
+            self.assertIn('Largest user_data:\n1\t', file.read())
+
+    def test_user_data_summary(self):
+        large = {'b': 'x' * 50, 'c': 2}
+        summary = user_data_summary({1: {'a': 1}, 2: large}, top=1)
+
+        self.assertEqual(summary['users'], 2)
+        self.assertEqual(summary['bytes'], len(json.dumps({'a': 1})) + len(json.dumps(large)))
+        self.assertEqual(summary['largest'], [{'user_id': 2, 'bytes': len(json.dumps(large)), 'keys': 2}])
+
+    def test_instrument_dispatcher_wraps_handlers(self):
+        def start(update, context):
+            return 'done'
+
+        handler = SimpleNamespace(callback=start)
+        dispatcher = SimpleNamespace(handlers={0: [handler]}, user_data={}, error_handlers={})
+
+        with mock.patch.object(profiling, 'profiler', self.profiler):
+            profiling.instrument_dispatcher(dispatcher)
+            self.assertIs(handler.callback.__wrapped__, start)
+            self.assertEqual(handler.callback(None, None), 'done')
+        self.assertIs(self.profiler.user_data, dispatcher.user_data)
@@ -1,3 +1,47 @@
-from django.shortcuts import render
+import hmac
+import json
 
-# Create your views here.
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+from telegram import Update
+
+from bot import metrics
+from bot.webhook import get_dispatcher
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+@csrf_exempt
+@require_POST
+def telegram_webhook(request):
+    secret = settings.TELEGRAM_WEBHOOK_SECRET
+    received_secret = request.headers.get(SECRET_TOKEN_HEADER, '')
+    if not secret or not hmac.compare_digest(received_secret, secret):
+        return HttpResponseForbidden()
+
+    try:
+        update_json = json.loads(request.body)
+    except ValueError:
+        return HttpResponseBadRequest()
+
+    dispatcher = get_dispatcher()
+    dispatcher.process_update(Update.de_json(update_json, dispatcher.bot))
+    return HttpResponse()
+
+
+@require_GET
+def metrics_view(request):
+    """Метрики обработчиков в формате Prometheus: webhook в этом процессе и процесс бота из файла."""
+    token = settings.METRICS_TOKEN
+    authorization = request.headers.get('Authorization', '')
+    if not request.user.is_staff and not (token and hmac.compare_digest(authorization, f'Bearer {token}')):
+        return HttpResponseForbidden()
+
+    snapshots = {'web': metrics.registry.snapshot()}
+    if settings.BOT_METRICS_FILE:
+        bot_snapshot = metrics.read_snapshot(settings.BOT_METRICS_FILE)
+        if bot_snapshot:
+            snapshots['bot'] = bot_snapshot
+    return HttpResponse(metrics.render(snapshots), content_type='text/plain; version=0.0.4; charset=utf-8')
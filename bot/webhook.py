@@ -0,0 +1,55 @@
+import atexit
+import threading
+from queue import Queue
+
+from django.conf import settings
+from telegram import Bot
+from telegram.ext import Dispatcher
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def create_dispatcher(bot, workers=0, send_outbox=False):
+    """Диспетчер с обработчиками бота.
+
+    send_outbox - отправлять Outbox из этого процесса. Отправитель должен
+    быть один на все процессы: строки очереди не закрепляются за ним,
+    и лимиты Telegram он соблюдает только в своем процессе.
+    """
+    from bot.bot import register_handlers
+    from bot.concurrency import ChatWorkerPool, dispatch_by_chat
+    from bot.outbox import OutboxSender, configure_outbox
+    from bot.rendering import load_templates
+    from bot.sessions import SQLitePersistence, refresh_sessions
+
+    load_templates()
+    persistence = None
+    if settings.BOT_SESSIONS_DB:
+        # апдейты одного чата могут прийти в разные процессы Django
+        persistence = SQLitePersistence(settings.BOT_SESSIONS_DB, shared=True)
+        atexit.register(persistence.flush)
+    if settings.BOT_OUTBOX_DB:
+        outbox = configure_outbox(settings.BOT_OUTBOX_DB)
+        if send_outbox:
+            OutboxSender(outbox, bot).start()
+    dispatcher = Dispatcher(bot, Queue(), workers=0, persistence=persistence)
+    register_handlers(dispatcher)
+    if persistence:
+        refresh_sessions(dispatcher)
+    if workers:
+        dispatch_by_chat(dispatcher, ChatWorkerPool(workers))
+    return dispatcher
+
+
+def get_dispatcher():
+    """Диспетчер бота для приема апдейтов через webhook, один на процесс.
+
+    Ответы только ставятся в Outbox, отправляет их процесс BOT_MODE=webhook bot/bot.py.
+    """
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            bot = Bot(settings.TELEGRAM_TOKEN, base_url=settings.TELEGRAM_API_URL)
+            _dispatcher = create_dispatcher(bot, workers=settings.BOT_WORKERS)
+    return _dispatcher
@@ -13,6 +13,8 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 from pathlib import Path
 from environs import Env
 
+from django.core.exceptions import ImproperlyConfigured
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -51,6 +53,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'self_storage.slow_queries.SlowQueryOriginMiddleware',
 ]
 
 ROOT_URLCONF = 'self_storage.urls'
@@ -77,13 +80,65 @@ WSGI_APPLICATION = 'self_storage.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
+# Бот и админка пишут в один файл SQLite. Профиль production включает WAL,
+# чтобы чтение не блокировало запись, начинает транзакции с BEGIN IMMEDIATE
+# и держит соединения открытыми. PRAGMA выполняются на каждом новом
+# соединении (self_storage/sqlite/base.py).
+SQLITE_PROFILES = {
+    'default': {
+        'pragmas': {},
+        'transaction_mode': None,
+        'timeout': 5,
+        'conn_max_age': 0,
+    },
+    'production': {
+        'pragmas': {
+            'journal_mode': 'WAL',
+            'synchronous': env.str('SQLITE_SYNCHRONOUS', 'NORMAL'),
+            'mmap_size': env.int('SQLITE_MMAP_SIZE', 256 * 1024 * 1024),
+            # отрицательное значение - размер в КиБ, а не в страницах
+            'cache_size': env.int('SQLITE_CACHE_SIZE', -64 * 1024),
+            'temp_store': 'MEMORY',
+        },
+        'transaction_mode': 'IMMEDIATE',
+        'timeout': 20,
+        'conn_max_age': 600,
+    },
+}
+SQLITE_PROFILE = env.str('SQLITE_PROFILE', 'default')
+if SQLITE_PROFILE not in SQLITE_PROFILES:
+    raise ImproperlyConfigured(f'Unknown SQLITE_PROFILE {SQLITE_PROFILE!r}, expected one of {list(SQLITE_PROFILES)}')
+sqlite_profile = SQLITE_PROFILES[SQLITE_PROFILE]
+
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        'ENGINE': 'self_storage.sqlite',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'CONN_MAX_AGE': env.int('DB_CONN_MAX_AGE', sqlite_profile['conn_max_age']),
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            # busy timeout: сколько ждать снятия блокировки, прежде чем выдать "database is locked"
+            'timeout': env.float('SQLITE_BUSY_TIMEOUT', sqlite_profile['timeout']),
+            'transaction_mode': sqlite_profile['transaction_mode'],
+            'init_command': ';'.join(f'PRAGMA {name} = {value}' for name, value in sqlite_profile['pragmas'].items()),
+        },
     }
 }
 
+# запросы дольше стольких миллисекунд пишутся в лог с планом (self_storage/slow_queries.py), 0 отключает
+SLOW_QUERY_MS = env.int('SLOW_QUERY_MS', 100)
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'self_storage.slow_queries': {'handlers': ['console'], 'level': 'INFO', 'propagate': False},
+    },
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -126,3 +181,26 @@ STATIC_ROOT = 'static'
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Telegram bot
+
+TELEGRAM_TOKEN = env.str('TELEGRAM_TOKEN', '')
+# None означает официальный https://api.telegram.org/bot
+TELEGRAM_API_URL = env.str('TELEGRAM_API_URL', None)
+# должен совпадать с secret_token, переданным в setWebhook
+TELEGRAM_WEBHOOK_SECRET = env.str('TELEGRAM_WEBHOOK_SECRET', '')
+# число потоков ChatWorkerPool, 0 - обработка в потоке диспетчера
+BOT_WORKERS = env.int('BOT_WORKERS', 0)
+# SQLite файл для состояния диалогов, пустая строка отключает сохранение
+BOT_SESSIONS_DB = env.str('BOT_SESSIONS_DB', str(BASE_DIR / 'bot_sessions.sqlite3'))
+# SQLite файл очереди исходящих сообщений, пустая строка - отправка прямо из обработчика
+BOT_OUTBOX_DB = env.str('BOT_OUTBOX_DB', str(BASE_DIR / 'bot_outbox.sqlite3'))
+# за сколько дней до конца оплаты напоминать клиенту, 0 отключает напоминания
+BOT_REMINDER_LEAD_DAYS = env.int('BOT_REMINDER_LEAD_DAYS', 3)
+# куда процесс бота сохраняет метрики для /metrics, пустая строка отключает
+BOT_METRICS_FILE = env.str('BOT_METRICS_FILE', str(BASE_DIR / 'bot_metrics.json'))
+# папка отчетов профилирования бота (/profile, kill -USR1)
+BOT_PROFILE_DIR = env.str('BOT_PROFILE_DIR', str(BASE_DIR / 'bot_profiles'))
+# Bearer токен для сборщика метрик, без него /metrics доступна только персоналу
+METRICS_TOKEN = env.str('METRICS_TOKEN', '')
@@ -0,0 +1,228 @@
+"""Журнал медленных запросов к БД для бота и админки.
+
+Время запросов меряет курсор бэкенда self_storage.sqlite: execute
+вместе со всеми fetch, потому что SQLite до первой строки почти ничего
+не делает, а сканирование таблицы идет во время чтения. Все запросы
+суммируются по нормализованному SQL (литералы и списки IN заменены на ?),
+а запросы дольше SLOW_QUERY_MS пишутся в лог вместе с EXPLAIN QUERY PLAN,
+источником (обработчик бота или адрес админки) и коротким стеком вызова.
+"""
+import functools
+import logging
+import os
+import re
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# суммы копятся окнами, top() показывает текущее и предыдущее окно
+WINDOW_SECONDS = 3600
+TOP_STATEMENTS = 20
+# новые запросы после этого числа разных SQL в окне не учитываются
+MAX_STATEMENTS = 2000
+STACK_FRAMES = 6
+# bulk_create дает SQL на сотни килобайт, в лог идет начало
+LOGGED_SQL_CHARS = 2000
+LOGGED_PARAMS_CHARS = 500
+PLAN_STATEMENTS = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE')
+
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+PLACEHOLDER_LIST = re.compile(r'\((?:\s*\?\s*,)+\s*\?\s*\)')
+REPEATED_LIST = re.compile(r'\(\.\.\.\)(?:, \(\.\.\.\))+')
+WHITESPACE = re.compile(r'\s+')
+
+PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SKIPPED_FILES = (os.path.abspath(__file__), os.path.join(PROJECT_PATH, 'self_storage', 'sqlite'))
+
+_local = threading.local()
+
+
+@functools.lru_cache(maxsize=4096)
+def normalize_sql(sql):
+    """SQL без конкретных значений: одинаковые запросы с разными параметрами совпадают."""
+    sql = STRING_LITERAL.sub('?', sql.replace('%s', '?'))
+    sql = NUMBER.sub('?', sql)
+    sql = PLACEHOLDER_LIST.sub('(...)', sql)
+    sql = WHITESPACE.sub(' ', sql).strip()
+    return REPEATED_LIST.sub('(...), ...', sql)
+
+
+def shorten(text, limit):
+    if len(text) <= limit:
+        return text
+    return f'{text[:limit]}... ({len(text)} chars)'
+
+
+@contextmanager
+def origin(name):
+    """Источник запросов в этом потоке: обработчик бота или запрос админки."""
+    previous = getattr(_local, 'origin', None)
+    _local.origin = name
+    try:
+        yield
+    finally:
+        _local.origin = previous
+
+
+def stack_summary():
+    """Последние кадры кода проекта, без Django и библиотек."""
+    frames = [
+        frame for frame in traceback.extract_stack()
+        if frame.filename.startswith(PROJECT_PATH) and not frame.filename.startswith(SKIPPED_FILES)
+    ]
+    return ' <- '.join(
+        f'{os.path.relpath(frame.filename, PROJECT_PATH)}:{frame.lineno} {frame.name}'
+        for frame in reversed(frames[-STACK_FRAMES:])
+    )
+
+
+def explain(connection, sql, params):
+    """План запроса: EXPLAIN QUERY PLAN для SQLite, EXPLAIN для остальных БД."""
+    prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+    # курсор без оберток Django: план не попадает в метрики обработчика
+    cursor = connection.create_cursor()
+    try:
+        cursor.execute(prefix + sql, params)
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+    if connection.vendor != 'sqlite':
+        return '\n'.join(' '.join(map(str, row)) for row in rows)
+    depths = {0: -1}
+    lines = []
+    for node_id, parent_id, _, detail in rows:
+        depths[node_id] = depths.get(parent_id, -1) + 1
+        lines.append('  ' * depths[node_id] + detail)
+    return '\n'.join(lines)
+
+
+class Statement:
+    __slots__ = ('count', 'seconds', 'max_seconds', 'slow', 'plan', 'origin')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.slow = 0
+        self.plan = None
+        self.origin = None
+
+    def merge(self, other):
+        merged = Statement()
+        merged.count = self.count + other.count
+        merged.seconds = self.seconds + other.seconds
+        merged.max_seconds = max(self.max_seconds, other.max_seconds)
+        merged.slow = self.slow + other.slow
+        merged.plan = other.plan or self.plan
+        merged.origin = other.origin or self.origin
+        return merged
+
+
+class SlowQueryLog:
+    """Суммы по нормализованному SQL за скользящее окно и запись медленных запросов в лог."""
+
+    def __init__(self, threshold, window=WINDOW_SECONDS):
+        self.threshold = threshold
+        self.window = window
+        self._lock = threading.Lock()
+        self._current = {}
+        self._previous = {}
+        self._window_started = time.monotonic()
+
+    def record(self, connection, sql, params, many, seconds):
+        """Учитывает выполненный запрос, connection - DatabaseWrapper для EXPLAIN."""
+        if getattr(_local, 'inside', False):
+            return
+        _local.inside = True
+        try:
+            self._record(connection, sql, params, many, seconds)
+        finally:
+            _local.inside = False
+
+    def _record(self, connection, sql, params, many, seconds):
+        normalized = normalize_sql(sql)
+        with self._lock:
+            self._rotate()
+            statement = self._current.get(normalized)
+            if statement is None:
+                if len(self._current) >= MAX_STATEMENTS:
+                    return
+                statement = self._current[normalized] = Statement()
+            statement.count += 1
+            statement.seconds += seconds
+            statement.max_seconds = max(statement.max_seconds, seconds)
+            if seconds < self.threshold:
+                return
+            statement.slow += 1
+            statement.origin = getattr(_local, 'origin', None)
+            previous = self._previous.get(normalized)
+            plan = statement.plan or (previous.plan if previous else None)
+
+        # план и стек только для медленных, план один раз на SQL в окне
+        if plan is None and not many and sql.lstrip().upper().startswith(PLAN_STATEMENTS):
+            try:
+                plan = explain(connection, sql, params)
+            except Exception as error:
+                plan = f'EXPLAIN failed: {error}'
+            statement.plan = plan
+        logger.warning(
+            'Slow query %.1f ms from %s\n%s\nParams: %s\nPlan:\n%s\nStack: %s',
+            seconds * 1000, statement.origin or '-', shorten(sql, LOGGED_SQL_CHARS),
+            shorten(repr(params), LOGGED_PARAMS_CHARS) if not many else '(executemany)',
+            plan or '-', stack_summary(),
+        )
+
+    def _rotate(self):
+        now = time.monotonic()
+        if now - self._window_started < self.window:
+            return
+        if self._current:
+            logger.info('Top queries for the last %d s:\n%s', self.window,
+                        self.format_top(self._top(self._current, TOP_STATEMENTS)))
+        self._previous, self._current = self._current, {}
+        self._window_started = now
+
+    @staticmethod
+    def _top(statements, limit):
+        return sorted(statements.items(), key=lambda item: item[1].seconds, reverse=True)[:limit]
+
+    def top(self, limit=TOP_STATEMENTS):
+        """Самые затратные по суммарному времени запросы за текущее и предыдущее окно."""
+        with self._lock:
+            merged = dict(self._previous)
+            for sql, statement in self._current.items():
+                merged[sql] = merged[sql].merge(statement) if sql in merged else statement
+            return self._top(merged, limit)
+
+    @staticmethod
+    def format_top(top):
+        lines = []
+        for sql, statement in top:
+            lines.append(
+                f'{statement.seconds * 1000:.0f} ms total, {statement.count} calls, '
+                f'max {statement.max_seconds * 1000:.1f} ms, slow {statement.slow}'
+                f'{f", last from {statement.origin}" if statement.origin else ""}\n  {sql}'
+            )
+            if statement.plan:
+                lines.append('  ' + statement.plan.replace('\n', '\n  '))
+        return '\n'.join(lines)
+
+
+slow_query_log = SlowQueryLog(settings.SLOW_QUERY_MS / 1000)
+
+
+class SlowQueryOriginMiddleware:
+    """Отмечает запросы к БД из админки и выгрузок методом и адресом страницы."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with origin(f'{request.method} {request.path}'):
+            return self.get_response(request)
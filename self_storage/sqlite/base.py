@@ -0,0 +1,104 @@
+import time
+
+from django.conf import settings
+from django.db.backends.sqlite3 import base
+
+from self_storage.slow_queries import slow_query_log
+
+
+class SlowQueryCursorWrapper(base.SQLiteCursorWrapper):
+    """Курсор, который меряет запрос вместе с чтением результата.
+
+    Запрос попадает в журнал медленных запросов при закрытии курсора
+    или следующем execute: к этому моменту строки уже прочитаны.
+    """
+
+    db = None
+    _query = None
+
+    def execute(self, query, params=None):
+        self._record()
+        started = time.perf_counter()
+        try:
+            return super().execute(query, params)
+        finally:
+            self._query = [query, params, False, time.perf_counter() - started]
+
+    def executemany(self, query, param_list):
+        self._record()
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, param_list)
+        finally:
+            self._query = [query, None, True, time.perf_counter() - started]
+
+    def fetchone(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            self._add_fetch_time(started)
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        try:
+            return super().fetchmany(self.arraysize if size is None else size)
+        finally:
+            self._add_fetch_time(started)
+
+    def fetchall(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            self._add_fetch_time(started)
+
+    def close(self):
+        self._record()
+        return super().close()
+
+    def _add_fetch_time(self, started):
+        if self._query is not None:
+            self._query[3] += time.perf_counter() - started
+
+    def _record(self):
+        if self._query is not None:
+            query, self._query = self._query, None
+            slow_query_log.record(self.db, *query)
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """Бэкенд SQLite с опциями init_command и transaction_mode, как в Django 5.1.
+
+    init_command - PRAGMA через ";", выполняются на каждом новом соединении.
+    transaction_mode - режим BEGIN для transaction.atomic. С IMMEDIATE
+    транзакция сразу берет блокировку записи и ждет ее в пределах timeout,
+    а не получает "database is locked" при попытке записать после чтения.
+    Если задан SLOW_QUERY_MS, курсоры учитываются в журнале медленных запросов.
+    """
+
+    transaction_mode = None
+
+    def create_cursor(self, name=None):
+        if not settings.SLOW_QUERY_MS:
+            return super().create_cursor(name)
+        cursor = self.connection.cursor(factory=SlowQueryCursorWrapper)
+        cursor.db = self
+        return cursor
+
+    def get_new_connection(self, conn_params):
+        conn_params = dict(conn_params)
+        init_command = conn_params.pop('init_command', '')
+        self.transaction_mode = conn_params.pop('transaction_mode', None)
+        conn = super().get_new_connection(conn_params)
+        for command in init_command.split(';'):
+            command = command.strip()
+            if command:
+                conn.execute(command)
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        if self.transaction_mode is None:
+            self.cursor().execute('BEGIN')
+        else:
+            self.cursor().execute(f'BEGIN {self.transaction_mode}')
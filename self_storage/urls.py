@@ -19,6 +19,12 @@ from django.urls import path
 from django.conf import settings
 from django.conf.urls.static import static
 
+from bot.views import metrics_view, telegram_webhook
+from storage.views import export_rows
+
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('telegram/webhook/', telegram_webhook, name='telegram_webhook'),
+    path('metrics', metrics_view, name='metrics'),
+    path('export/<str:name>.<str:export_format>', export_rows, name='export_rows'),
 ] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
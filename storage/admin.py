@@ -1,8 +1,192 @@
-from django.contrib import admin
+from datetime import datetime
 
-from .models import User, Box, TransferRequest, Promocodes
+from django import forms
+from django.contrib import admin, messages
+from django.contrib.admin.helpers import ActionForm
+from django.core.paginator import Paginator
+from django.db.models import Max, Min, Q, QuerySet
+from django.utils import timezone
+from django.utils.functional import cached_property
 
-admin.site.register(User)
-admin.site.register(Box)
-admin.site.register(TransferRequest)
-admin.site.register(Promocodes)
\ No newline at end of file
+from . import bulk
+from .analytics import get_latest_stats
+from .models import User, Box, TransferRequest, Promocodes, StorageDailyStats
+
+
+class EstimatedCountPaginator(Paginator):
+    """Для списка без фильтров вместо COUNT(*) берет максимальный id.
+
+    MAX(id) читается по первичному ключу за один шаг, а COUNT(*) в SQLite
+    обходит всю таблицу. После удалений оценка завышена, поэтому последние
+    страницы могут оказаться пустыми. С фильтрами и поиском считается
+    точно - такие выборки идут по индексам.
+    """
+
+    @cached_property
+    def count(self):
+        if self.object_list.query.where:
+            return super().count
+        return self.object_list.model._default_manager.aggregate(max_id=Max('pk'))['max_id'] or 0
+
+
+class YearRangeQuerySet(QuerySet):
+    """Годы для date_hierarchy по MIN/MAX поля вместо DISTINCT по всей таблице.
+
+    MIN и MAX индексированного поля читаются по индексу, а DISTINCT по
+    году вычисляет функцию для каждой строки. В списке могут оказаться
+    годы без записей.
+    """
+
+    def datetimes(self, field_name, kind, *args, **kwargs):
+        if kind != 'year':
+            return super().datetimes(field_name, kind, *args, **kwargs)
+        date_range = self.aggregate(first=Min(field_name), last=Max(field_name))
+        if date_range['first'] is None:
+            return []
+        first = timezone.localtime(date_range['first']).year
+        last = timezone.localtime(date_range['last']).year
+        return [datetime(year, 1, 1, tzinfo=timezone.get_current_timezone()) for year in range(first, last + 1)]
+
+
+class BoxActionForm(ActionForm):
+    """Параметры массовых действий над боксами рядом со списком действий."""
+
+    months = forms.IntegerField(label='Месяцев', min_value=1, initial=1, required=False)
+    promo = forms.ModelChoiceField(Promocodes.objects.order_by('name'), label='Промокод', required=False)
+
+
+def prefix_search(field, term):
+    """Поиск по началу строки диапазоном, чтобы SQLite шел по индексу, а не по LIKE.
+
+    Сравнение с учетом регистра и только с начала: "ivan" не найдет
+    "Ivanov" и "mr_ivan", поэтому об этом сказано в search_help_text.
+    """
+    return Q(**{f'{field}__gte': term, f'{field}__lt': term + '\U0010ffff'})
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    # иначе на каждой странице списка выполняется еще и COUNT(*) по всей таблице
+    show_full_result_count = False
+
+
+@admin.register(User)
+class UserAdmin(LargeTableAdmin):
+    list_display = ('tg_username', 'chat_id', 'phone', 'utm_source', 'from_owner')
+    # число ищется как chat_id или id, текст - по началу никнейма
+    search_fields = ('tg_username',)
+    search_help_text = 'ID чата, ID клиента или начало никнейма с учетом регистра ("Iva" найдет Ivanov, "iva" - нет)'
+
+    def get_search_results(self, request, queryset, search_term):
+        search_term = search_term.strip().lstrip('@')
+        if not search_term:
+            return queryset, False
+        if search_term.isdigit():
+            return queryset.filter(Q(chat_id=int(search_term)) | Q(pk=int(search_term))), False
+        return queryset.filter(prefix_search('tg_username', search_term)), False
+
+
+@admin.register(Box)
+class BoxAdmin(LargeTableAdmin):
+    list_display = ('id', 'user', 'paid_from', 'paid_till', 'weight', 'volume', 'price', 'discount')
+    # Box.__str__ и колонка user обращаются к клиенту
+    list_select_related = ('user',)
+    date_hierarchy = 'paid_till'
+    autocomplete_fields = ('user',)
+    search_fields = ('user__tg_username',)
+    search_help_text = 'Номер бокса, ID чата или начало никнейма клиента с учетом регистра'
+    action_form = BoxActionForm
+    actions = ('extend_rentals', 'apply_promo')
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        return YearRangeQuerySet(model=self.model, query=queryset.query, using=queryset.db)
+
+    def get_search_results(self, request, queryset, search_term):
+        search_term = search_term.strip().lstrip('@')
+        if not search_term:
+            return queryset, False
+        if search_term.isdigit():
+            return queryset.filter(Q(pk=int(search_term)) | Q(user__chat_id=int(search_term))), False
+        return queryset.filter(prefix_search('user__tg_username', search_term)), False
+
+    def get_action_params(self, request):
+        form = self.action_form(request.POST)
+        form.fields['action'].choices = self.get_action_choices(request)
+        return form.cleaned_data if form.is_valid() else None
+
+    @admin.action(description='Продлить аренду на N месяцев', permissions=['change'])
+    def extend_rentals(self, request, queryset):
+        params = self.get_action_params(request)
+        if not params or not params['months']:
+            self.message_user(request, 'Укажите, на сколько месяцев продлить аренду', messages.ERROR)
+            return
+        count = bulk.extend_rentals(queryset, params['months'])
+        self.message_user(request, f'Продлено боксов: {count} на {params["months"]} мес.', messages.SUCCESS)
+
+    @admin.action(description='Применить промокод', permissions=['change'])
+    def apply_promo(self, request, queryset):
+        params = self.get_action_params(request)
+        if not params or not params['promo']:
+            self.message_user(request, 'Выберите промокод', messages.ERROR)
+            return
+        promo = params['promo']
+        try:
+            count = bulk.apply_promo(queryset, promo)
+        except ValueError:
+            self.message_user(request, f'Промокод {promo.name} сейчас не действует, скидка не применена',
+                              messages.ERROR)
+            return
+        self.message_user(request, f'Промокод {promo.name} применен к боксам: {count}', messages.SUCCESS)
+
+
+@admin.register(TransferRequest)
+class TransferRequestAdmin(LargeTableAdmin):
+    list_display = ('id', 'box', 'transfer_type', 'time_arrive', 'address', 'is_complete')
+    # колонка box выводит Box.__str__, а он - никнейм клиента
+    list_select_related = ('box__user',)
+    list_filter = ('is_complete', 'transfer_type')
+    raw_id_fields = ('box',)
+    search_fields = ('box__id',)
+    search_help_text = 'Номер заявки или бокса'
+    actions = ('complete_transfers',)
+
+    def get_search_results(self, request, queryset, search_term):
+        search_term = search_term.strip()
+        if not search_term.isdigit():
+            return queryset.none() if search_term else queryset, False
+        return queryset.filter(Q(pk=int(search_term)) | Q(box_id=int(search_term))), False
+
+    @admin.action(description='Отметить выполненными', permissions=['change'])
+    def complete_transfers(self, request, queryset):
+        count = bulk.complete_transfers(queryset)
+        self.message_user(request, f'Отмечено выполненными: {count}', messages.SUCCESS)
+
+
+@admin.register(Promocodes)
+class PromocodesAdmin(admin.ModelAdmin):
+    list_display = ('name', 'discount', 'valid_from', 'valid_till')
+
+
+@admin.register(StorageDailyStats)
+class StorageDailyStatsAdmin(admin.ModelAdmin):
+    list_display = (
+        'date', 'boxes', 'clients', 'occupied_volume', 'occupied_weight', 'revenue',
+        'started_boxes', 'ended_boxes', 'lost_clients', 'expiring_boxes', 'expiring_volume',
+    )
+    date_hierarchy = 'date'
+    ordering = ('-date',)
+
+    def changelist_view(self, request, extra_context=None):
+        # сводки только читаются, устаревшая таблица пересчитывается в фоне
+        get_latest_stats()
+        return super().changelist_view(request, extra_context)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
@@ -0,0 +1,209 @@
+"""Загрузка склада, выручка и отток клиентов по дням.
+
+Колонки Box читаются одним проходом в массивы numpy, дальше все считается
+векторно: интервалы аренды превращаются в разностные массивы по дням,
+а суммы по дням - в их накопленную сумму. Результат кэшируется в таблице
+StorageDailyStats, отчеты читают только ее, а устаревшую таблицу
+пересчитывает фоновый поток или команда refresh_storage_stats.
+"""
+import logging
+import threading
+from collections import namedtuple
+from datetime import date, timedelta
+
+import numpy as np
+from django.db import connection, transaction
+from django.db.models import Sum
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+
+from storage.models import Box, StorageDailyStats
+
+logger = logging.getLogger(__name__)
+
+# месяц аренды в боте - 30 дней
+DAYS_PER_MONTH = 30
+EXPIRING_WINDOW_DAYS = 7
+CHURN_WINDOW_DAYS = 30
+STATS_MAX_AGE = timedelta(hours=1)
+LOAD_CHUNK_SIZE = 10000
+SECONDS_PER_DAY = 86400
+
+BoxArrays = namedtuple('BoxArrays', 'user_id weight volume start_day end_day daily_revenue')
+
+
+def _to_days(datetimes, utc_offset):
+    timestamps = np.fromiter((value.timestamp() for value in datetimes), dtype=float, count=len(datetimes))
+    return np.floor((timestamps + utc_offset) / SECONDS_PER_DAY).astype(np.int64)
+
+
+def _chunk_arrays(chunk, utc_offset):
+    user_ids, weights, volumes, paid_from, paid_till, prices = zip(*chunk)
+    # в price уже цена со скидкой промокода
+    monthly_price = np.nan_to_num(np.array(prices, dtype=float))
+    return BoxArrays(
+        user_id=np.array(user_ids, dtype=np.int64),
+        weight=np.nan_to_num(np.array(weights, dtype=float)),
+        volume=np.nan_to_num(np.array(volumes, dtype=float)),
+        start_day=_to_days(paid_from, utc_offset),
+        end_day=_to_days(paid_till, utc_offset),
+        daily_revenue=monthly_price / DAYS_PER_MONTH,
+    )
+
+
+def load_box_arrays(queryset=None, chunk_size=LOAD_CHUNK_SIZE):
+    """Читает боксы с известным сроком аренды в массивы, дни - порядковые номера дат.
+
+    Бокс занимает склад с дня paid_from включительно до дня paid_till.
+    """
+    if queryset is None:
+        queryset = Box.objects.all()
+    rows = queryset.filter(paid_from__isnull=False, paid_till__isnull=False) \
+        .values_list('user_id', 'weight', 'volume', 'paid_from', 'paid_till', 'price') \
+        .order_by()
+    # дни считаются в текущем часовом поясе проекта, date.toordinal() отсчитывает от 1 января 1 года
+    utc_offset = timezone.localtime().utcoffset().total_seconds() + date(1970, 1, 1).toordinal() * SECONDS_PER_DAY
+
+    chunks = []
+    chunk = []
+    for row in rows.iterator(chunk_size=chunk_size):
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            chunks.append(_chunk_arrays(chunk, utc_offset))
+            chunk = []
+    if chunk:
+        chunks.append(_chunk_arrays(chunk, utc_offset))
+    if not chunks:
+        return None
+    arrays = BoxArrays(*(np.concatenate(column) for column in zip(*chunks)))
+    valid = arrays.end_day > arrays.start_day
+    return BoxArrays(*(column[valid] for column in arrays))
+
+
+def _interval_sum(start, end, days, weights=None):
+    """Сумма weights по интервалам [start, end) для каждого из days дней."""
+    start = np.clip(start, 0, days)
+    end = np.clip(end, 0, days)
+    delta = np.bincount(start, weights, minlength=days + 1) - np.bincount(end, weights, minlength=days + 1)
+    return np.cumsum(delta)[:days]
+
+
+def _count_on_day(day, days):
+    """Число событий в каждый из days дней."""
+    return np.bincount(day[(day >= 0) & (day < days)], minlength=days)
+
+
+def _sum_in_next_days(day, days, window, weights=None):
+    """Сумма weights по событиям в окне (d, d + window] для каждого дня d."""
+    size = days + window + 1
+    day = np.clip(day, 0, size - 1)
+    cumulative = np.cumsum(np.bincount(day, weights, minlength=size))
+    return cumulative[window:days + window] - cumulative[:days]
+
+
+def compute_daily_stats(arrays, first_day, last_day, expiring_window=EXPIRING_WINDOW_DAYS):
+    """Считает дневные ряды с first_day по last_day включительно (порядковые номера дат)."""
+    days = last_day - first_day + 1
+    start = arrays.start_day - first_day
+    end = arrays.end_day - first_day
+
+    # клиент активен от начала первой аренды до конца последней
+    users, user_index = np.unique(arrays.user_id, return_inverse=True)
+    user_start = np.full(len(users), np.iinfo(np.int64).max)
+    user_end = np.full(len(users), np.iinfo(np.int64).min)
+    np.minimum.at(user_start, user_index, start)
+    np.maximum.at(user_end, user_index, end)
+
+    return {
+        'boxes': _interval_sum(start, end, days),
+        'clients': _interval_sum(user_start, user_end, days),
+        'occupied_volume': _interval_sum(start, end, days, arrays.volume),
+        'occupied_weight': _interval_sum(start, end, days, arrays.weight),
+        'revenue': _interval_sum(start, end, days, arrays.daily_revenue),
+        'started_boxes': _count_on_day(start, days),
+        'ended_boxes': _count_on_day(end, days),
+        'lost_clients': _count_on_day(user_end, days),
+        'expiring_boxes': _sum_in_next_days(end, days, expiring_window),
+        'expiring_volume': _sum_in_next_days(end, days, expiring_window, arrays.volume),
+    }
+
+
+def refresh_daily_stats(today=None):
+    """Пересчитывает StorageDailyStats с первого дня аренды по today, возвращает число дней."""
+    today = today or timezone.localdate()
+    arrays = load_box_arrays()
+    if arrays is None or not len(arrays.start_day):
+        StorageDailyStats.objects.all().delete()
+        return 0
+
+    first_day = int(arrays.start_day.min())
+    last_day = today.toordinal()
+    if first_day > last_day:
+        first_day = last_day
+    stats = compute_daily_stats(arrays, first_day, last_day)
+
+    computed_at = timezone.now()
+    columns = {name: values.round(2).tolist() for name, values in stats.items()}
+    rows = [
+        StorageDailyStats(
+            date=date.fromordinal(first_day + day),
+            computed_at=computed_at,
+            **{name: values[day] for name, values in columns.items()},
+        )
+        for day in range(last_day - first_day + 1)
+    ]
+    with transaction.atomic():
+        StorageDailyStats.objects.all().delete()
+        StorageDailyStats.objects.bulk_create(rows, batch_size=1000)
+    return len(rows)
+
+
+_refresh_lock = threading.Lock()
+
+
+def _refresh_in_thread():
+    try:
+        refresh_daily_stats()
+    except Exception:
+        logger.exception('Failed to refresh storage daily stats')
+    finally:
+        connection.close()
+        _refresh_lock.release()
+
+
+def refresh_in_background():
+    """Запускает пересчет в отдельном потоке, если он еще не идет; возвращает, запущен ли он."""
+    if not _refresh_lock.acquire(blocking=False):
+        return False
+    threading.Thread(target=_refresh_in_thread, name='storage-stats-refresh', daemon=True).start()
+    return True
+
+
+def get_latest_stats(max_age=STATS_MAX_AGE):
+    """Последняя посчитанная сводка или None.
+
+    Если таблица старше max_age или без сегодняшнего дня, пересчет
+    запускается в фоне, а вызывающий сразу получает прежнюю сводку.
+    """
+    latest = StorageDailyStats.objects.order_by('-date').first()
+    if latest is None or latest.date < timezone.localdate() or latest.computed_at < timezone.now() - max_age:
+        refresh_in_background()
+    return latest
+
+
+def get_monthly_revenue(months=6):
+    """Выручка по месяцам из StorageDailyStats, последние months месяцев по возрастанию."""
+    revenue = StorageDailyStats.objects.annotate(month=TruncMonth('date')) \
+        .values('month').annotate(revenue=Sum('revenue')).order_by('-month')[:months]
+    return list(reversed(revenue))
+
+
+def get_churn(latest, days=CHURN_WINDOW_DAYS):
+    """Доля клиентов days дней назад, у которых с тех пор закончилась последняя аренда."""
+    since = latest.date - timedelta(days=days)
+    clients = StorageDailyStats.objects.filter(date=since).values_list('clients', flat=True).first()
+    if not clients:
+        return None
+    lost = StorageDailyStats.objects.filter(date__gt=since, date__lte=latest.date) \
+        .aggregate(lost=Sum('lost_clients'))['lost'] or 0
+    return lost / clients
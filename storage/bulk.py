@@ -0,0 +1,50 @@
+"""Массовые операции над заявками и боксами одним UPDATE.
+
+Используются действиями админки и командами владельца в боте. Каждая
+функция принимает QuerySet выбранных строк, выполняется в одной
+транзакции и возвращает число измененных строк.
+"""
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import F, FloatField, IntegerField
+from django.db.models.functions import Cast, Now, Round
+
+from .analytics import DAYS_PER_MONTH
+from .models import Promocodes
+
+
+@transaction.atomic
+def complete_transfers(transfers):
+    """Отмечает заявки выполненными, уже выполненные не считаются."""
+    return transfers.filter(is_complete=False).update(is_complete=True)
+
+
+@transaction.atomic
+def extend_rentals(boxes, months):
+    """Сдвигает paid_till на months месяцев по 30 дней, как при оформлении бокса."""
+    if months <= 0:
+        raise ValueError(f'Rental can only be extended by a positive number of months, got {months}')
+    return boxes.filter(paid_till__isnull=False) \
+        .update(paid_till=F('paid_till') + timedelta(days=months * DAYS_PER_MONTH), updated_at=Now())
+
+
+@transaction.atomic
+def apply_promo(boxes, promo):
+    """Дает боксам скидку промокода, если она больше текущей.
+
+    Промокод должен действовать сейчас, как при вводе в боте, иначе ValueError.
+    В price хранится цена уже со скидкой, поэтому она пересчитывается
+    от цены без скидки: price * (100 - новая) / (100 - старая). Из-за
+    округления при оформлении цена может разойтись с ботом на рубль.
+    """
+    if not Promocodes.objects.active().filter(pk=promo.pk).exists():
+        raise ValueError(f'Promo code {promo.name!r} is not valid now')
+    discounted_price = Round(
+        Cast(F('price'), FloatField()) * (100 - promo.discount) / (100 - F('discount'))
+    )
+    return boxes.filter(discount__lt=promo.discount).update(
+        price=Cast(discounted_price, IntegerField()),
+        discount=promo.discount,
+        updated_at=Now(),
+    )
@@ -0,0 +1,126 @@
+"""Выгрузки боксов, клиентов и заявок в CSV и JSONL потоком.
+
+Строки читаются порциями по первичному ключу: каждая порция - отдельный
+запрос WHERE id > последний id LIMIT n. В отличие от одного курсора на
+всю выгрузку, такой запрос не держит блокировку чтения SQLite, пока
+медленный клиент скачивает файл, и память не зависит от числа строк.
+"""
+import csv
+import io
+from collections import namedtuple
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+from .models import Box, TransferRequest, User
+
+EXPORT_CHUNK_SIZE = 2000
+# фильтры-флажки включаются только этими значениями, ?overdue=0 фильтр не включает
+FLAG_FILTERS = ('overdue', 'incomplete')
+TRUE_VALUES = ('1', 'true', 'yes')
+# Excel и LibreOffice считают ячейку с такого символа формулой
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+Export = namedtuple('Export', 'model fields filters')
+
+EXPORTS = {
+    'boxes': Export(
+        Box,
+        ('id', 'user_id', 'user__tg_username', 'user__chat_id', 'user__phone', 'weight', 'volume',
+         'paid_from', 'paid_till', 'price', 'discount', 'description'),
+        {
+            # как в отчете владельца "Просроченные боксы"
+            'overdue': lambda boxes, value: boxes.filter(paid_till__lte=timezone.now()),
+            'utm_source': lambda boxes, value: boxes.filter(user__utm_source=value),
+        },
+    ),
+    'users': Export(
+        User,
+        ('id', 'tg_username', 'chat_id', 'phone', 'address', 'utm_source', 'from_owner'),
+        {
+            'utm_source': lambda users, value: users.filter(utm_source=value),
+        },
+    ),
+    'transfers': Export(
+        TransferRequest,
+        ('id', 'box_id', 'box__user__chat_id', 'transfer_type', 'address', 'time_arrive', 'is_complete'),
+        {
+            # как в отчете владельца "Заявки на перевозку"
+            'incomplete': lambda transfers, value: transfers.filter(is_complete=False),
+            'utm_source': lambda transfers, value: transfers.filter(box__user__utm_source=value),
+        },
+    ),
+}
+
+
+def filter_rows(export, params):
+    """QuerySet строк выгрузки с фильтрами из params, неизвестные параметры игнорируются."""
+    rows = export.model.objects.all()
+    for name, apply_filter in export.filters.items():
+        value = params.get(name)
+        if name in FLAG_FILTERS and (value or '').lower() not in TRUE_VALUES:
+            continue
+        if value:
+            rows = apply_filter(rows, value)
+    return rows
+
+
+def escape_csv_cell(value):
+    """Строка, которую табличный редактор принял бы за формулу, получает префикс '."""
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return f"'{value}"
+    return value
+
+
+def unescape_csv_cell(value):
+    """Обратное escape_csv_cell, для загрузки выгруженного CSV."""
+    if isinstance(value, str) and value.startswith("'") and value[1:].startswith(FORMULA_PREFIXES):
+        return value[1:]
+    return value
+
+
+def iter_row_chunks(queryset, fields, chunk_size=EXPORT_CHUNK_SIZE):
+    """Порции кортежей values_list по возрастанию id, каждая - отдельным запросом.
+
+    Первым в fields должен быть id: по нему продолжается следующая порция.
+    """
+    rows = queryset.order_by('pk').values_list(*fields)
+    last_id = None
+    while True:
+        chunk = list((rows if last_id is None else rows.filter(pk__gt=last_id))[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        if len(chunk) < chunk_size:
+            return
+        last_id = chunk[-1][0]
+
+
+def iter_csv(queryset, fields, chunk_size=EXPORT_CHUNK_SIZE):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush():
+        value = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return value
+
+    # заголовок уходит до первого запроса к БД
+    writer.writerow(fields)
+    yield flush()
+    for chunk in iter_row_chunks(queryset, fields, chunk_size):
+        writer.writerows([escape_csv_cell(value) for value in row] for row in chunk)
+        yield flush()
+
+
+def iter_jsonl(queryset, fields, chunk_size=EXPORT_CHUNK_SIZE):
+    encoder = DjangoJSONEncoder(ensure_ascii=False)
+    for chunk in iter_row_chunks(queryset, fields, chunk_size):
+        yield ''.join(f'{encoder.encode(dict(zip(fields, row)))}\n' for row in chunk)
+
+
+FORMATS = {
+    'csv': ('text/csv; charset=utf-8', iter_csv),
+    'jsonl': ('application/x-ndjson; charset=utf-8', iter_jsonl),
+}
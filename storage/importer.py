@@ -0,0 +1,224 @@
+"""Загрузка клиентов, боксов и заявок из CSV/JSONL, например из старой системы.
+
+Колонки такие же, как в выгрузках storage.exports: клиент боксу находится
+по user__chat_id, бокс заявке - по box_id, номеру бокса в старой системе
+(колонка id файла боксов). Внешние ключи разрешаются словарями в памяти,
+строки вставляются bulk_create. Каждая транзакция вместе со строками
+сохраняет ImportCheckpoint, поэтому прерванная загрузка продолжается с
+первой незагруженной строки, если уже загруженные строки файла не менялись.
+"""
+import csv
+import hashlib
+import json
+import os
+import time
+from collections import namedtuple
+from itertools import islice
+
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from django.db.models import DateTimeField
+from django.utils import timezone
+
+from .exports import unescape_csv_cell
+from .models import Box, ImportCheckpoint, LegacyBox, TransferRequest, User
+
+IMPORT_BATCH_SIZE = 1000
+IMPORT_TRANSACTION_SIZE = 20000
+
+# порядок загрузки: боксам нужны клиенты, заявкам - боксы
+IMPORT_KINDS = ('users', 'boxes', 'transfers')
+
+USER_FIELDS = ('tg_username', 'chat_id', 'phone', 'address', 'utm_source', 'from_owner')
+BOX_FIELDS = ('weight', 'volume', 'paid_from', 'paid_till', 'description', 'price', 'discount')
+TRANSFER_FIELDS = ('transfer_type', 'address', 'time_arrive', 'is_complete')
+
+# invalid - число ошибочных строк, errors - тексты первых из них
+ImportResult = namedtuple('ImportResult', 'rows created skipped invalid errors seconds')
+
+
+class ImportRowError(ValueError):
+
+    def __init__(self, path, line, message):
+        super().__init__(f'{os.path.basename(path)}, строка {line}: {message}')
+
+
+class ImportBatchError(ValueError):
+    """Транзакцию отклонила БД, например chat_id уже добавил бот. Место остановки - до нее."""
+
+    def __init__(self, path, first_line, last_line, rows_done, message):
+        super().__init__(
+            f'{os.path.basename(path)}, строки {first_line}-{last_line}: {message}. '
+            f'Загружено строк: {rows_done}'
+        )
+
+
+class ImportCheckpointError(ValueError):
+    """Уже загруженные строки файла не совпадают с прерванной загрузкой."""
+
+
+def row_digest(row):
+    return json.dumps(row, sort_keys=True, ensure_ascii=False, default=str).encode() + b'\n'
+
+
+def read_rows(path):
+    """Строки файла словарями, формат по расширению: .csv или .jsonl."""
+    if path.endswith('.csv'):
+        with open(path, newline='', encoding='utf-8-sig') as file:
+            for row in csv.DictReader(file):
+                yield {name: unescape_csv_cell(value) for name, value in row.items()}
+    elif path.endswith(('.jsonl', '.ndjson')):
+        with open(path, encoding='utf-8') as file:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+    else:
+        raise ValueError(f'Unsupported import file {path!r}, expected .csv or .jsonl')
+
+
+def get_cleaners(model, field_names):
+    fields = [model._meta.get_field(name) for name in field_names]
+
+    def clean(row):
+        values = {}
+        for field in fields:
+            value = row.get(field.name)
+            if value is None or value == '':
+                if field.has_default():
+                    continue
+                if not field.null:
+                    raise ValidationError(f'{field.name}: обязательное поле')
+                values[field.name] = None
+                continue
+            value = field.clean(value, None)
+            if isinstance(field, DateTimeField) and timezone.is_naive(value):
+                value = timezone.make_aware(value)
+            values[field.name] = value
+        return values
+
+    return clean
+
+
+class Importer:
+    """Загружает файлы и держит словари chat_id -> клиент и номер в старой системе -> бокс.
+
+    При dry_run строки только проверяются: в словари вместо id попадает
+    None, в БД ничего не пишется.
+    """
+
+    def __init__(self, batch_size=IMPORT_BATCH_SIZE, transaction_size=IMPORT_TRANSACTION_SIZE, dry_run=False):
+        self.batch_size = batch_size
+        self.transaction_size = transaction_size
+        self.dry_run = dry_run
+        self.user_ids = dict(User.objects.values_list('chat_id', 'id').iterator(chunk_size=10000))
+        self.box_ids = dict(LegacyBox.objects.values_list('legacy_id', 'box_id').iterator(chunk_size=10000))
+        self._clean_user = get_cleaners(User, USER_FIELDS)
+        self._clean_box = get_cleaners(Box, BOX_FIELDS)
+        self._clean_transfer = get_cleaners(TransferRequest, TRANSFER_FIELDS)
+
+    def build_users(self, row):
+        user = User(**self._clean_user(row))
+        if user.chat_id in self.user_ids:
+            return None
+        self.user_ids[user.chat_id] = None
+        return user
+
+    def build_boxes(self, row):
+        legacy_id = str(row.get('id') or '') or None
+        if legacy_id in self.box_ids:
+            return None
+        chat_id = User._meta.get_field('chat_id').clean(row.get('user__chat_id'), None)
+        if chat_id not in self.user_ids:
+            raise ValidationError(f'клиент с chat_id {chat_id} не найден')
+        box = Box(user_id=self.user_ids[chat_id], **self._clean_box(row))
+        if legacy_id is not None:
+            self.box_ids[legacy_id] = None
+        return box, legacy_id
+
+    def build_transfers(self, row):
+        legacy_id = str(row.get('box_id') or '')
+        if legacy_id not in self.box_ids:
+            raise ValidationError(f'бокс {legacy_id or "без номера"} не найден')
+        return TransferRequest(box_id=self.box_ids[legacy_id], **self._clean_transfer(row))
+
+    def save_users(self, users):
+        User.objects.bulk_create(users, batch_size=self.batch_size)
+        for user in users:
+            self.user_ids[user.chat_id] = user.pk
+
+    def save_boxes(self, rows):
+        Box.objects.bulk_create([box for box, _ in rows], batch_size=self.batch_size)
+        legacy_boxes = [LegacyBox(legacy_id=legacy_id, box_id=box.pk) for box, legacy_id in rows if legacy_id]
+        LegacyBox.objects.bulk_create(legacy_boxes, batch_size=self.batch_size)
+        for legacy_box in legacy_boxes:
+            self.box_ids[legacy_box.legacy_id] = legacy_box.box_id
+
+    def save_transfers(self, transfers):
+        TransferRequest.objects.bulk_create(transfers, batch_size=self.batch_size)
+
+    def import_file(self, kind, path, restart=False, on_progress=None, max_errors=20):
+        """Загружает файл транзакциями по transaction_size строк.
+
+        Без dry_run первая ошибочная строка прерывает загрузку с
+        ImportRowError, а транзакция, которую отклонила БД, - с
+        ImportBatchError; уже закрытые транзакции остаются в БД. При dry_run
+        проверяется весь файл, тексты сохраняются для первых max_errors ошибок.
+        """
+        build = getattr(self, f'build_{kind}')
+        save = getattr(self, f'save_{kind}')
+        source = f'{kind}:{os.path.abspath(path)}'
+
+        checkpoint = None
+        rows_done = 0
+        if not self.dry_run:
+            checkpoint, _ = ImportCheckpoint.objects.get_or_create(source=source)
+            rows_done = 0 if restart else checkpoint.rows_done
+        started = time.perf_counter()
+        rows = created = skipped = invalid = 0
+        errors = []
+
+        # хэш загруженных строк: продолжать можно, только если начало файла то же,
+        # исправлять строки после места остановки можно
+        digest = hashlib.sha256()
+        numbered_rows = enumerate(read_rows(path), 1)
+        if rows_done:
+            for _, row in islice(numbered_rows, rows_done):
+                digest.update(row_digest(row))
+            if digest.hexdigest() != checkpoint.fingerprint:
+                raise ImportCheckpointError(
+                    f'{path}: первые {rows_done} строк не совпадают с прерванной загрузкой этого файла, '
+                    f'продолжить с того же места нельзя. Загрузите файл заново с --restart'
+                )
+        while chunk := list(islice(numbered_rows, self.transaction_size)):
+            objects = []
+            for line, row in chunk:
+                digest.update(row_digest(row))
+                try:
+                    obj = build(row)
+                except (ValidationError, ValueError, TypeError) as error:
+                    message = '; '.join(error.messages) if isinstance(error, ValidationError) else str(error)
+                    if not self.dry_run:
+                        raise ImportRowError(path, line, message) from error
+                    invalid += 1
+                    if len(errors) < max_errors:
+                        errors.append(str(ImportRowError(path, line, message)))
+                    continue
+                if obj is None:
+                    skipped += 1
+                else:
+                    objects.append(obj)
+            if not self.dry_run:
+                try:
+                    with transaction.atomic():
+                        save(objects)
+                        checkpoint.rows_done = rows_done + rows + len(chunk)
+                        checkpoint.fingerprint = digest.hexdigest()
+                        checkpoint.save(update_fields=['rows_done', 'fingerprint', 'updated_at'])
+                except IntegrityError as error:
+                    # транзакция откатилась вместе с checkpoint, в БД осталось место остановки до нее
+                    raise ImportBatchError(path, chunk[0][0], chunk[-1][0], rows_done + rows, error) from error
+            rows += len(chunk)
+            created += len(objects)
+            if on_progress:
+                on_progress(kind, rows, time.perf_counter() - started)
+        return ImportResult(rows, created, skipped, invalid, errors, time.perf_counter() - started)
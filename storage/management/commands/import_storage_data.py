@@ -0,0 +1,67 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from storage.importer import (
+    IMPORT_BATCH_SIZE,
+    IMPORT_KINDS,
+    IMPORT_TRANSACTION_SIZE,
+    ImportCheckpointError,
+    Importer,
+)
+from storage.models import UtmSourceCounter
+
+
+class Command(BaseCommand):
+    help = 'Загружает клиентов, боксов и заявки из CSV/JSONL, колонки как в выгрузках /export/. ' \
+           'Прерванная загрузка продолжается с места остановки'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', help='Файл клиентов')
+        parser.add_argument('--boxes', help='Файл боксов, клиент по колонке user__chat_id')
+        parser.add_argument('--transfers', help='Файл заявок, бокс по колонке box_id (номер из файла боксов)')
+        parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE,
+                            help='Строк в одном INSERT')
+        parser.add_argument('--transaction-size', type=int, default=IMPORT_TRANSACTION_SIZE,
+                            help='Строк в одной транзакции, после каждой сохраняется место остановки')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Только проверить файлы, ничего не записывая')
+        parser.add_argument('--restart', action='store_true',
+                            help='Загружать файлы с начала, а не с места остановки')
+
+    def handle(self, *args, **options):
+        files = [(kind, options[kind]) for kind in IMPORT_KINDS if options[kind]]
+        if not files:
+            raise CommandError('Укажите хотя бы один файл: --users, --boxes или --transfers')
+        if options['batch_size'] <= 0 or options['transaction_size'] <= 0:
+            raise CommandError('--batch-size и --transaction-size должны быть больше нуля')
+
+        importer = Importer(options['batch_size'], options['transaction_size'], options['dry_run'])
+        created = invalid = 0
+        for kind, path in files:
+            try:
+                result = importer.import_file(kind, path, options['restart'], self.report_progress)
+            except ImportCheckpointError as error:
+                raise CommandError(str(error)) from error
+            except (OSError, ValueError) as error:
+                raise CommandError(f'{error}. Загруженные транзакции сохранены, '
+                                   f'после исправления файла запустите команду снова') from error
+            created += result.created
+            invalid += result.invalid
+            for error in result.errors:
+                self.stderr.write(error)
+            self.stdout.write(
+                f'{kind}: строк {result.rows}, добавлено {result.created}, уже были {result.skipped}, '
+                f'с ошибками {result.invalid}, {result.rows / (result.seconds or 1e-9):.0f} строк/с'
+            )
+
+        if options['dry_run']:
+            if invalid:
+                raise CommandError(f'Строк с ошибками: {invalid}')
+            self.stdout.write(self.style.SUCCESS('Проверка прошла, данные не записывались'))
+            return
+        # счетчики источников считаются при заказе в боте, загрузка идет в обход
+        if created:
+            UtmSourceCounter.objects.rebuild()
+        self.stdout.write(self.style.SUCCESS(f'Загружено строк: {created}'))
+
+    def report_progress(self, kind, rows, seconds):
+        self.stdout.write(f'{kind}: {rows} строк, {rows / (seconds or 1e-9):.0f} строк/с')
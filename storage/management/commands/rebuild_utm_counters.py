@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from storage.models import UtmSourceCounter
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает счетчики клиентов и заказов по источникам (UtmSourceCounter)'
+
+    def handle(self, *args, **options):
+        count = UtmSourceCounter.objects.rebuild()
+        self.stdout.write(self.style.SUCCESS(f'Пересчитано источников: {count}'))
@@ -0,0 +1,16 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from storage.analytics import refresh_daily_stats
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает дневные сводки по складу (StorageDailyStats), удобно запускать из cron'
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        days = refresh_daily_stats()
+        self.stdout.write(self.style.SUCCESS(
+            f'Пересчитано дней: {days} за {time.perf_counter() - started:.2f} с'
+        ))
@@ -0,0 +1,78 @@
+# Generated by Django 4.2 on 2026-10-18 19:47
+
+from django.db import migrations, models
+
+
+# контакты берутся у самого нового дубля, где они заполнены
+CONTACT_FIELDS = ('tg_username', 'phone', 'address')
+# источник - у самого старого, где он заполнен
+ORIGIN_FIELDS = ('utm_source',)
+
+
+def merge_duplicate_users(apps, schema_editor):
+    """Склеивает клиентов с одинаковым chat_id перед добавлением уникальности.
+
+    Остается самая старая запись, боксы дублей переходят к ней.
+    """
+    User = apps.get_model('storage', 'User')
+    Box = apps.get_model('storage', 'Box')
+    duplicates = (
+        User.objects.values('chat_id')
+        .annotate(count=models.Count('pk'))
+        .filter(count__gt=1)
+    )
+    for duplicate in duplicates:
+        users = list(User.objects.filter(chat_id=duplicate['chat_id']).order_by('pk'))
+        keep, extra_users = users[0], users[1:]
+        for field in CONTACT_FIELDS:
+            for user in reversed(users):
+                if getattr(user, field) not in (None, ''):
+                    setattr(keep, field, getattr(user, field))
+                    break
+        for field in ORIGIN_FIELDS:
+            for user in users:
+                if getattr(user, field) not in (None, ''):
+                    setattr(keep, field, getattr(user, field))
+                    break
+        # False - тоже заполненное значение, поэтому признак представителя ставится, если он есть у любого дубля
+        if any(user.from_owner for user in users):
+            keep.from_owner = True
+        keep.save(update_fields=[*CONTACT_FIELDS, *ORIGIN_FIELDS, 'from_owner'])
+        Box.objects.filter(user__in=extra_users).update(user_id=keep.pk)
+        User.objects.filter(pk__in=[user.pk for user in extra_users]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storage', '0006_remove_transferrequest_is_call_needed_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='user',
+            name='chat_id',
+            field=models.BigIntegerField(verbose_name='ID чата'),
+        ),
+        migrations.AddIndex(
+            model_name='box',
+            index=models.Index(fields=['paid_till'], name='box_paid_till_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='box',
+            index=models.Index(fields=['user', 'paid_till'], name='box_user_paid_till_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transferrequest',
+            index=models.Index(condition=models.Q(('is_complete', False)), fields=['id'], name='transfer_open_queue_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['utm_source'], name='user_utm_source_idx'),
+        ),
+        migrations.RunPython(merge_duplicate_users, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='user',
+            constraint=models.UniqueConstraint(fields=('chat_id',), name='unique_user_chat_id'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2 on 2026-10-18 19:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storage', '0007_hot_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='box',
+            name='discount',
+            field=models.IntegerField(default=0, verbose_name='Скидка в %'),
+        ),
+        migrations.AddField(
+            model_name='box',
+            name='price',
+            field=models.IntegerField(null=True, verbose_name='Цена в месяц'),
+        ),
+    ]
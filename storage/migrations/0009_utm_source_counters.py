@@ -0,0 +1,41 @@
+# Generated by Django 4.2 on 2026-10-18 20:02
+
+from django.db import migrations, models
+
+
+def fill_counters(apps, schema_editor):
+    """Заполняет счетчики по уже сохраненным клиентам и боксам."""
+    User = apps.get_model('storage', 'User')
+    Box = apps.get_model('storage', 'Box')
+    UtmSourceCounter = apps.get_model('storage', 'UtmSourceCounter')
+    users = User.objects.exclude(utm_source__isnull=True).exclude(utm_source='') \
+        .values_list('utm_source').annotate(count=models.Count('pk')).order_by()
+    orders = Box.objects.exclude(user__utm_source__isnull=True).exclude(user__utm_source='') \
+        .values_list('user__utm_source').annotate(count=models.Count('pk')).order_by()
+    counters = {utm_source: UtmSourceCounter(utm_source=utm_source, users=count) for utm_source, count in users}
+    for utm_source, count in orders:
+        counters.setdefault(utm_source, UtmSourceCounter(utm_source=utm_source)).orders = count
+    UtmSourceCounter.objects.bulk_create(counters.values())
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storage', '0008_box_price_discount'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UtmSourceCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('utm_source', models.CharField(max_length=100, unique=True, verbose_name='Источник')),
+                ('users', models.IntegerField(default=0, verbose_name='Клиентов')),
+                ('orders', models.IntegerField(default=0, verbose_name='Заказов')),
+            ],
+            options={
+                'verbose_name': 'источник клиентов',
+                'verbose_name_plural': 'Источники клиентов',
+            },
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.2 on 2026-10-18 20:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storage', '0009_utm_source_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StorageDailyStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(unique=True, verbose_name='Дата')),
+                ('boxes', models.IntegerField(verbose_name='Занято боксов')),
+                ('clients', models.IntegerField(verbose_name='Клиентов')),
+                ('occupied_volume', models.FloatField(verbose_name='Занятый объем, м³')),
+                ('occupied_weight', models.FloatField(verbose_name='Занятый вес, кг')),
+                ('revenue', models.FloatField(verbose_name='Выручка за день, руб.')),
+                ('started_boxes', models.IntegerField(verbose_name='Новых боксов')),
+                ('ended_boxes', models.IntegerField(verbose_name='Закончилась аренда боксов')),
+                ('lost_clients', models.IntegerField(verbose_name='Ушло клиентов')),
+                ('expiring_boxes', models.IntegerField(verbose_name='Освободится боксов за неделю')),
+                ('expiring_volume', models.FloatField(verbose_name='Освободится объема за неделю, м³')),
+                ('computed_at', models.DateTimeField(verbose_name='Пересчитано')),
+            ],
+            options={
+                'verbose_name': 'сводка по складу',
+                'verbose_name_plural': 'Сводки по складу',
+            },
+        ),
+    ]
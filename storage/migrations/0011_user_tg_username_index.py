@@ -0,0 +1,17 @@
+# Generated by Django 4.2 on 2026-10-18 20:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storage', '0010_storage_daily_stats'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['tg_username'], name='user_tg_username_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.2 on 2026-10-18 20:23
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storage', '0011_user_tg_username_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=255, unique=True, verbose_name='Файл')),
+                ('rows_done', models.IntegerField(default=0, verbose_name='Загружено строк')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Обновлено')),
+            ],
+            options={
+                'verbose_name': 'загрузка данных',
+                'verbose_name_plural': 'Загрузки данных',
+            },
+        ),
+        migrations.CreateModel(
+            name='LegacyBox',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('legacy_id', models.CharField(max_length=100, unique=True, verbose_name='Номер в старой системе')),
+                ('box', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='legacy', to='storage.box', verbose_name='Бокс')),
+            ],
+            options={
+                'verbose_name': 'бокс из старой системы',
+                'verbose_name_plural': 'Боксы из старой системы',
+            },
+        ),
+    ]
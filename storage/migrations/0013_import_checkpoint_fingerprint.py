@@ -0,0 +1,23 @@
+# Generated by Django 4.2 on 2026-10-18 21:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storage', '0012_legacy_import'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importcheckpoint',
+            name='fingerprint',
+            field=models.CharField(blank=True, max_length=64, verbose_name='SHA-256 загруженных строк'),
+        ),
+        migrations.AlterField(
+            model_name='importcheckpoint',
+            name='source',
+            field=models.CharField(max_length=1024, unique=True, verbose_name='Файл'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2 on 2026-10-18 21:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storage', '0013_import_checkpoint_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='box',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, null=True, verbose_name='Обновлено'),
+        ),
+        migrations.AddIndex(
+            model_name='box',
+            index=models.Index(fields=['updated_at'], name='box_updated_at_idx'),
+        ),
+    ]
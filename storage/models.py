@@ -1,4 +1,6 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Count, F, Q
+from django.utils import timezone
 
 class User(models.Model):
 
@@ -6,7 +8,7 @@ class User(models.Model):
         'Никнейм в мессенджере',
         max_length=100,
     )
-    chat_id = models.IntegerField(
+    chat_id = models.BigIntegerField(
         'ID чата',
     )
     phone = models.CharField(
@@ -34,6 +36,14 @@ class User(models.Model):
     class Meta:
         verbose_name = 'клиент'
         verbose_name_plural = 'Клиенты'
+        constraints = [
+            models.UniqueConstraint(fields=['chat_id'], name='unique_user_chat_id'),
+        ]
+        indexes = [
+            models.Index(fields=['utm_source'], name='user_utm_source_idx'),
+            # поиск клиента по началу никнейма в админке
+            models.Index(fields=['tg_username'], name='user_tg_username_idx'),
+        ]
 
 
 class Box(models.Model):
@@ -64,6 +74,21 @@ class Box(models.Model):
         'Хранимые вещи',
         null=True,
     )
+    price = models.IntegerField(
+        'Цена в месяц',
+        null=True,
+    )
+    discount = models.IntegerField(
+        'Скидка в %',
+        default=0,
+    )
+    # auto_now не срабатывает в QuerySet.update(), там поле выставляется явно:
+    # по нему напоминания находят измененные боксы
+    updated_at = models.DateTimeField(
+        'Обновлено',
+        auto_now=True,
+        null=True,
+    )
 
     def __str__(self):
         return f'{self.user.tg_username} с {self.paid_from} по {self.paid_till}'
@@ -71,6 +96,11 @@ class Box(models.Model):
     class Meta:
         verbose_name = 'бокс'
         verbose_name_plural = 'Боксы'
+        indexes = [
+            models.Index(fields=['paid_till'], name='box_paid_till_idx'),
+            models.Index(fields=['user', 'paid_till'], name='box_user_paid_till_idx'),
+            models.Index(fields=['updated_at'], name='box_updated_at_idx'),
+        ]
 
 
 class TransferRequest(models.Model):
@@ -111,6 +141,25 @@ class TransferRequest(models.Model):
     class Meta:
         verbose_name = 'трансфер'
         verbose_name_plural = 'Трансферы'
+        indexes = [
+            # очередь невыполненных заявок, выполненных обычно на порядки больше
+            models.Index(
+                fields=['id'],
+                condition=models.Q(is_complete=False),
+                name='transfer_open_queue_idx',
+            ),
+        ]
+
+
+class PromocodesQuerySet(models.QuerySet):
+
+    def active(self, now=None):
+        """Промокоды, которые действуют в момент now (по умолчанию сейчас)."""
+        now = now or timezone.now()
+        return self.filter(
+            Q(valid_from__isnull=True) | Q(valid_from__lte=now),
+            Q(valid_till__isnull=True) | Q(valid_till__gte=now),
+        )
 
 
 class Promocodes(models.Model):
@@ -134,9 +183,179 @@ class Promocodes(models.Model):
         null=True,
     )
 
+    objects = PromocodesQuerySet.as_manager()
+
     def __str__(self):
         return f'{self.name}, скидка {self.discount}'
 
     class Meta:
         verbose_name = 'промокод'
-        verbose_name_plural = 'Промокоды'
\ No newline at end of file
+        verbose_name_plural = 'Промокоды'
+
+
+class UtmSourceCounterQuerySet(models.QuerySet):
+
+    def record_order(self, user_id, utm_source=None):
+        """Учитывает завершенный заказ клиента. Вызывать в той же транзакции, что и создание бокса.
+
+        utm_source из сессии привязывается к клиенту, только если он еще
+        ни к чему не привязан; тогда источнику засчитываются клиент и все
+        его боксы, как при пересчете в rebuild.
+        """
+        users = User.objects.filter(pk=user_id)
+        is_new_user = bool(utm_source) and users.filter(utm_source__isnull=True).update(utm_source=utm_source) == 1
+        if is_new_user:
+            orders = Box.objects.filter(user_id=user_id).count()
+        else:
+            utm_source = users.values_list('utm_source', flat=True).first()
+            orders = 1
+        if not utm_source:
+            return
+        self.get_or_create(utm_source=utm_source)
+        self.filter(utm_source=utm_source).update(
+            users=F('users') + int(is_new_user),
+            orders=F('orders') + orders,
+        )
+
+    def rebuild(self):
+        """Пересчитывает счетчики по клиентам и боксам."""
+        users = User.objects.exclude(utm_source__isnull=True).exclude(utm_source='') \
+            .values_list('utm_source').annotate(count=Count('pk')).order_by()
+        orders = Box.objects.exclude(user__utm_source__isnull=True).exclude(user__utm_source='') \
+            .values_list('user__utm_source').annotate(count=Count('pk')).order_by()
+        counters = {utm_source: self.model(utm_source=utm_source, users=count) for utm_source, count in users}
+        for utm_source, count in orders:
+            counters.setdefault(utm_source, self.model(utm_source=utm_source)).orders = count
+        with transaction.atomic():
+            self.all().delete()
+            self.bulk_create(counters.values())
+        return len(counters)
+
+
+class UtmSourceCounter(models.Model):
+    """Число клиентов и заказов по источнику, обновляется вместе с заказом."""
+
+    utm_source = models.CharField(
+        'Источник',
+        max_length=100,
+        unique=True,
+    )
+    users = models.IntegerField(
+        'Клиентов',
+        default=0,
+    )
+    orders = models.IntegerField(
+        'Заказов',
+        default=0,
+    )
+
+    objects = UtmSourceCounterQuerySet.as_manager()
+
+    def __str__(self):
+        return f'{self.utm_source}: {self.users} клиентов, {self.orders} заказов'
+
+    class Meta:
+        verbose_name = 'источник клиентов'
+        verbose_name_plural = 'Источники клиентов'
+
+
+class StorageDailyStats(models.Model):
+    """Дневная сводка по складу, считается storage.analytics.refresh_daily_stats."""
+
+    date = models.DateField(
+        'Дата',
+        unique=True,
+    )
+    boxes = models.IntegerField(
+        'Занято боксов',
+    )
+    clients = models.IntegerField(
+        'Клиентов',
+    )
+    occupied_volume = models.FloatField(
+        'Занятый объем, м³',
+    )
+    occupied_weight = models.FloatField(
+        'Занятый вес, кг',
+    )
+    revenue = models.FloatField(
+        'Выручка за день, руб.',
+    )
+    started_boxes = models.IntegerField(
+        'Новых боксов',
+    )
+    ended_boxes = models.IntegerField(
+        'Закончилась аренда боксов',
+    )
+    lost_clients = models.IntegerField(
+        'Ушло клиентов',
+    )
+    expiring_boxes = models.IntegerField(
+        'Освободится боксов за неделю',
+    )
+    expiring_volume = models.FloatField(
+        'Освободится объема за неделю, м³',
+    )
+    computed_at = models.DateTimeField(
+        'Пересчитано',
+    )
+
+    def __str__(self):
+        return f'{self.date}: {self.boxes} боксов, {self.occupied_volume:.1f} м³'
+
+    class Meta:
+        verbose_name = 'сводка по складу'
+        verbose_name_plural = 'Сводки по складу'
+
+
+class ImportCheckpoint(models.Model):
+    """Сколько строк файла уже загружено командой import_storage_data."""
+
+    source = models.CharField(
+        'Файл',
+        max_length=1024,
+        unique=True,
+    )
+    fingerprint = models.CharField(
+        'SHA-256 загруженных строк',
+        max_length=64,
+        blank=True,
+    )
+    rows_done = models.IntegerField(
+        'Загружено строк',
+        default=0,
+    )
+    updated_at = models.DateTimeField(
+        'Обновлено',
+        auto_now=True,
+    )
+
+    def __str__(self):
+        return f'{self.source}: {self.rows_done} строк'
+
+    class Meta:
+        verbose_name = 'загрузка данных'
+        verbose_name_plural = 'Загрузки данных'
+
+
+class LegacyBox(models.Model):
+    """Номер бокса в старой системе, по нему к боксам привязываются загружаемые заявки."""
+
+    legacy_id = models.CharField(
+        'Номер в старой системе',
+        max_length=100,
+        unique=True,
+    )
+    box = models.OneToOneField(
+        Box,
+        verbose_name='Бокс',
+        related_name='legacy',
+        on_delete=models.CASCADE,
+    )
+
+    def __str__(self):
+        return f'{self.legacy_id} -> {self.box_id}'
+
+    class Meta:
+        verbose_name = 'бокс из старой системы'
+        verbose_name_plural = 'Боксы из старой системы'
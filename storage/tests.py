@@ -1,3 +1,527 @@
-from django.test import TestCase
+import csv
+import io
+import json
+import os
+import sqlite3
+import tempfile
+from datetime import datetime, timedelta
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.contrib import admin
+from django.contrib.auth.models import User as AuthUser
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from self_storage.slow_queries import SlowQueryLog, normalize_sql, origin
+from self_storage.sqlite.base import DatabaseWrapper
+from storage import analytics, bulk
+from storage.admin import BoxAdmin, EstimatedCountPaginator, UserAdmin, YearRangeQuerySet
+from storage.exports import EXPORTS, filter_rows, iter_csv
+from storage.importer import ImportBatchError, ImportCheckpointError, Importer, ImportRowError
+from storage.models import Box, ImportCheckpoint, Promocodes, StorageDailyStats, TransferRequest, User, UtmSourceCounter
+
+
+class AnalyticsTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(tg_username='client', chat_id=1)
+        self.today = timezone.localdate()
+        self.paid_from = timezone.now() - timedelta(days=10)
+
+    def create_box(self, **fields):
+        fields = {
+            'user': self.user, 'weight': 10, 'volume': 2, 'price': 3000,
+            'paid_from': self.paid_from, 'paid_till': self.paid_from + timedelta(days=30), **fields,
+        }
+        return Box.objects.create(**fields)
+
+    def test_revenue_of_discounted_box(self):
+        # price уже со скидкой: 1500 в месяц - 50 в день
+        self.create_box(price=1500, discount=50)
+        analytics.refresh_daily_stats(self.today)
+
+        stats = StorageDailyStats.objects.get(date=self.today)
+        self.assertAlmostEqual(stats.revenue, 50)
+
+    def test_daily_rollup(self):
+        self.create_box()
+        self.create_box(volume=3, paid_till=self.paid_from + timedelta(days=5))
+        days = analytics.refresh_daily_stats(self.today)
+
+        self.assertEqual(days, 11)
+        first = StorageDailyStats.objects.order_by('date').first()
+        self.assertEqual((first.boxes, first.clients, first.occupied_volume, first.revenue), (2, 1, 5, 200))
+        latest = StorageDailyStats.objects.get(date=self.today)
+        self.assertEqual((latest.boxes, latest.clients, latest.occupied_volume), (1, 1, 2))
+        self.assertEqual(StorageDailyStats.objects.get(date=first.date + timedelta(days=5)).ended_boxes, 1)
+
+    def test_churn(self):
+        self.create_box(paid_from=self.paid_from - timedelta(days=40), paid_till=self.paid_from)
+        self.create_box(
+            user=User.objects.create(tg_username='other', chat_id=2),
+            paid_from=self.paid_from - timedelta(days=40), paid_till=self.paid_from + timedelta(days=30),
+        )
+        analytics.refresh_daily_stats(self.today)
+
+        latest = StorageDailyStats.objects.get(date=self.today)
+        self.assertEqual(latest.clients, 1)
+        self.assertAlmostEqual(analytics.get_churn(latest), 0.5)
+
+    def test_latest_stats_do_not_refresh_in_caller(self):
+        self.create_box()
+        analytics.refresh_daily_stats(self.today - timedelta(days=1))
+        StorageDailyStats.objects.update(computed_at=timezone.now() - timedelta(days=1))
+        with mock.patch.object(analytics, 'refresh_in_background') as refresh:
+            latest = analytics.get_latest_stats()
+
+        self.assertEqual(latest.date, self.today - timedelta(days=1))
+        refresh.assert_called_once_with()
+
+
+class MergeDuplicateUsersTests(TransactionTestCase):
+
+    before = [('storage', '0006_remove_transferrequest_is_call_needed_and_more')]
+    after = [('storage', '0007_hot_lookup_indexes')]
+
+    def setUp(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.before)
+        self.addCleanup(lambda: MigrationExecutor(connection).migrate(executor.loader.graph.leaf_nodes()))
+        self.apps = executor.loader.project_state(self.before).apps
+
+    def migrate(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.after)
+        return executor.loader.project_state(self.after).apps
+
+    def test_merge(self):
+        User = self.apps.get_model('storage', 'User')
+        Box = self.apps.get_model('storage', 'Box')
+        oldest = User.objects.create(chat_id=1, tg_username='old', phone='111', utm_source='vk', from_owner=False)
+        middle = User.objects.create(chat_id=1, tg_username='middle', address='Москва', from_owner=True)
+        newest = User.objects.create(chat_id=1, tg_username='new', utm_source='tg', from_owner=False)
+        User.objects.create(chat_id=2, tg_username='other')
+        for user in (oldest, middle, newest):
+            Box.objects.create(user=user)
+
+        apps = self.migrate()
+
+        User = apps.get_model('storage', 'User')
+        user = User.objects.get(chat_id=1)
+        self.assertEqual(user.pk, oldest.pk)
+        self.assertEqual(
+            (user.tg_username, user.phone, user.address, user.utm_source, user.from_owner),
+            ('new', '111', 'Москва', 'vk', True),
+        )
+        self.assertEqual(apps.get_model('storage', 'Box').objects.filter(user=user).count(), 3)
+        self.assertEqual(User.objects.count(), 2)
+
+
+class SQLiteBackendTests(SimpleTestCase):
+
+    def open(self, **options):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_dict = {**connection.settings_dict, 'NAME': os.path.join(directory.name, 'db.sqlite3')}
+        settings_dict['OPTIONS'] = {'timeout': 0, **options}
+        wrapper = DatabaseWrapper(settings_dict, alias='sqlite_backend_test')
+        self.addCleanup(wrapper.close)
+        with wrapper.cursor() as cursor:
+            cursor.execute('CREATE TABLE t (id INTEGER PRIMARY KEY)')
+        return wrapper
+
+    def pragma(self, wrapper, name):
+        with wrapper.cursor() as cursor:
+            cursor.execute(f'PRAGMA {name}')
+            return cursor.fetchone()[0]
+
+    def other_writer_is_blocked(self, wrapper):
+        other = sqlite3.connect(wrapper.settings_dict['NAME'], timeout=0)
+        try:
+            other.execute('BEGIN IMMEDIATE')
+            other.rollback()
+            return False
+        except sqlite3.OperationalError:
+            return True
+        finally:
+            other.close()
+
+    def test_init_command_pragmas(self):
+        wrapper = self.open(init_command='PRAGMA journal_mode = WAL; PRAGMA synchronous = NORMAL;')
+
+        self.assertEqual(self.pragma(wrapper, 'journal_mode'), 'wal')
+        self.assertEqual(self.pragma(wrapper, 'synchronous'), 1)
+
+    def test_immediate_transaction_takes_write_lock(self):
+        wrapper = self.open(transaction_mode='IMMEDIATE')
+
+        wrapper._start_transaction_under_autocommit()
+        self.assertTrue(self.other_writer_is_blocked(wrapper))
+        wrapper.cursor().execute('ROLLBACK')
+
+    def test_deferred_transaction_by_default(self):
+        wrapper = self.open()
+
+        wrapper._start_transaction_under_autocommit()
+        self.assertFalse(self.other_writer_is_blocked(wrapper))
+        wrapper.cursor().execute('ROLLBACK')
+
+
+class UtmSourceCounterTests(TestCase):
+
+    def counters(self):
+        return {counter.utm_source: (counter.users, counter.orders) for counter in UtmSourceCounter.objects.all()}
+
+    def order(self, user, utm_source=None):
+        Box.objects.create(user=user)
+        UtmSourceCounter.objects.record_order(user.id, utm_source)
+
+    def test_record_order(self):
+        user = User.objects.create(tg_username='client', chat_id=1)
+        other = User.objects.create(tg_username='other', chat_id=2, utm_source='vk')
+
+        self.order(user, 'tg')
+        self.order(user, 'vk')
+        self.order(other, 'tg')
+
+        self.assertEqual(self.counters(), {'tg': (1, 2), 'vk': (0, 1)})
+        user.refresh_from_db()
+        self.assertEqual(user.utm_source, 'tg')
+
+    def test_new_source_counts_earlier_boxes(self):
+        user = User.objects.create(tg_username='client', chat_id=1)
+        self.order(user)
+        self.assertEqual(self.counters(), {})
+
+        self.order(user, 'tg')
+
+        self.assertEqual(self.counters(), {'tg': (1, 2)})
+
+    def test_rebuild_matches_recorded(self):
+        users = [User.objects.create(tg_username=str(number), chat_id=number) for number in range(4)]
+        for user, utm_source in zip(users, ('tg', 'tg', 'vk', None)):
+            self.order(user, utm_source)
+            self.order(user)
+        recorded = self.counters()
+        UtmSourceCounter.objects.filter(utm_source='tg').update(users=100)
+
+        self.assertEqual(UtmSourceCounter.objects.rebuild(), 2)
+        self.assertEqual(self.counters(), recorded)
+        self.assertEqual(recorded, {'tg': (2, 4), 'vk': (1, 2)})
+
+
+class AdminTests(TestCase):
+
+    def setUp(self):
+        self.users = [
+            User.objects.create(tg_username=name, chat_id=number)
+            for number, name in enumerate(('Ivanov', 'ivanova', 'mr_ivan', 'Petrov'), 100)
+        ]
+
+    def user_search(self, term):
+        queryset, _ = UserAdmin(User, admin.site).get_search_results(None, User.objects.all(), term)
+        return sorted(user.tg_username for user in queryset)
+
+    def test_user_search(self):
+        self.assertEqual(self.user_search('Iva'), ['Ivanov'])
+        # поиск с начала и с учетом регистра
+        self.assertEqual(self.user_search('ivan'), ['ivanova'])
+        self.assertEqual(self.user_search('@Petrov '), ['Petrov'])
+        self.assertEqual(self.user_search('101'), ['ivanova'])
+        self.assertEqual(self.user_search(str(self.users[2].pk)), ['mr_ivan'])
+        self.assertEqual(len(self.user_search('')), 4)
+
+    def test_box_search(self):
+        box = Box.objects.create(user=self.users[0])
+        Box.objects.create(user=self.users[3])
+
+        queryset, _ = BoxAdmin(Box, admin.site).get_search_results(None, Box.objects.all(), 'Iv')
+
+        self.assertEqual(list(queryset), [box])
+
+    def test_estimated_count(self):
+        self.users[1].delete()
+
+        self.assertEqual(EstimatedCountPaginator(User.objects.order_by('pk'), 2).count, self.users[-1].pk)
+        self.assertEqual(EstimatedCountPaginator(User.objects.filter(chat_id__gt=100).order_by('pk'), 2).count, 2)
+
+    def test_year_range(self):
+        for year in (2021, 2024):
+            Box.objects.create(user=self.users[0], paid_till=timezone.make_aware(datetime(year, 6, 1)))
+        queryset = YearRangeQuerySet(Box)
+
+        self.assertEqual([date.year for date in queryset.datetimes('paid_till', 'year')], [2021, 2022, 2023, 2024])
+        self.assertEqual(YearRangeQuerySet(Box).none().datetimes('paid_till', 'year'), [])
+        self.assertEqual(len(queryset.datetimes('paid_till', 'month')), 2)
+
+
+class BulkTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(tg_username='client', chat_id=1)
+        self.paid_till = timezone.now()
+
+    def test_complete_transfers(self):
+        box = Box.objects.create(user=self.user)
+        TransferRequest.objects.create(box=box, transfer_type=0, address='a', time_arrive='10', is_complete=True)
+        TransferRequest.objects.create(box=box, transfer_type=1, address='b', time_arrive='11')
+
+        self.assertEqual(bulk.complete_transfers(TransferRequest.objects.all()), 1)
+        self.assertFalse(TransferRequest.objects.filter(is_complete=False).exists())
+
+    def test_extend_rentals(self):
+        box = Box.objects.create(user=self.user, paid_till=self.paid_till)
+        Box.objects.create(user=self.user)
+
+        self.assertEqual(bulk.extend_rentals(Box.objects.all(), 2), 1)
+        box.refresh_from_db()
+        self.assertEqual(box.paid_till, self.paid_till + timedelta(days=60))
+        with self.assertRaises(ValueError):
+            bulk.extend_rentals(Box.objects.all(), 0)
+
+    def test_apply_promo_recomputes_discounted_price(self):
+        promo = Promocodes.objects.create(name='summer', discount=20)
+        full_price = Box.objects.create(user=self.user, price=1000)
+        discounted = Box.objects.create(user=self.user, price=900, discount=10)
+        better = Box.objects.create(user=self.user, price=500, discount=50)
+
+        self.assertEqual(bulk.apply_promo(Box.objects.all(), promo), 2)
+        for box in (full_price, discounted, better):
+            box.refresh_from_db()
+        self.assertEqual((full_price.price, full_price.discount), (800, 20))
+        self.assertEqual((discounted.price, discounted.discount), (800, 20))
+        self.assertEqual((better.price, better.discount), (500, 50))
+
+    def test_apply_promo_rejects_inactive_codes(self):
+        now = timezone.now()
+        Box.objects.create(user=self.user, price=1000)
+        expired = Promocodes.objects.create(name='old', discount=20, valid_till=now - timedelta(days=1))
+        future = Promocodes.objects.create(name='new', discount=20, valid_from=now + timedelta(days=1))
+
+        for promo in (expired, future):
+            with self.assertRaises(ValueError):
+                bulk.apply_promo(Box.objects.all(), promo)
+        self.assertEqual(Box.objects.get().price, 1000)
+
+
+class ExportTests(TestCase):
+
+    def setUp(self):
+        now = timezone.now()
+        user = User.objects.create(tg_username='client', chat_id=1, utm_source='vk')
+        other = User.objects.create(tg_username='other', chat_id=2, utm_source='tg')
+        self.overdue = Box.objects.create(user=user, paid_till=now - timedelta(days=1), description='=HYPERLINK("x")')
+        self.paid = Box.objects.create(user=user, paid_till=now + timedelta(days=1), description='-5 кг')
+        self.other = Box.objects.create(user=other, paid_till=now - timedelta(days=1))
+
+    def box_ids(self, params):
+        return set(filter_rows(EXPORTS['boxes'], params).values_list('id', flat=True))
+
+    def test_flag_filters(self):
+        everything = {self.overdue.id, self.paid.id, self.other.id}
+        self.assertEqual(self.box_ids({}), everything)
+        for value in ('1', 'true', 'YES'):
+            self.assertEqual(self.box_ids({'overdue': value}), {self.overdue.id, self.other.id})
+        for value in ('0', 'false', 'no', ''):
+            self.assertEqual(self.box_ids({'overdue': value}), everything)
+
+    def test_value_filters(self):
+        self.assertEqual(self.box_ids({'utm_source': 'vk'}), {self.overdue.id, self.paid.id})
+        self.assertEqual(self.box_ids({'overdue': '1', 'utm_source': 'tg'}), {self.other.id})
+
+    def test_csv_escapes_formulas(self):
+        rows = list(csv.reader(''.join(iter_csv(Box.objects.all(), ('id', 'description'))).splitlines()))
+
+        self.assertEqual(rows[0], ['id', 'description'])
+        self.assertEqual(rows[1], [str(self.overdue.id), '\'=HYPERLINK("x")'])
+        self.assertEqual(rows[2], [str(self.paid.id), "'-5 кг"])
+
+
+class ExportViewTests(TestCase):
+
+    def setUp(self):
+        user = User.objects.create(tg_username='client', chat_id=1)
+        Box.objects.create(user=user, description='=1+1')
+        self.admin = AuthUser.objects.create_user('admin', is_staff=True)
+
+    def test_requires_staff(self):
+        response = self.client.get(reverse('export_rows', args=('boxes', 'csv')))
+
+        self.assertEqual(response.status_code, 302)
+
+    def test_streams_csv(self):
+        self.client.force_login(self.admin)
+
+        response = self.client.get(reverse('export_rows', args=('boxes', 'csv')))
+
+        self.assertTrue(response.streaming)
+        self.assertFalse(response.is_async)
+        self.assertIn('attachment; filename="boxes-', response['Content-Disposition'])
+        rows = list(csv.reader(b''.join(response.streaming_content).decode().splitlines()))
+        self.assertEqual(rows[1][-1], "'=1+1")
+
+    async def test_streams_async_under_asgi(self):
+        await sync_to_async(self.async_client.force_login)(self.admin)
+
+        response = await self.async_client.get(reverse('export_rows', args=('users', 'jsonl')))
+
+        self.assertTrue(response.is_async)
+        lines = b''.join([chunk async for chunk in response.streaming_content]).decode().splitlines()
+        self.assertEqual([json.loads(line)['chat_id'] for line in lines], [1])
+
+    def test_unknown_export(self):
+        self.client.force_login(self.admin)
+
+        self.assertEqual(self.client.get(reverse('export_rows', args=('boxes', 'xml'))).status_code, 404)
+
+
+class ImporterTests(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def write_users(self, name, chat_ids, subdirectory=''):
+        path = os.path.join(self.directory, subdirectory, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', newline='', encoding='utf-8') as file:
+            writer = csv.writer(file)
+            writer.writerow(('tg_username', 'chat_id', 'phone'))
+            for chat_id in chat_ids:
+                writer.writerow((f'user{chat_id}', chat_id, "'+79990000"))
+        return path
+
+    def test_import_and_unescape(self):
+        path = self.write_users('users.csv', [1, 2, 3])
+
+        result = Importer(transaction_size=2).import_file('users', path)
+
+        self.assertEqual((result.rows, result.created), (3, 3))
+        self.assertEqual(User.objects.get(chat_id=1).phone, '+79990000')
+        self.assertEqual(ImportCheckpoint.objects.get().rows_done, 3)
+
+    def test_resume_after_fixed_row(self):
+        path = self.write_users('users.csv', [1, 2, 'bad', 4])
+        with self.assertRaises(ImportRowError):
+            Importer(transaction_size=2).import_file('users', path)
+        self.assertEqual(User.objects.count(), 2)
+
+        # строки после места остановки можно исправить
+        self.write_users('users.csv', [1, 2, 3, 4])
+        result = Importer(transaction_size=2).import_file('users', path)
+
+        self.assertEqual((result.rows, result.created), (2, 2))
+        self.assertEqual(User.objects.count(), 4)
+
+    def test_same_name_in_other_directory_is_a_new_file(self):
+        Importer().import_file('users', self.write_users('users.csv', [1, 2], 'a'))
+
+        result = Importer().import_file('users', self.write_users('users.csv', [3, 4], 'b'))
+
+        self.assertEqual(result.created, 2)
+        self.assertEqual(ImportCheckpoint.objects.count(), 2)
+
+    def test_changed_prefix_is_rejected(self):
+        path = self.write_users('users.csv', [1, 2])
+        Importer().import_file('users', path)
+        self.write_users('users.csv', [5, 6, 7])
+
+        with self.assertRaises(ImportCheckpointError):
+            Importer().import_file('users', path)
+        result = Importer().import_file('users', path, restart=True)
+        self.assertEqual(result.created, 3)
+
+    def test_dry_run_writes_nothing(self):
+        path = self.write_users('users.csv', [1, 'bad'])
+
+        result = Importer(dry_run=True).import_file('users', path)
+
+        self.assertEqual((result.rows, result.invalid), (2, 1))
+        self.assertFalse(User.objects.exists())
+        self.assertFalse(ImportCheckpoint.objects.exists())
+
+    def test_rejected_transaction_keeps_checkpoint(self):
+        path = self.write_users('users.csv', [1, 2, 3, 4])
+        importer = Importer(transaction_size=2)
+        # клиента добавил бот после того, как загрузка прочитала chat_id из БД
+        User.objects.create(tg_username='bot', chat_id=4)
+
+        with self.assertRaisesMessage(ImportBatchError, 'users.csv, строки 3-4'):
+            importer.import_file('users', path)
+
+        self.assertEqual(ImportCheckpoint.objects.get().rows_done, 2)
+        self.assertEqual(User.objects.count(), 3)
+        result = Importer(transaction_size=2).import_file('users', path)
+        self.assertEqual((result.rows, result.created, result.skipped), (2, 1, 1))
+
+    def test_command_reports_rejected_transaction(self):
+        path = self.write_users('users.csv', [1, 2])
+
+        with mock.patch.object(Importer, 'save_users', side_effect=IntegrityError('UNIQUE constraint failed')):
+            with self.assertRaisesMessage(CommandError, 'строки 1-2: UNIQUE constraint failed. Загружено строк: 0'):
+                call_command('import_storage_data', users=path, stdout=io.StringIO())
+
+
+class NormalizeSqlTests(SimpleTestCase):
+
+    def test_literals_and_lists(self):
+        self.assertEqual(
+            normalize_sql("SELECT * FROM t WHERE id IN (%s, %s, %s) AND name = 'x''y' LIMIT 21"),
+            'SELECT * FROM t WHERE id IN (...) AND name = ? LIMIT ?',
+        )
+
+    def test_multi_row_insert(self):
+        self.assertEqual(
+            normalize_sql('INSERT INTO "t" ("a", "b") VALUES (%s, %s), (%s, %s), (%s, %s)'),
+            'INSERT INTO "t" ("a", "b") VALUES (...), ...',
+        )
+
+    def test_same_query_with_other_values(self):
+        self.assertEqual(
+            normalize_sql('SELECT  *\n FROM t WHERE id = 1'),
+            normalize_sql('SELECT * FROM t WHERE id = 25'),
+        )
+
+    def test_identifiers_with_digits_are_kept(self):
+        self.assertEqual(normalize_sql('SELECT "box2"."id" FROM "t1"'), 'SELECT "box2"."id" FROM "t1"')
+
+
+class SlowQueryLogTests(TestCase):
+
+    def test_totals_by_normalized_sql(self):
+        log = SlowQueryLog(threshold=1)
+        log.record(connection, 'SELECT * FROM storage_box WHERE id = 1', None, False, 0.002)
+        log.record(connection, 'SELECT * FROM storage_box WHERE id = 2', None, False, 0.004)
+
+        [(sql, statement)] = log.top()
+
+        self.assertEqual(sql, 'SELECT * FROM storage_box WHERE id = ?')
+        self.assertEqual((statement.count, statement.slow, statement.plan), (2, 0, None))
+        self.assertAlmostEqual(statement.seconds, 0.006)
+
+    def test_slow_query_is_logged_with_plan_and_origin(self):
+        log = SlowQueryLog(threshold=0.1)
+
+        with origin('start'), self.assertLogs('self_storage.slow_queries', 'WARNING') as logs:
+            log.record(connection, 'SELECT * FROM storage_box WHERE description = %s', ('x',), False, 0.5)
+
+        self.assertIn('Slow query 500.0 ms from start', logs.output[0])
+        self.assertIn('SCAN storage_box', logs.output[0])
+        [(_, statement)] = log.top()
+        self.assertEqual((statement.slow, statement.origin), (1, 'start'))
+
+    def test_previous_window_is_kept_in_top(self):
+        log = SlowQueryLog(threshold=1, window=0)
+        log.record(connection, 'SELECT 1', None, False, 0.001)
+
+        with self.assertLogs('self_storage.slow_queries', 'INFO'):
+            log.record(connection, 'SELECT 2', None, False, 0.001)
+
+        [(_, statement)] = log.top()
+        self.assertEqual(statement.count, 2)
@@ -1,3 +1,42 @@
-from django.shortcuts import render
+from asgiref.sync import sync_to_async
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, StreamingHttpResponse
+from django.utils import timezone
+from django.views.decorators.http import require_GET
 
-# Create your views here.
+from .exports import EXPORTS, FORMATS, filter_rows
+
+_END = object()
+
+
+async def iter_in_thread(chunks):
+    """Асинхронный итератор поверх синхронного: каждая порция читается из БД в потоке Django.
+
+    Под ASGI Django 4.2 синхронный итератор StreamingHttpResponse сначала
+    читает целиком в память, асинхронный отдается по мере чтения.
+    """
+    next_chunk = sync_to_async(next)
+    while (chunk := await next_chunk(chunks, _END)) is not _END:
+        yield chunk
+
+
+@require_GET
+@staff_member_required
+def export_rows(request, name, export_format):
+    """Выгрузка для бухгалтерии: /export/boxes.csv?overdue=1, /export/users.jsonl?utm_source=vk."""
+    if name not in EXPORTS or export_format not in FORMATS:
+        raise Http404
+    export = EXPORTS[name]
+    content_type, iter_rows = FORMATS[export_format]
+
+    rows = filter_rows(export, request.GET)
+    chunks = iter_rows(rows, export.fields)
+    if isinstance(request, ASGIRequest):
+        chunks = iter_in_thread(chunks)
+    response = StreamingHttpResponse(chunks, content_type=content_type)
+    filename = f'{name}-{timezone.localdate():%Y-%m-%d}.{export_format}'
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    # nginx иначе копит ответ в буфере и первый байт приходит в конце выгрузки
+    response['X-Accel-Buffering'] = 'no'
+    return response